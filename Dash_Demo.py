@@ -1,67 +1,183 @@
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output
-import pandas as pd
-import sqlite3
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import plotly.graph_objs as go
 
+from mesi import data_store, figure_cache, map_lod, metrics, sqlite_query
+from mesi.config import LAZY_STARTUP, MAP_POINT_BUDGET, QUERY_BACKEND, REFRESH_INTERVAL
+from mesi.live_refresh import DatabaseWatcher, start_polling
+from mesi.query_index import SiteQueryIndex
+from mesi.spatial_index import SpatialIndex, haversine_km
+from mesi.startup import BackgroundLoader, add_ready_route
+
 # 创建 Dash 应用
 app = dash.Dash(__name__)
 server = app.server
 
-# 连接到 SQLite 数据库并读取 Site_main 表格数据
+# 在 /metrics 暴露回调耗时与响应大小（Prometheus 文本格式）
+metrics.instrument_flask(server)
+
+# 从共享的列式数据存储读取 Site_main 表格数据（首次使用时由 MESI.db 转换，各 worker 以内存映射方式共享）
 def get_site_main():
-    conn = sqlite3.connect('MESI.db')
-    df = pd.read_sql_query("SELECT * FROM Site_main", conn)
-    conn.close()
-    return df
+    return data_store.get_frame('Site_main')
+
+
+df_site_main = site_index = spatial_index = main_layout = dropdown_options = None
+
+# 数据版本号：本进程每次载入新数据时加一，页面通过 data-version 判断是否需要刷新
+data_version = 0
+watcher = DatabaseWatcher()
+
+# 图表缓存键中的数据状态（与 data_version 不同，各 worker 进程之间一致）
+figure_data = None
+
+
+def current_figure_data():
+    if QUERY_BACKEND == 'sqlite':
+        identity = data_store.db_identity()  # 先于水位读取：期间的新提交在下次刷新时体现
+        return figure_cache.data_key(sqlite_query.watermark('Site_main'), identity)
+    return figure_cache.data_key(data_store.watermark('Site_main'), data_store.identity('Site_main'))
+
+
+# 获取唯一的 site、lat 和 lon 信息，生成三个下拉菜单的选项
+def build_dropdown_options():
+    if QUERY_BACKEND == 'sqlite':
+        unique_sites, unique_lats, unique_lons = (sqlite_query.distinct_values(col) for col in ('site', 'lat', 'lon'))
+    else:
+        unique_sites = df_site_main['site'].dropna().unique()
+        unique_lats = df_site_main['lat'].dropna().unique()
+        unique_lons = df_site_main['lon'].dropna().unique()
+    return ([{'label': site, 'value': site} for site in unique_sites],
+            [{'label': str(lat), 'value': lat} for lat in unique_lats],
+            [{'label': str(lon), 'value': lon} for lon in unique_lons])
+
 
+# 每个 site 一个点的经纬度网格索引，用于查找点击的聚合网格内的 site
+def build_spatial_index():
+    if QUERY_BACKEND == 'sqlite':
+        return SpatialIndex(sqlite_query.site_points())
+    return SpatialIndex(map_lod.dedupe_sites(df_site_main))
 
-df_site_main = get_site_main()
 
-# 获取唯一的 site、lat 和 lon 信息
-unique_sites = df_site_main['site'].dropna().unique()
-unique_lats = df_site_main['lat'].dropna().unique()
-unique_lons = df_site_main['lon'].dropna().unique()
+# 加载数据、建立索引并生成页面布局（由 data_loader 执行一次，fork 出的 worker 直接继承）
+def initialize_data():
+    global df_site_main, site_index, spatial_index, main_layout, dropdown_options, figure_data
+    watcher.changed()  # 记录当前版本，加载期间的新提交由第一次刷新补上
+    if QUERY_BACKEND == 'sqlite':
+        # 筛选和点击查询下推到 MESI.db（只读连接池 + 覆盖索引），进程内不保留整表
+        sqlite_query.prepare_database()
+    else:
+        df_site_main = get_site_main()
+
+        # 预先建立 site、lat、lon 到行号的倒排索引，筛选变为集合求交，点击查询为 O(1)
+        site_index = SiteQueryIndex(df_site_main)
+
+    dropdown_options = build_dropdown_options()
+    spatial_index = build_spatial_index()
+    figure_data = current_figure_data()
+    main_layout = build_layout(*dropdown_options, data_version)
+
+
+# 每个提供服务的进程各自启动轮询线程（线程不会随 fork 复制）
+def start_threads():
+    start_polling(refresh_data)
+
+
+# MESI.db 有新提交时追加新行：索引只为新行增量建立，其余变化则整表重新加载
+def refresh_data():
+    global df_site_main, site_index, spatial_index, main_layout, dropdown_options, data_version, figure_data
+    data_loader.wait()
+    if not watcher.changed():
+        return
+    if QUERY_BACKEND != 'sqlite':  # sqlite 模式下查询本来就读取最新数据，只需更新选项
+        try:
+            changes = data_store.refresh_frames()
+        except Exception:
+            watcher.reset()  # 下次检查时重试
+            raise
+        if 'Site_main' not in changes:
+            return
+        df = get_site_main()
+        site_index = SiteQueryIndex(df) if changes['Site_main'] is None else site_index.extend(df)
+        df_site_main = df
+    dropdown_options = build_dropdown_options()
+    spatial_index = build_spatial_index()
+    figure_data = current_figure_data()
+    data_version += 1
+    main_layout = build_layout(*dropdown_options, data_version)
+
+
+# 延迟启动模式下数据在后台线程加载，服务立即响应；/ready 在加载完成前返回 503
+data_loader = BackgroundLoader(initialize_data, start_threads)
+add_ready_route(server, data_loader)
+
 
 # 创建 Dash 应用的布局
-app.layout = html.Div([
-    html.H1('Site World Map'),
-
-    # 地图展示
-    dcc.Graph(id='world-map', config={'scrollZoom': False}),
-
-    # 下拉菜单选择 site
-    html.Label("Select Site:"),
-    dcc.Dropdown(
-        id='site-dropdown',
-        options=[{'label': site, 'value': site} for site in unique_sites],
-        placeholder="Select a site",
-        multi=True  # 允许多选
-    ),
-
-    # 下拉菜单选择 lat
-    html.Label("Select Latitude (Optional):"),
-    dcc.Dropdown(
-        id='lat-dropdown',
-        options=[{'label': str(lat), 'value': lat} for lat in unique_lats],
-        placeholder="Select a latitude",
-        multi=True  # 允许多选
-    ),
-
-    # 下拉菜单选择 lon
-    html.Label("Select Longitude (Optional):"),
-    dcc.Dropdown(
-        id='lon-dropdown',
-        options=[{'label': str(lon), 'value': lon} for lon in unique_lons],
-        placeholder="Select a longitude",
-        multi=True  # 允许多选
-    ),
-
-    # 点击 site 后展示相关信息
-    html.Hr(),
-    html.Div(id='site-data')
-])
+def build_layout(site_options, lat_options, lon_options, version):
+    return html.Div([
+        html.H1('Site World Map'),
+
+        # 定时检查数据版本，有新数据时刷新下拉菜单和地图
+        dcc.Interval(id='data-refresh', interval=max(REFRESH_INTERVAL, 1) * 1000, disabled=REFRESH_INTERVAL <= 0),
+        dcc.Store(id='data-version', data=version),
+
+        # 地图展示
+        dcc.Graph(id='world-map', config={'scrollZoom': False}),
+
+        # 下拉菜单选择 site
+        html.Label("Select Site:"),
+        dcc.Dropdown(
+            id='site-dropdown',
+            options=site_options,
+            placeholder="Select a site",
+            multi=True  # 允许多选
+        ),
+
+        # 下拉菜单选择 lat
+        html.Label("Select Latitude (Optional):"),
+        dcc.Dropdown(
+            id='lat-dropdown',
+            options=lat_options,
+            placeholder="Select a latitude",
+            multi=True  # 允许多选
+        ),
+
+        # 下拉菜单选择 lon
+        html.Label("Select Longitude (Optional):"),
+        dcc.Dropdown(
+            id='lon-dropdown',
+            options=lon_options,
+            placeholder="Select a longitude",
+            multi=True  # 允许多选
+        ),
+
+        # 点击 site 后展示相关信息
+        html.Hr(),
+        html.Div(id='site-data')
+    ])
+
+
+# 数据加载完成前返回提示页（每两秒自动刷新，直到数据就绪）
+def serve_layout():
+    if not data_loader.ready():
+        return html.Div([
+            html.Meta(httpEquiv='refresh', content='2'),
+            html.H1('Site World Map'),
+            html.P('数据加载中，请稍候……'),
+        ])
+    return main_layout
+
+
+# 回调校验使用空选项的完整布局，页面请求时才读取已加载的数据
+app.validation_layout = build_layout([], [], [], 0)
+app.layout = serve_layout
+
+# 延迟启动时立即在后台开始加载，否则在导入阶段加载完成且不启动线程（gunicorn --preload fork 出的 worker 共享已加载的数据）
+if LAZY_STARTUP:
+    data_loader.start()
+else:
+    data_loader.load()
 
 
 # 更新地图，根据 site, lat, lon 筛选
@@ -69,29 +185,41 @@ app.layout = html.Div([
     Output('world-map', 'figure'),
     [Input('site-dropdown', 'value'),
      Input('lat-dropdown', 'value'),
-     Input('lon-dropdown', 'value')]
+     Input('lon-dropdown', 'value'),
+     Input('data-version', 'data')]
 )
-def update_map(selected_sites, selected_lats, selected_lons):
-    filtered_df = df_site_main
+@metrics.timed('update_map')
+def update_map(selected_sites, selected_lats, selected_lons, version=None):
+    data_loader.wait()
+
+    # 相同筛选条件的地图在各会话、各 worker 之间共享（筛选值的顺序不影响结果）
+    key = figure_cache.figure_key('site_map', figure_data, sites=set(selected_sites or []),
+                                  lats=set(selected_lats or []), lons=set(selected_lons or []))
+    return figure_cache.cache.figure('site_map', key,
+                                     lambda: render_map(selected_sites, selected_lats, selected_lons))
 
-    # 根据选择的 site, lat, lon 进行筛选
-    if selected_sites:
-        filtered_df = filtered_df[filtered_df['site'].isin(selected_sites)]
-    if selected_lats:
-        filtered_df = filtered_df[filtered_df['lat'].isin(selected_lats)]
-    if selected_lons:
-        filtered_df = filtered_df[filtered_df['lon'].isin(selected_lons)]
+
+# 根据选择的 site, lat, lon 筛选出地图上的点，每个 site 一个（通过倒排索引求交集，或在 SQLite 中按索引查询）
+def filtered_points(selected_sites, selected_lats, selected_lons):
+    if QUERY_BACKEND == 'sqlite':
+        return sqlite_query.site_points(selected_sites, selected_lats, selected_lons)
+    return map_lod.dedupe_sites(site_index.filter(selected_sites, selected_lats, selected_lons))
+
+
+def render_map(selected_sites, selected_lats, selected_lons):
+    # 每个 site 只保留一个点，超过点数上限时按经纬度网格聚合
+    points = map_lod.level_of_detail(filtered_points(selected_sites, selected_lats, selected_lons))
 
     # 创建地图
     fig = go.Figure()
 
     fig.add_trace(go.Scattergeo(
-        lon=filtered_df['lon'],  # 经度
-        lat=filtered_df['lat'],  # 纬度
-        text=filtered_df['site'],  # 悬停显示 site 名字
+        lon=points['lon'],  # 经度
+        lat=points['lat'],  # 纬度
+        text=map_lod.point_text(points),  # 悬停显示 site 名字（聚合网格显示 site 数量）
         mode='markers',  # 以点的方式展示
         marker=dict(
-            size=2,  # 将点的大小设置为 4
+            size=map_lod.marker_sizes(points, 2),  # 单个 site 的点大小为 2，聚合网格随 site 数量增大
             color='blue',  # 设置点的颜色
             symbol='circle'
         )
@@ -111,31 +239,79 @@ def update_map(selected_sites, selected_lats, selected_lons):
     return fig
 
 
+# 数据版本变化时推送新的下拉菜单选项（update_map 随 data-version 一起刷新地图）
+@app.callback(
+    [Output('data-version', 'data'),
+     Output('site-dropdown', 'options'),
+     Output('lat-dropdown', 'options'),
+     Output('lon-dropdown', 'options')],
+    [Input('data-refresh', 'n_intervals')],
+    [State('data-version', 'data')]
+)
+@metrics.timed('refresh_options')
+def refresh_options(n_intervals, shown_version):
+    if shown_version == data_version:
+        raise PreventUpdate
+    return (data_version,) + dropdown_options
+
+
 # 定义回调函数，处理点击事件并展示 site 数据
 @app.callback(
     Output('site-data', 'children'),
-    [Input('world-map', 'clickData')]
+    [Input('world-map', 'clickData')],
+    [State('site-dropdown', 'value'),
+     State('lat-dropdown', 'value'),
+     State('lon-dropdown', 'value')]
 )
-def display_site_data(clickData):
+@metrics.timed('display_site_data')
+def display_site_data(clickData, selected_sites=None, selected_lats=None, selected_lons=None):
+    data_loader.wait()
+
     if clickData is None:
         return html.Div("Click on a site to see details.")
 
-    # 从点击的数据中提取 site 名称
-    clicked_site = clickData['points'][0]['text']
+    # 从点击的数据中提取 site 名称；聚合网格（文本为 "N sites"）取该网格内离点击位置最近的 site
+    point = clickData['points'][0]
+    clicked_site = point['text']
+    if str(clicked_site).endswith(' sites') and 'lat' in point and 'lon' in point:
+        clicked_site = cell_site(point, selected_sites, selected_lats, selected_lons)
 
-    # 根据 site 名称从数据框中获取相关数据
-    site_info = df_site_main[df_site_main['site'] == clicked_site]
+    # 根据 site 名称从索引中获取该 site 的第一行数据
+    if QUERY_BACKEND == 'sqlite':
+        site_info = sqlite_query.first_site_row(clicked_site)
+    else:
+        site_info = site_index.first_row(clicked_site)
 
-    if site_info.empty:
+    if site_info is None:
         return html.Div("No data available for the selected site.")
 
     # 将 site 的信息转换为 HTML 表格或文本展示
     return html.Table([
-        html.Tr([html.Th(col) for col in site_info.columns]),  # 表头
-        html.Tr([html.Td(site_info.iloc[0][col]) for col in site_info.columns])  # 表体
+        html.Tr([html.Th(col) for col in site_info.index]),  # 表头
+        html.Tr([html.Td(site_info[col]) for col in site_info.index])  # 表体
     ])
 
 
+# 聚合网格中离点击位置最近的 site：按 render_map 所用的同一网格（当前筛选结果的经纬度范围），
+# 在空间索引中取出该网格附近的点，再按当前筛选条件和网格归属确定网格内的 site
+def cell_site(point, selected_sites, selected_lats, selected_lons):
+    points = filtered_points(selected_sites, selected_lats, selected_lons)
+    if len(points) <= MAP_POINT_BUDGET:
+        return None
+    lat_range = (points['lat'].min(), points['lat'].max())
+    lon_range = (points['lon'].min(), points['lon'].max())
+    index = spatial_index
+    candidates = index.points.iloc[index.box(*map_lod.cell_box(point['lat'], point['lon'], lat_range, lon_range))]
+    for col, values in (('site', selected_sites), ('lat', selected_lats), ('lon', selected_lons)):
+        if values:
+            candidates = candidates[candidates[col].isin(values)]
+    members = candidates[map_lod.cell_members(candidates, point['lat'], point['lon'], lat_range, lon_range)]
+    if not len(members):
+        return None
+    distances = haversine_km(point['lat'], point['lon'], members['lat'].to_numpy(), members['lon'].to_numpy())
+    return members['site'].iloc[distances.argmin()]
+
+
 # 运行应用
 if __name__ == '__main__':
     app.run_server(debug=True, port=8051)
@@ -1,162 +1,274 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import plotly.graph_objs as go
 import pandas as pd
 import panel as pn
-import sqlite3
 import numpy as np
-
-# Initialize Panel extension
-pn.extension('plotly')
-pn.extension('tabulator')
-
-# Connect to the database and load data
-conn = sqlite3.connect('MESI.db')
-df_main = pd.read_sql_query("SELECT * FROM Site_main", conn)
-df_metadata = pd.read_sql_query("SELECT * FROM Site_metadata", conn)
-conn.close()
-
-# Header/Title
-header = pn.Row(
-    pn.layout.HSpacer(),
-    pn.pane.Markdown("# MESI DASH", styles={'text-align': 'center', 'font-size': '20px'}),
-    pn.layout.HSpacer(),
-    height=80  # Fixed height for header
-)
-
-# Extract unique values of site lat and lon as unique index(site, lat, lon)
-unique_sites = df_main['site'].dropna().unique().tolist()
-unique_lats = df_main['lat'].dropna()
-unique_lons = df_main['lon'].dropna()
-
-# Function to create a download button
-def create_download_button(dataframe, filename="data.csv"):
-    def get_file():
-        if dataframe is None or dataframe.empty:
-            # form an empty dataframe
-            buffer = io.StringIO("No data available\n")
-            return io.BytesIO(buffer.getvalue().encode('utf-8'))
+import pyarrow as pa
+from bokeh.models import ColumnDataSource
+from urllib.parse import urlencode
+
+from mesi import (color_scale, data_store, export, figure_cache, map_lod, meta_analysis, metrics, model_fit,
+                  process_pool, ratio_map, sqlite_query, warmup)
+from mesi.config import (BOOTSTRAP_REPLICATES, COMPUTE_THREADS, LAZY_STARTUP, MAP_POINT_BUDGET, MAP_UPDATE_MODE, NUM_PROCS, NUM_THREADS,
+                         PORT, QUERY_BACKEND, REFRESH_INTERVAL, TABLE_PAGE_SIZE, WARMUP_PROCS)
+from mesi.live_refresh import DatabaseWatcher, start_polling
+from mesi.ratio_engine import RatioEngine
+from mesi.spatial_index import SpatialIndex
+from mesi.startup import BackgroundLoader, ReadyHandler
+
+# Initialize Panel extension (nthreads lets each process handle several session events at once)
+pn.extension('plotly', 'tabulator', nthreads=NUM_THREADS)
+
+# Executor for pandas/Plotly work, so the Bokeh event loop keeps serving other sessions
+executor = ThreadPoolExecutor(max_workers=COMPUTE_THREADS)
+
+async def run_in_executor(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+# ## Process-wide data, shared read-only by every session
+# Load data from the shared, memory-mapped columnar store (converted from MESI.db on first use).
+# The frames are taken from the store when needed: after new rows are appended they are only rebuilt
+# by the first reader.
+def load_data():
+    df_main = data_store.get_frame('Site_main')
+    df_metadata = data_store.get_frame('Site_metadata')
+    return df_main, df_metadata
+
+ratio_engine = site_points = spatial_index = None
+unique_sites = lat_range = lon_range = None
+# The same sites as a set, for membership tests (replaced, never mutated, when sites are added)
+site_set = frozenset()
+
+# Bumped whenever this process applies new data; sessions compare it with the version they show
+data_version = 0
+
+# Data version -> (treatment, response) pairs whose ratios changed in it, or None if everything did
+data_changes = {}
+
+# State of the data in the figure cache keys; unlike data_version the same in every worker process
+figure_data = None
+
+watcher = DatabaseWatcher()
+
+# Load the frames and build the derived state (run once by data_loader; forked workers inherit it)
+def initialize_data():
+    global ratio_engine, site_points, spatial_index, unique_sites, site_set, lat_range, lon_range, figure_data
+    watcher.changed()  # Baseline: commits made while loading are picked up by the first refresh
+    if QUERY_BACKEND == 'sqlite':
+        # Filters and the ratio aggregation are pushed down to MESI.db; only the site summary is kept
+        sqlite_query.prepare_database()
+    else:
+        # Precompute the log-ratio cube once; widget changes are answered by indexed lookups
+        ratio_engine = RatioEngine(load_data()[0], version=data_version)
+
+    site_points, unique_sites, lat_range, lon_range = site_summary()
+    site_set = frozenset(unique_sites)
+    spatial_index = SpatialIndex(site_points)  # Slider boxes and click radii over the site points
+    figure_data = current_figure_data()
+
+# Threads of every process serving the data (started by data_loader; threads do not survive fork)
+def start_threads():
+    start_polling(refresh_data)
+    if WARMUP_PROCS > 0:
+        warmup_scheduler.request()
+
+# Figure cache state of the loaded data (the database itself with the sqlite backend)
+def current_figure_data():
+    if QUERY_BACKEND == 'sqlite':
+        identity = data_store.db_identity()  # Before the watermark: a commit made meanwhile shows next time
+        return figure_cache.data_key(sqlite_query.watermark('Site_main'), identity)
+    return figure_cache.data_key(data_store.watermark('Site_main'), data_store.identity('Site_main'))
+
+# Site points of the main map, site list and slider bounds
+def site_summary():
+    if QUERY_BACKEND == 'sqlite':
+        return (sqlite_query.site_points(), sqlite_query.distinct_values('site'),
+                sqlite_query.value_range('lat'), sqlite_query.value_range('lon'))
+
+    # One point per site for the main map
+    df_main = data_store.get_frame('Site_main')
+    points = map_lod.dedupe_sites(df_main)
+
+    # Extract unique sites and the lat/lon bounds of the sliders
+    sites = df_main['site'].dropna().unique().tolist()
+    return (points, sites, (df_main['lat'].min(), df_main['lat'].max()),
+            (df_main['lon'].min(), df_main['lon'].max()))
+
+data_lock = threading.Lock()
+
+# Widen a (min, max) range to cover new values
+def extend_range(value_range, values):
+    return (np.nanmin([value_range[0], values.min()]), np.nanmax([value_range[1], values.max()]))
+
+# Catch up with rows added to MESI.db: new rows are appended to the stored tables and folded into the
+# derived state; any other change reloads the tables. Runs on the polling thread only: callbacks read
+# the state it publishes, and sessions pick the changes up in apply_data_changes.
+def refresh_data():
+    global site_points, spatial_index, unique_sites, site_set, lat_range, lon_range, data_version, figure_data
+    data_loader.wait()
+    if not watcher.changed():
+        return
+    with data_lock:
+        version = data_version + 1
+        if QUERY_BACKEND == 'sqlite':
+            changes = {'Site_main': None}  # Queries read the database directly; only the site summary follows
+        else:
+            try:
+                changes = data_store.refresh_frames()
+            except Exception:
+                watcher.reset()  # Retry on the next check
+                raise
+            if not changes:
+                return
+
+        if 'Site_main' not in changes:
+            changed_pairs = set()  # Only Site_metadata changed
+        elif changes['Site_main'] is None:
+            if ratio_engine is not None:
+                ratio_engine.rebuild(data_store.get_frame('Site_main'), version)
+            site_points, unique_sites, lat_range, lon_range = site_summary()
+            site_set = frozenset(unique_sites)
+            changed_pairs = None
         else:
-            # transform to csv format
-            buffer = io.BytesIO()
-            dataframe.to_csv(buffer, index=False, encoding='utf-8')
-            buffer.seek(0)
-            return buffer
-    return pn.widgets.FileDownload(callback=get_file, filename=filename, button_type="success", name="Download CSV")
-
-# ## General main map formation
-# Create MultiChoice widget for selecting sites
-site_select = pn.widgets.MultiChoice(
-    name='Select Site', options=df_main['site'].dropna().unique().tolist(), value=[],
-    placeholder='Select one or more sites',
-    width=180
-)
-
-# Latitude and Longitude range sliders
-lat_slider = pn.widgets.RangeSlider(
-    name='Latitude slider', bar_color='skyblue',
-    start=unique_lats.min(), end=unique_lats.max(), step=0.5,
-    value=(unique_lats.min(), unique_lats.max())
-)
-
-lon_slider = pn.widgets.RangeSlider(
-    name='Longitude slider', bar_color='skyblue',
-    start=unique_lons.min(), end=unique_lons.max(), step=0.5,
-    value=(unique_lons.min(), unique_lons.max())
-)
-
-# Initialize DataFrame widget for displaying general main data
-site_data_table = pn.widgets.Tabulator(pd.DataFrame(), height=500, width=310, show_index=False)
-
-# Define selected data option and initial site filter
-selected_option = "all"  # Default option for showing all data
-
-# Define function to filter data based on button selection and site_select
-def update_table(event=None):
-    global selected_option
-    # Get the currently selected sites
-    selected_sites = site_select.value
-
-    # Check selected_option to decide which data to show
-    if selected_option == "Site_cite":
-        filtered_df = df_main[['site', 'lat', 'lon', 'citation', 'study']]
-    elif selected_option == "Site_meta":
-        filtered_df = df_metadata
-    elif selected_option == "Site_data":
-        filtered_df = df_main[['site', 'lat', 'lon', 'treatment', 'response', 'x_c', 'x_t', 'x_units']]
-    else:  # Default: show all data in Site_main if "all" is selected
-        filtered_df = df_main
-
-    # Apply site filtering if there are selected sites
+            rows = changes['Site_main']
+            changed_pairs = ratio_engine.append(rows, version)
+            site_points = map_lod.append_sites(site_points, rows)
+            new_sites = [site for site in rows['site'].dropna().unique() if site not in site_set]
+            unique_sites = unique_sites + new_sites
+            site_set = site_set.union(new_sites)
+            lat_range = extend_range(lat_range, rows['lat'])
+            lon_range = extend_range(lon_range, rows['lon'])
+        if 'Site_main' in changes:
+            spatial_index = SpatialIndex(site_points)
+
+        data_changes[version] = changed_pairs
+        data_changes.pop(version - 100, None)  # Sessions further behind refresh everything
+        data_version = version
+        figure_data = current_figure_data()
+    if WARMUP_PROCS > 0:
+        warmup_scheduler.request()
+
+# Pairs whose ratios changed after `version`, or None if the session has to refresh everything
+def changes_since(version):
+    changed_pairs = set()
+    for newer in range(version + 1, data_version + 1):
+        if data_changes.get(newer) is None:
+            return None
+        changed_pairs |= data_changes[newer]
+    return changed_pairs
+
+# In lazy startup mode the data loads in the background while the server is already answering;
+# sessions get a placeholder page that is swapped for the dashboard once the data is ready
+data_loader = BackgroundLoader(initialize_data, start_threads)
+
+# Function to create the download links of a streaming export (served by export.ExportHandler)
+def export_links(name, **params):
+    links = []
+    for fmt in export.FORMATS:
+        query = urlencode({**params, 'format': fmt}, doseq=True)
+        links.append(f'<a href="export/{name}?{query}" download>{fmt}</a>')
+    return 'Download: ' + ' | '.join(links)
+
+# Source table and columns of each data option (None shows every column)
+SITE_VIEWS = {
+    "Site_cite": ('Site_main', ['site', 'lat', 'lon', 'citation', 'study']),
+    "Site_meta": ('Site_metadata', None),
+    "Site_data": ('Site_main', ['site', 'lat', 'lon', 'treatment', 'response', 'x_c', 'x_t', 'x_units']),
+    "all": ('Site_main', None),
+}
+
+# Frame of a data option, projected once per data version and shared by every session
+site_views = {}
+
+def site_view(option):
+    with data_lock:
+        key = (option, data_version)
+        if key not in site_views:
+            for stale in [stale for stale in site_views if stale[1] < data_version]:
+                del site_views[stale]  # Frames of older data versions; other options are kept
+            table, columns = SITE_VIEWS[option]
+            df = data_store.get_frame(table)
+            site_views[key] = df[columns] if columns else df
+        return site_views[key]
+
+# Remote-paginated table reading its pages from MESI.db (sqlite backend): the site selection, header
+# filters and sorters become the WHERE and ORDER BY of a LIMIT/OFFSET query, so a session only holds
+# the visible page. `value` is an empty frame with the columns (and dtypes) of the pages.
+class SqlPageTable(pn.widgets.Tabulator):
+    source = None  # (table, columns, selected sites)
+    _total = 0
+    _page = None  # Last page read, with the query it answers
+
+    @property
+    def _length(self):
+        return self._total if self.source is not None else super()._length
+
+    def _read_page(self, page=None):
+        table, columns, sites = self.source
+        nrows = self.page_size or self.initial_page_size
+        page = page or self.page
+        query = (self.source, repr(self.filters), repr(self.sorters), page, nrows)
+        if self._page is None or self._page[0] != query:
+            rows, total = sqlite_query.site_page(table, columns, sites, self.filters, self.sorters,
+                                                 (page - 1) * nrows, nrows)
+            rows.index = pd.RangeIndex((page - 1) * nrows, (page - 1) * nrows + len(rows))
+            self._page = (query, rows, total)
+        _, rows, self._total = self._page
+        return rows
+
+    def _get_data(self):
+        if self.source is None:
+            return super()._get_data()
+        rows = self._read_page()
+        return rows, {str(k): self._process_column(v, k, rows) for k, v in ColumnDataSource.from_df(rows).items()}
+
+    # Show the selected sites' rows of a table from the first page (read again if the data changed)
+    def show(self, table, columns, selected_sites):
+        self.source, self._page = (table, columns, tuple(selected_sites)), None
+        schema = self._read_page(page=1).iloc[:0]
+        self.param.update(page=1, value=schema)
+
+# Site filter applied by the table when it computes the visible page
+def filter_sites(df, selected_sites):
     if selected_sites:
-        filtered_df = filtered_df[filtered_df['site'].isin(selected_sites)]
-
-    # Update the table display
-    site_data_table.value = filtered_df if not filtered_df.empty else pd.DataFrame(columns=filtered_df.columns)
-
-# Define button click handlers to update the selected_option and refresh table
-def select_site_cite(event):
-    global selected_option
-    selected_option = "Site_cite"
-    button_site_cite.button_type = 'danger'  # Change color to red when selected
-    button_site_meta.button_type = 'primary'
-    button_site_data.button_type = 'primary'
-    update_table()
-
-def select_site_meta(event):
-    global selected_option
-    selected_option = "Site_meta"
-    button_site_cite.button_type = 'primary'
-    button_site_meta.button_type = 'danger'  # Change color to red when selected
-    button_site_data.button_type = 'primary'
-    update_table()
-
-def select_site_data(event):
-    global selected_option
-    selected_option = "Site_data"
-    button_site_cite.button_type = 'primary'
-    button_site_meta.button_type = 'primary'
-    button_site_data.button_type = 'danger'  # Change color to red when selected
-    update_table()
-
-# Reset to show all data
-def show_all_data(event):
-    global selected_option
-    selected_option = "all"
-    button_site_cite.button_type = 'primary'
-    button_site_meta.button_type = 'primary'
-    button_site_data.button_type = 'primary'
-    update_table()
-
-# Define buttons and set their callbacks
-button_site_cite = pn.widgets.Button(name='Site_cite', button_type='primary')
-button_site_meta = pn.widgets.Button(name='Site_meta', button_type='primary')
-button_site_data = pn.widgets.Button(name='Site_data', button_type='primary')
-button_show_all = pn.widgets.Button(name='Show All', button_type='success')  #Button to reset to show all data
-
-button_site_cite.on_click(select_site_cite)
-button_site_meta.on_click(select_site_meta)
-button_site_data.on_click(select_site_data)
-button_show_all.on_click(show_all_data)  # Add callback for the "Show All" button
-
-# Watch for site selection changes and update table accordingly
-site_select.param.watch(update_table, 'value')
-
-# Define default main map plotting function
-@pn.depends(site_select.param.value, lat_slider.param.value, lon_slider.param.value)
+        return df[df['site'].isin(selected_sites)]
+    return df
+
+# Define default main map plotting function (shared through the figure cache)
+@metrics.stage('plot_main_map')  # Payload size recorded by the figure cache
 def plot_main_map(selected_sites, lat_range, lon_range):
-    # Filter data by latitude and longitude range
-    filtered_df = df_main[(df_main['lat'].between(*lat_range)) & (df_main['lon'].between(*lon_range))]
-    filtered_df['color'] = filtered_df['site'].apply(lambda x: 'red' if x in selected_sites else 'blue')
+    key = figure_cache.figure_key('main_map', figure_data, sites=set(selected_sites), lat_range=lat_range,
+                                  lon_range=lon_range)
+    return figure_cache.cache.figure('main_map', key, lambda: render_main_map(selected_sites, lat_range, lon_range))
+
+def render_main_map(selected_sites, lat_range, lon_range):
+    # Sites inside the latitude and longitude ranges (box query on the site index)
+    index = spatial_index
+    filtered_df = index.points.iloc[index.box(lat_range, lon_range)]
+    selected_df = filtered_df[['site', 'lat', 'lon']].assign(selected=filtered_df['site'].isin(selected_sites))
+
+    # One marker per site, binned on a grid when the slider range holds too many sites
+    points = map_lod.level_of_detail(selected_df, lat_range, lon_range, flag_col='selected')
+    colors = np.where(points['selected'], 'red', 'blue')
 
     # Create Plotly map
     fig = go.Figure(go.Scattergeo(
-        lon=filtered_df['lon'],
-        lat=filtered_df['lat'],
-        text=filtered_df['site'],
+        lon=points['lon'],
+        lat=points['lat'],
+        text=map_lod.point_text(points),
         mode='markers',
-        marker=dict(size=3, color=filtered_df['color'], symbol='circle'),
+        marker=dict(size=map_lod.marker_sizes(points, 3), color=colors, symbol='circle'),
         hoverinfo='text'
     ))
 
+    return main_map_layout(fig)
+
+# Shared layout of the main map
+def main_map_layout(fig):
     fig.update_layout(
         title='',
         geo=dict(projection_type='natural earth',
@@ -164,226 +276,735 @@ def plot_main_map(selected_sites, lat_range, lon_range):
                  landcolor="lightgray",
                  coastlinecolor="black"),
         margin=dict(l=0, r=0, t=0, b=0),
-        width=700, height=600  # Adjusted width and height for map size
+        width=700, height=600,  # Adjusted width and height for map size
+        uirevision='main_map'  # Keep zoom and pan when the trace is patched
     )
     return fig
 
-# Create a Plotly panel for the map and set up click event handling
-plot_pane = pn.pane.Plotly(plot_main_map)
-
-# Click event on main map handler function
-def handle_click(event):
-    if 'points' in event.new and len(event.new['points']) > 0:
-        clicked_site = event.new['points'][0]['text']
-        if clicked_site in site_select.value:
-            site_select.value = [site for site in site_select.value if site != clicked_site]
-        else:
-            site_select.value = site_select.value + [clicked_site]
-    else:
-        print("Click event did not return expected data format:", event)
-
-# Watch for click events on plot_pane and trigger handle_click
-plot_pane.param.watch(handle_click, 'click_data')
-
-# Bind the update_table function to ensure table refresh
-table_panel = pn.panel(update_table)
-
-# Main dashboard layout with fixed width percentages
-control_panel = pn.Column(
-pn.Spacer(height=100),
-    site_select, lat_slider, lon_slider, pn.Row(button_site_cite, button_site_meta), pn.Row(button_site_data, button_show_all),  width=200,
-)
-
-# Create download button for site_data_table
-site_download_button = create_download_button(pd.DataFrame(), filename="site_data.csv")
-
-# Update the download button for site_data_table
-@pn.depends(site_data_table.param.value, watch=True)
-def update_site_download(value):
-    if value is not None and not value.empty:
-        site_download_button.filename = "site_data.csv"
-        site_download_button.callback = lambda: io.BytesIO(value.to_csv(index=False).encode('utf-8'))
-
-
-# Update the Panel layout to include the download buttons
-main_dashboard = pn.Row(
-    control_panel,
-    pn.Spacer(width=30),
-    pn.Column(plot_pane, width=700),  # Increased map width
-    pn.Spacer(width=30),
-    pn.Column(site_data_table, site_download_button, width=200)  # Add download button next to site_data_table
-)
-
-
+# Incremental mode: build the base trace of every site once, then only patch the marker color
+# array on selection changes and the visible-index set (selectedpoints) on slider moves.
+# Client mode builds the same trace but computes both patches in the browser (MAIN_MAP_CLIENT_JS).
+def use_incremental_map():
+    return MAP_UPDATE_MODE in ('incremental', 'client') and len(site_points) <= MAP_POINT_BUDGET
+
+# Browser-side version of update_main_map_colors/update_main_map_range. The site coordinates and
+# names are already on the page as the trace's typed arrays; the graph is redrawn with Plotly.react,
+# which (unlike Plotly.restyle) is not reported back to the server.
+MAIN_MAP_CLIENT_JS = """
+const view = Bokeh.index.find_one(plot)
+if (view == null || view.container == null || view.container.data == null)
+  return
+const source = plot.data_sources[0]
+const lats = source.get_column('lat')[0]
+const lons = source.get_column('lon')[0]
+const sites = source.get_column('text')[0]
+const [lat_lo, lat_hi] = lat_slider.value
+const [lon_lo, lon_hi] = lon_slider.value
+const selected = new Set(site_select.value)
+const visible = []
+const colors = new Int8Array(lats.length)
+for (let i = 0; i < lats.length; i++) {
+  if (lats[i] >= lat_lo && lats[i] <= lat_hi && lons[i] >= lon_lo && lons[i] <= lon_hi)
+    visible.push(i)
+  colors[i] = selected.has(sites[i]) ? 1 : 0
+}
+const graph = view.container
+const trace = graph.data[0]
+trace.selectedpoints = visible
+trace.marker = {...trace.marker, color: colors}
+window.Plotly.react(graph, graph.data, graph.layout)
+"""
+
+@metrics.stage('build_main_map', payload=metrics.payload_bytes)
+def build_main_map(points):
+    fig = go.Figure(go.Scattergeo(
+        lon=points['lon'],
+        lat=points['lat'],
+        text=points['site'],
+        mode='markers',
+        marker=dict(size=3, color=np.zeros(len(points), dtype=np.int8), symbol='circle',
+                    colorscale=[[0, 'blue'], [1, 'red']], cmin=0, cmax=1),  # 1 marks a selected site
+        hoverinfo='text',  # Set once; clicks on hidden sites are ignored by handle_click
+        selectedpoints=np.arange(len(points)),
+        unselected=dict(marker=dict(opacity=0))  # Sites outside the slider ranges are hidden
+    ))
+    return main_map_layout(fig)
 
-# ##Ratio map formation
-# Create dropdown widgets for treatment, response, and ecosystem_type(optional)
-treatment_select = pn.widgets.Select(name='Select Treatment', options=['f', 'w', 'i', 'c', 'd'], width=180)
-response_select = pn.widgets.Select(name='Select Response', options=['agb','soil_total_c','soc'], width=180)
-ecosystem_type_select = pn.widgets.Select(name='Select Ecosystem', options=['All'],
-                                          width=180)  # "All" means do not select exact ecosystem_type
+# Treatment and response options of the ratio section
+TREATMENTS = ['f', 'w', 'i', 'c', 'd']
+RESPONSES = ['agb', 'soil_total_c', 'soc']
 
-treatres_panel = pn.Column(
-    pn.Spacer(height=100),
-    treatment_select, response_select, ecosystem_type_select, width=200,
-)
+# Figure cache key of a part of a ratio view ('ratio_map', 'ratio_table' or 'ecosystems')
+def ratio_key(kind, treatment, response, ecosystem_type=None):
+    return figure_cache.figure_key(kind, figure_data, treatment=treatment, response=response,
+                                   ecosystem_type=ecosystem_type if ecosystem_type != "All" else None)
 
 # Ratio = log (x_t / x_c) (x_t means data under certain treatment and x_c means data in control)
-# Function to filter and calculate ratio based on treatment, response, and optional ecosystem_type
+# Function to look up the mean ratio per site for treatment, response, and optional ecosystem_type.
+# With the sqlite backend the tables are shared between workers through the figure cache.
 def calculate_ratio(treatment, response, ecosystem_type=None):
-    # Filter data based on treatment and response
-    df_filtered = df_main[(df_main['treatment'] == treatment) & (df_main['response'] == response)].copy()
-
-    # Convert 'x_t' and 'x_c' to float and remove invalid values
-    df_filtered['x_t'] = pd.to_numeric(df_filtered['x_t'], errors='coerce')
-    df_filtered['x_c'] = pd.to_numeric(df_filtered['x_c'], errors='coerce')
-    df_filtered = df_filtered.dropna(subset=['x_t', 'x_c'])
-    df_filtered = df_filtered[(df_filtered['x_t'] > 0) & (df_filtered['x_c'] > 0)]
-
-    # Calculate log ratio
-    df_filtered['ratio'] = np.log(df_filtered['x_t'] / df_filtered['x_c'])
-
-    # Group by site, lat, lon, ecosystem_type and calculate mean ratio
-    df_grouped_mean = df_filtered.groupby(['site', 'lat', 'lon', 'ecosystem_type']).ratio.mean().reset_index()
-
-    # Apply ecosystem_type filtering if a specific type is selected
-    if ecosystem_type and ecosystem_type != "All":
-        df_grouped_mean = df_grouped_mean[df_grouped_mean['ecosystem_type'] == ecosystem_type]
+    if QUERY_BACKEND == 'sqlite':
+        return figure_cache.cache.frame('ratio_table', ratio_key('ratio_table', treatment, response, ecosystem_type),
+                                        lambda: sqlite_query.ratio_by_site(treatment, response, ecosystem_type))
+    return ratio_engine.lookup(treatment, response, ecosystem_type)
+
+# Ecosystem types available for a treatment/response pair
+def ecosystems(treatment, response):
+    if QUERY_BACKEND == 'sqlite':
+        return figure_cache.cache.value('ecosystems', ratio_key('ecosystems', treatment, response),
+                                        lambda: sqlite_query.ecosystems(treatment, response))
+    return ratio_engine.ecosystems(treatment, response)
+
+# Colour-scale summary kept by the ratio engine for a lookup; SQL results are summarized when plotted
+def ratio_summary(treatment, response, ecosystem_type):
+    return ratio_engine.summary(treatment, response, ecosystem_type) if QUERY_BACKEND != 'sqlite' else None
+
+# Define a function to create the ratio map of a ratio table (see mesi.ratio_map)
+@metrics.stage('plot_ratio_map', payload=metrics.payload_bytes)
+def plot_ratio_map(df_grouped, summary=None):
+    # Color scale from the quantiles of the ratios (one pass, unless a precomputed summary is given)
+    if summary is None:
+        summary = color_scale.summarize(df_grouped['ratio'])
+    return ratio_map.ratio_figure(df_grouped, summary)
+
+# Ratio table and map for a treatment/response/ecosystem_type selection
+@metrics.timed('update_ratio_map')
+def update_ratio_map(treatment, response, ecosystem_type):
+    ecosystem_type = ecosystem_type if ecosystem_type != "All" else None
+    df_grouped = calculate_ratio(treatment, response, ecosystem_type)
+    fig = figure_cache.cache.figure('ratio_map', ratio_key('ratio_map', treatment, response, ecosystem_type),
+                                    lambda: plot_ratio_map(df_grouped, ratio_summary(treatment, response, ecosystem_type)))
+    return df_grouped, fig
+
+# ## Warm-up: after startup and every data change the ratio table, colour scale and ecosystem list of
+# every treatment × response × ecosystem selection are computed, and the ratio maps missing from the
+# figure cache are rendered by a process pool, so the first visit to a view is served from the caches
+@metrics.stage('warm_up')
+def warm_up():
+    data_loader.wait()
+    with warmup.exclusive(figure_cache.cache.directory) as acquired:
+        if not acquired:
+            return  # Another worker is publishing the views to the shared cache directory
+        keys, tasks = [], []
+        for treatment in TREATMENTS:
+            for response in RESPONSES:
+                for ecosystem_type in [None] + ecosystems(treatment, response):
+                    df_grouped = calculate_ratio(treatment, response, ecosystem_type)
+                    key = ratio_key('ratio_map', treatment, response, ecosystem_type)
+                    if not figure_cache.cache.contains(key):
+                        keys.append(key)
+                        summary = ratio_summary(treatment, response, ecosystem_type)
+                        if summary is None:
+                            summary = color_scale.summarize(df_grouped['ratio'])
+                        tasks.append((df_grouped, summary))
+        if not tasks:
+            return
+        rendered = process_pool.imap('warmup', WARMUP_PROCS, ratio_map.render_ratio_map, *zip(*tasks))
+        for key, payload in zip(keys, rendered):
+            figure_cache.cache.put(key, payload)
+
+warmup_scheduler = warmup.WarmupScheduler(warm_up)
+
+# Eager startup: load everything at import (after the functions the load uses are defined). No
+# threads or pools are started here, so the workers forked by pn.serve share the loaded data. The
+# workers of the process pools never run this script.
+if not LAZY_STARTUP:
+    data_loader.load()
+
+# Meta-analysis of every treatment × response × ecosystem_type group, computed once per data version
+# and shared by every session. The bootstrap intervals come from a second, slower pass.
+meta_summaries = {}
+meta_locks = {False: threading.Lock(), True: threading.Lock()}
+
+def meta_summary(bootstrap=False):
+    version = data_version
+    with meta_locks[bootstrap]:
+        if bootstrap not in meta_summaries or meta_summaries[bootstrap][0] != version:
+            if QUERY_BACKEND == 'sqlite':
+                df = sqlite_query.site_rows('Site_main', meta_analysis.GROUP_COLUMNS + meta_analysis.MEASUREMENT_COLUMNS)
+            else:
+                df = data_store.get_frame('Site_main')
+            replicates = BOOTSTRAP_REPLICATES if bootstrap else 0
+            meta_summaries[bootstrap] = (version, meta_analysis.summarize(df, replicates))
+        return meta_summaries[bootstrap][1]
+
+# Regression models of the Model tab (see mesi.model_fit): fitted by background jobs on a process
+# pool, and cached under the data state and the model parameters for every session and worker
+def model_data_key():
+    if QUERY_BACKEND == 'sqlite':
+        metadata = sqlite_query.watermark('Site_metadata')
+    else:
+        metadata = data_store.watermark('Site_metadata')
+    return [figure_data, [int(value) for value in metadata]]  # The models also read Site_metadata
+
+# Rows the models are fitted on, with the data state they were read at. The sqlite backend reads
+# them from MESI.db for the fit only (they may be newer than the key, never older) and leaves the
+# store alone.
+def model_data():
+    if QUERY_BACKEND == 'sqlite':
+        data = model_data_key()
+        return data, sqlite_query.site_rows('Site_main', model_fit.MAIN_COLUMNS), sqlite_query.site_rows('Site_metadata')
+    with data_lock:
+        data, (main, metadata) = model_data_key(), load_data()
+    return data, main, metadata
+
+model_service = model_fit.ModelService(model_data)
+
+# Job fitting the models of a parameter set (grouping, covariates, weighting) on the current data
+def submit_models(params):
+    return model_service.submit(model_data_key(), **params)
+
+# Covariates offered by the Model tab: the coordinates and the numeric Site_metadata columns
+def model_covariates():
+    def names():
+        if QUERY_BACKEND == 'sqlite':
+            metadata = sqlite_query.site_rows('Site_metadata')
+        else:
+            metadata = data_store.get_frame('Site_metadata')
+        return model_fit.covariate_names(metadata)
+    return figure_cache.cache.value('model_covariates', figure_cache.figure_key('model_covariates', model_data_key()),
+                                    names)
+
+# Model parameters of an export request (the query string of export_links)
+def model_params(args):
+    return {'grouping': args['grouping'][0], 'covariates': args.get('covariate', []),
+            'weighting': args.get('weighting', model_fit.WEIGHTINGS[:1])[0]}
+
+# Exports streamed by export.ExportHandler: the selected site view, the current ratio table, the
+# meta-analysis table or the fitted models and their predictions
+def resolve_export(name, args):
+    data_loader.wait()  # Exports can be requested before a lazy startup has loaded the data
+    if name == 'site':
+        table, columns = SITE_VIEWS[args.get('view', ['all'])[0]]
+        if QUERY_BACKEND == 'sqlite':
+            return sqlite_query.site_batches(table, columns, args.get('site')), 'site_data'
+        return export.select_rows(data_store.read_table(table), columns, args.get('site')), 'site_data'
+    if name == 'ratio':
+        df_grouped = calculate_ratio(args['treatment'][0], args['response'][0], args.get('ecosystem_type', ['All'])[0])
+        return pa.Table.from_pandas(df_grouped, preserve_index=False), 'ratio_data'
+    if name == 'meta':
+        return pa.Table.from_pandas(meta_summary(bootstrap=True), preserve_index=False), 'meta_analysis'
+    if name in ('models', 'predictions'):
+        models, predictions = submit_models(model_params(args)).future.result()
+        table = models if name == 'models' else predictions
+        return pa.Table.from_pandas(table, preserve_index=False), f'model_{name}'
+    raise KeyError(name)
+
+
+# ## Per-session dashboard: widgets, callbacks and layout of one browser session
+class MesiDashboard:
+
+    # defer_ratio leaves a placeholder for the ratio section, filled in later by show_ratio_dashboard
+    def __init__(self, defer_ratio=False):
+        # Header/Title
+        self.header = pn.Row(
+            pn.layout.HSpacer(),
+            pn.pane.Markdown("# MESI DASH", styles={'text-align': 'center', 'font-size': '20px'}),
+            pn.layout.HSpacer(),
+            height=80  # Fixed height for header
+        )
 
-    return df_grouped_mean
+        # Define selected data option
+        self.selected_option = "all"  # Default option for showing all data
 
-# Update ecosystem_type options based on selected treatment and response
-@pn.depends(treatment_select.param.value, response_select.param.value)
-def update_ecosystem_options(treatment, response):
-    # Filter data for the selected treatment and response
-    df_filtered = calculate_ratio(treatment, response)
+        # Sequence numbers of the background map updates, so stale results are dropped
+        self._main_map_request = 0
+        self._ratio_request = 0
+        self._analytics_request = 0
+        self._model_request = 0
 
-    # Get unique ecosystem_type values for the filtered data
-    available_ecosystems = ['All'] + df_filtered['ecosystem_type'].dropna().unique().tolist()
-    ecosystem_type_select.options = available_ecosystems  # Update the options
+        # Data version shown by this session (see apply_data_changes)
+        self.data_version = data_version
 
+        self.main_dashboard = self._build_main_dashboard()
 
-update_ecosystem_options(treatment_select.value, response_select.value)
+        if defer_ratio:
+            self.ratio_dashboard = pn.Column(pn.indicators.LoadingSpinner(value=True, size=40), min_height=500)
+        else:
+            self.ratio_dashboard = pn.Column(self._build_ratio_dashboard())
 
-# Define a table widget to display the filtered ratio data
-ratio_data_table = pn.widgets.Tabulator(pd.DataFrame(), height=500, width=310, show_index=False)
+        # Analytics page: filled in when the tab is first opened
+        self.analytics_page = pn.Column(self.header, self._build_analytics_dashboard())
 
+        # Model page: the default models are fitted when the tab is first opened
+        self.model_page = pn.Column(self.header, self._build_model_dashboard())
 
-# Define a function to create and update the ratio map and table
-@pn.depends(treatment_select.param.value, response_select.param.value, ecosystem_type_select.param.value)
-def update_ratio_map(treatment, response, ecosystem_type):
-    df_grouped = calculate_ratio(treatment, response, ecosystem_type if ecosystem_type != "All" else None)
-    ratio_data_table.value = df_grouped[['site', 'lat', 'lon', 'ecosystem_type', 'ratio']]
-
-    # Calculate quantiles for color scale
-    lower_bound = df_grouped['ratio'].quantile(0.05)
-    upper_bound = df_grouped['ratio'].quantile(0.92)
-
-    # Define colorscale based on data distribution
-    # Check and handle extreme cases
-    if df_grouped['ratio'].quantile(0.0) == df_grouped['ratio'].quantile(1):
-        # Case where all values are the same or only one data point
-        lower_bound = df_grouped['ratio'].quantile(0.0) - 1e-18
-        upper_bound = df_grouped['ratio'].quantile(1) + 1e-18
-
-    # Case when all values are zero
-    if (df_grouped['ratio'] == 0).all():
-        colorscale = [[0, "black"]]
-        lower_bound = -0.1
-        upper_bound = 0.1
-
-    # If data contains both negative and positive values
-    elif lower_bound < 0 < upper_bound:
-        zero_position = abs(lower_bound) / (abs(lower_bound) + upper_bound)
-        colorscale = [[0, "red"], [zero_position, "white"], [1, "blue"]]
-
-    # All values are positive
-    elif df_grouped['ratio'].quantile(0.0) >= 0:
-        lower_bound = 0
-        colorscale = [[0, "white"], [1, "blue"]]
-
-    # All values are negative
-    elif df_grouped['ratio'].quantile(1) <= 0:
-        upper_bound = 0
-        colorscale = [[0, "red"], [1, "white"]]
-
-    # Ensure color scale includes zero in all cases
-    cmin = min(lower_bound, 0)
-    cmax = max(upper_bound, 0)
-
-    # Create Plotly scatter map
-    fig = go.Figure(go.Scattergeo(
-        lon=df_grouped['lon'],
-        lat=df_grouped['lat'],
-        text=df_grouped['site'] + ' ' + df_grouped['ecosystem_type'] + ' ' + df_grouped['ratio'].astype(str),
-        mode='markers',
-        marker=dict(
-            size=3,
-            color=df_grouped['ratio'],
-            colorscale=colorscale,
-            cmin=cmin,
-            cmax=cmax,
-            colorbar=dict(title="Ratio(log(x_t / x_c))")
+        # Tabs interface with three pages (dynamic: only the open tab is rendered)
+        self.tabs = pn.Tabs(
+            ("Main", pn.Column(self.header, self.main_dashboard, pn.Spacer(height=30), self.ratio_dashboard)),
+            ("Analytics", self.analytics_page),
+            ("Model", self.model_page),
+            dynamic=True,
+        )
+        self.tabs.param.watch(self.open_tab, 'active')
+        self.layout = pn.Column(self.tabs)
+
+    # ## General main map formation
+    def _build_main_dashboard(self):
+        # Create MultiChoice widget for selecting sites
+        self.site_set = site_set  # Options of site_select as a set
+        self.site_select = pn.widgets.MultiChoice(
+            name='Select Site', options=unique_sites, value=[],
+            placeholder='Select one or more sites',
+            width=180
         )
-    ))
-
-    # Update map layout
-    fig.update_layout(
-        title='World Map with Ratio-colored Points',
-        geo=dict(
-            projection_type='natural earth',
-            showland=True,
-            landcolor="lightgray",
-            coastlinecolor="black"),
-        width=900 # Adjusted width and height for map size
-    )
-
-    return fig
 
-# Create a Plotly panel for the ratio map
-ratio_plot_pane = pn.pane.Plotly(update_ratio_map)
+        # Latitude and Longitude range sliders
+        self.lat_slider = pn.widgets.RangeSlider(
+            name='Latitude slider', bar_color='skyblue',
+            start=lat_range[0], end=lat_range[1], step=0.5,
+            value=lat_range
+        )
 
-# Create download button for ratio_data_table
-ratio_download_button = create_download_button(pd.DataFrame(), filename="ratio_data.csv")
+        self.lon_slider = pn.widgets.RangeSlider(
+            name='Longitude slider', bar_color='skyblue',
+            start=lon_range[0], end=lon_range[1], step=0.5,
+            value=lon_range
+        )
 
-# Update the download button for ratio_data_table
-@pn.depends(ratio_data_table.param.value, watch=True)
-def update_ratio_download(value):
-    if value is not None and not value.empty:
-        ratio_download_button.filename = "ratio_data.csv"
-        ratio_download_button.callback = lambda: io.BytesIO(value.to_csv(index=False).encode('utf-8'))
+        # Clicking the map with a radius toggles every visible site within it
+        self.radius_input = pn.widgets.FloatInput(name='Click radius (km)', value=0, start=0, step=50, width=180)
+
+        # Initialize DataFrame widget for displaying general main data.
+        # Pagination, sorting and header filters run on the server, so only the visible page is sent;
+        # with the sqlite backend they run in MESI.db and only the visible page is read.
+        if QUERY_BACKEND == 'sqlite':
+            self.site_data_table = SqlPageTable(value=pd.DataFrame(), height=500, width=310, show_index=False,
+                                                pagination='remote', page_size=TABLE_PAGE_SIZE,
+                                                header_filters=True, disabled=True,
+                                                selectable=False)  # Selections index the whole table
+        else:
+            self.site_data_table = pn.widgets.Tabulator(pd.DataFrame(), height=500, width=310, show_index=False,
+                                                        pagination='remote', page_size=TABLE_PAGE_SIZE,
+                                                        header_filters=True,
+                                                        disabled=True)  # Read-only: the frames are shared
+            self.site_data_table.add_filter(pn.bind(filter_sites, selected_sites=self.site_select))
+
+        # Download links for site_data_table
+        self.site_download_links = pn.pane.HTML(export_links('site', view='all'), width=310)
+
+        # Define buttons and set their callbacks
+        self.option_buttons = {
+            "Site_cite": pn.widgets.Button(name='Site_cite', button_type='primary'),
+            "Site_meta": pn.widgets.Button(name='Site_meta', button_type='primary'),
+            "Site_data": pn.widgets.Button(name='Site_data', button_type='primary'),
+        }
+        button_show_all = pn.widgets.Button(name='Show All', button_type='success')  #Button to reset to show all data
+
+        for option, button in self.option_buttons.items():
+            button.on_click(lambda event, option=option: self.select_option(option))
+        button_show_all.on_click(lambda event: self.select_option("all"))  # Reset to show all data
+
+        # Watch for site selection changes and update table accordingly
+        self.site_select.param.watch(self.update_table, 'value')
+
+        # Create a Plotly panel for the map and set up click event handling
+        self.spatial_index = spatial_index
+        if use_incremental_map():
+            self.site_points = self.spatial_index.points
+            self.main_map = build_main_map(self.site_points)
+            self.plot_pane = pn.pane.Plotly(self.main_map)
+            if MAP_UPDATE_MODE == 'client':
+                args = {'plot': self.plot_pane, 'site_select': self.site_select,
+                        'lat_slider': self.lat_slider, 'lon_slider': self.lon_slider}
+                for widget in (self.site_select, self.lat_slider, self.lon_slider):
+                    widget.jscallback(value=MAIN_MAP_CLIENT_JS, args=args)
+            else:
+                self.site_select.param.watch(self.update_main_map_colors, 'value')
+                self.lat_slider.param.watch(self.update_main_map_range, 'value')
+                self.lon_slider.param.watch(self.update_main_map_range, 'value')
+        else:
+            self.plot_pane = pn.pane.Plotly(
+                plot_main_map(self.site_select.value, self.lat_slider.value, self.lon_slider.value),
+                link_figure=False)  # Replaced by new figures, never edited in place
+            for widget in (self.site_select, self.lat_slider, self.lon_slider):
+                widget.param.watch(self.refresh_main_map, 'value')
+
+        # Watch for click events on plot_pane and trigger handle_click
+        self.plot_pane.param.watch(self.handle_click, 'click_data')
+
+        self.update_table()
+
+        # Main dashboard layout with fixed width percentages
+        control_panel = pn.Column(
+            pn.Spacer(height=100),
+            self.site_select, self.lat_slider, self.lon_slider, self.radius_input,
+            pn.Row(self.option_buttons["Site_cite"], self.option_buttons["Site_meta"]),
+            pn.Row(self.option_buttons["Site_data"], button_show_all), width=200,
+        )
 
-# Combine into the dashboard layout
-ratio_dashboard = pn.Row(
-    treatres_panel,
-    pn.Spacer(width=30),
-    pn.Column(ratio_plot_pane, width=800),
-    pn.Column(ratio_data_table, ratio_download_button, width=310)  # Add download button next to ratio_data_table
-)
+        # Update the Panel layout to include the download links
+        return pn.Row(
+            control_panel,
+            pn.Spacer(width=30),
+            pn.Column(self.plot_pane, width=700),  # Increased map width
+            pn.Spacer(width=30),
+            pn.Column(self.site_data_table, self.site_download_links, width=200)  # Add download links next to site_data_table
+        )
 
-# Display ecosystem_type options upon changing treatment and response
-treatment_select.param.watch(lambda event: update_ecosystem_options(event.new, response_select.value), 'value')
-response_select.param.watch(lambda event: update_ecosystem_options(treatment_select.value, event.new), 'value')
+    # Define function to show the data of the button selection; site_select is applied by the table (filter or query)
+    @metrics.timed('update_table')
+    def update_table(self, event=None):
+        # Check selected_option to decide which data to show, and update the table display
+        if QUERY_BACKEND == 'sqlite':
+            table, columns = SITE_VIEWS[self.selected_option]
+            self.site_data_table.show(table, columns, self.site_select.value)
+        else:
+            filtered_df = site_view(self.selected_option)
+            if self.site_data_table.value is not filtered_df:
+                self.site_data_table.value = filtered_df
+
+        # Update the download links
+        self.site_download_links.object = export_links('site', view=self.selected_option, site=self.site_select.value)
+
+    # Define button click handler to update the selected_option and refresh table
+    @metrics.timed('select_option')
+    def select_option(self, option):
+        self.selected_option = option
+        for name, button in self.option_buttons.items():
+            button.button_type = 'danger' if name == option else 'primary'  # Change color to red when selected
+        self.update_table()
+
+    # The pane is linked to main_map: edits of the figure are sent to the browser as restyle patches
+    @metrics.timed('update_main_map_colors')
+    def update_main_map_colors(self, event=None):
+        self.main_map.data[0].marker.color = self._main_map_colors()
+
+    @metrics.timed('update_main_map_range')
+    def update_main_map_range(self, event=None):
+        with self.main_map.batch_update():
+            self._show_main_map_range(self.main_map.data[0])
+
+    def _main_map_colors(self):
+        return self.site_points['site'].isin(self.site_select.value).to_numpy(dtype=np.int8)
+
+    # Sites inside the slider ranges are shown; the others are transparent. Only the visible-index
+    # set is patched, not an array per site.
+    def _show_main_map_range(self, trace):
+        trace.selectedpoints = self.spatial_index.box(self.lat_slider.value, self.lon_slider.value)
+
+    # Rebuild mode: recreate the main map off the event loop
+    @metrics.timed('refresh_main_map')
+    async def refresh_main_map(self, event=None):
+        self._main_map_request += 1
+        request = self._main_map_request
+        fig = await run_in_executor(plot_main_map, self.site_select.value, self.lat_slider.value,
+                                    self.lon_slider.value)
+        if request == self._main_map_request:  # Drop results superseded by a newer change
+            self.plot_pane.object = fig
+
+    # Click event on main map handler function
+    @metrics.timed('handle_click')
+    def handle_click(self, event):
+        if 'points' in event.new and len(event.new['points']) > 0:
+            point = event.new['points'][0]
+            if not (self.lat_slider.value[0] <= point['lat'] <= self.lat_slider.value[1]
+                    and self.lon_slider.value[0] <= point['lon'] <= self.lon_slider.value[1]):
+                return  # Hidden site outside the slider ranges
+            clicked_sites = self.clicked_sites(point)
+            if not clicked_sites:
+                return
+            if all(site in self.site_select.value for site in clicked_sites):
+                self.site_select.value = [site for site in self.site_select.value if site not in clicked_sites]
+            else:
+                self.site_select.value = self.site_select.value + [
+                    site for site in clicked_sites if site not in self.site_select.value]
+        else:
+            print("Click event did not return expected data format:", event)
+
+    # Sites toggled by a click: the clicked site, or every visible site within the click radius.
+    # A binned marker ("N sites") stands for the sites of its grid cell, found on the grid
+    # render_main_map binned the slider ranges with.
+    def clicked_sites(self, point):
+        index = self.spatial_index
+        if self.radius_input.value:
+            positions, _ = index.within(point['lat'], point['lon'], self.radius_input.value)
+        elif point['text'] in self.site_set:
+            return [point['text']]
+        elif str(point['text']).endswith(' sites'):
+            lat_range, lon_range = self.lat_slider.value, self.lon_slider.value
+            positions = index.box(*map_lod.cell_box(point['lat'], point['lon'], lat_range, lon_range))
+            positions = positions[map_lod.cell_members(index.points.iloc[positions], point['lat'], point['lon'],
+                                                       lat_range, lon_range)]
+        else:
+            return []
+        points = index.points.iloc[positions]
+        visible = points['lat'].between(*self.lat_slider.value) & points['lon'].between(*self.lon_slider.value)
+        return list(dict.fromkeys(points.loc[visible, 'site']))
+
+    # ##Ratio map formation
+    def _build_ratio_dashboard(self):
+        # Create dropdown widgets for treatment, response, and ecosystem_type(optional)
+        self.treatment_select = pn.widgets.Select(name='Select Treatment', options=TREATMENTS, width=180)
+        self.response_select = pn.widgets.Select(name='Select Response', options=RESPONSES, width=180)
+        self.ecosystem_type_select = pn.widgets.Select(name='Select Ecosystem', options=['All'],
+                                                       width=180)  # "All" means do not select exact ecosystem_type
+
+        treatres_panel = pn.Column(
+            pn.Spacer(height=100),
+            self.treatment_select, self.response_select, self.ecosystem_type_select, width=200,
+        )
 
-# Analytics placeholder pages
+        self.update_ecosystem_options()
+
+        # Define a table widget to display the filtered ratio data
+        self.ratio_data_table = pn.widgets.Tabulator(pd.DataFrame(), height=500, width=310, show_index=False,
+                                                     pagination='remote', page_size=TABLE_PAGE_SIZE,
+                                                     header_filters=True, disabled=True)
+
+        # Download links for ratio_data_table
+        self.ratio_download_links = pn.pane.HTML('', width=310)
+
+        # Create a Plotly panel for the ratio map
+        df_grouped, fig = update_ratio_map(self.treatment_select.value, self.response_select.value,
+                                           self.ecosystem_type_select.value)
+        self.ratio_plot_pane = pn.pane.Plotly(fig, link_figure=False)  # Replaced by new figures, never edited
+        self.show_ratio(df_grouped)
+
+        # Display ecosystem_type options upon changing treatment and response
+        self.treatment_select.param.watch(self.update_ecosystem_options, 'value')
+        self.response_select.param.watch(self.update_ecosystem_options, 'value')
+        for widget in (self.treatment_select, self.response_select, self.ecosystem_type_select):
+            widget.param.watch(self.refresh_ratio_map, 'value')
+
+        # Combine into the dashboard layout
+        return pn.Row(
+            treatres_panel,
+            pn.Spacer(width=30),
+            pn.Column(self.ratio_plot_pane, width=800),
+            pn.Column(self.ratio_data_table, self.ratio_download_links, width=310)  # Add download links next to ratio_data_table
+        )
 
-analytics_dashboard = pn.Column(
-    pn.pane.Markdown("# Analytics Page (Coming Soon)", styles={'font-size': '20px', 'text-align': 'center'}),
-)
+    async def show_ratio_dashboard(self):
+        self.ratio_dashboard.objects = [await run_in_executor(self._build_ratio_dashboard)]
+
+    # Update ecosystem_type options based on selected treatment and response
+    @metrics.timed('update_ecosystem_options')
+    def update_ecosystem_options(self, event=None):
+        # Get unique ecosystem_type values for the selected treatment and response
+        available_ecosystems = ['All'] + ecosystems(self.treatment_select.value, self.response_select.value)
+        self.ecosystem_type_select.options = available_ecosystems  # Update the options
+
+    def show_ratio(self, df_grouped):
+        self.ratio_data_table.value = df_grouped  # Already limited to site, lat, lon, ecosystem_type and ratio
+        self.ratio_download_links.object = export_links('ratio', treatment=self.treatment_select.value,
+                                                        response=self.response_select.value,
+                                                        ecosystem_type=self.ecosystem_type_select.value)
+
+    # Recompute the ratio table and map off the event loop
+    @metrics.timed('refresh_ratio_map')
+    async def refresh_ratio_map(self, event=None):
+        self._ratio_request += 1
+        request = self._ratio_request
+        df_grouped, fig = await run_in_executor(update_ratio_map, self.treatment_select.value,
+                                                self.response_select.value, self.ecosystem_type_select.value)
+        if request == self._ratio_request:  # Drop results superseded by a newer selection
+            self.show_ratio(df_grouped)
+            self.ratio_plot_pane.object = fig
+
+
+    # ## Analytics: meta-analysis table of every treatment × response × ecosystem_type group
+    def _build_analytics_dashboard(self):
+        self.analytics_loaded = False
+        self.analytics_status = pn.pane.Markdown("", width=900)
+        self.meta_table = pn.widgets.Tabulator(pd.DataFrame(), height=500, width=1200, show_index=False,
+                                               pagination='remote', page_size=TABLE_PAGE_SIZE,
+                                               header_filters=True, disabled=True)
+        return pn.Column(
+            pn.pane.Markdown(
+                "## Meta-analysis of log response ratios\n"
+                "lnRR = log(x_t / x_c) per row, weighted by its sampling variance "
+                "sd_t² / (rep_t x_t²) + sd_c² / (rep_c x_c²). Fixed- and random-effects (DerSimonian-Laird) "
+                "means with 95% intervals, between-row variance tau², Cochran's Q and I² per group, and "
+                "bootstrap intervals of the random-effects mean.", width=900),
+            self.analytics_status,
+            self.meta_table,
+            pn.pane.HTML(export_links('meta'), width=310),
+        )
 
-# Model placeholder pages
+    async def open_tab(self, event):
+        if self.tabs[event.new] is self.analytics_page and not self.analytics_loaded:
+            self.analytics_loaded = True
+            await self.refresh_analytics()
+        elif self.tabs[event.new] is self.model_page and self.model_params is None:
+            await self.fit_models()
+
+    # Analytic estimates first (fast), then the same table with the bootstrap intervals
+    @metrics.timed('refresh_analytics')
+    async def refresh_analytics(self):
+        self._analytics_request += 1
+        request = self._analytics_request
+        self.analytics_status.object = "Computing the group estimates..."
+        summary = await run_in_executor(meta_summary)
+        if request != self._analytics_request:
+            return
+        self.meta_table.value = summary
+        self.analytics_status.object = f"{len(summary)} groups. Running {BOOTSTRAP_REPLICATES} bootstrap replicates..."
+        summary = await run_in_executor(meta_summary, True)
+        if request == self._analytics_request:  # Drop results superseded by a data refresh
+            self.meta_table.value = summary
+            self.analytics_status.object = f"{len(summary)} groups, {BOOTSTRAP_REPLICATES} bootstrap replicates."
+
+
+    # ## Model: per-group regressions of the log ratio on the coordinates and site covariates
+    def _build_model_dashboard(self):
+        self.model_params = None  # Parameters of the models shown, once fitted
+        self.grouping_select = pn.widgets.Select(name='One model per', options=list(model_fit.GROUPINGS),
+                                                 value='treatment', width=200)
+        self.covariate_select = pn.widgets.MultiChoice(name='Covariates', options=model_covariates(),
+                                                       value=list(model_fit.BASE_COVARIATES), width=300)
+        self.weighting_select = pn.widgets.Select(name='Weights', options=model_fit.WEIGHTINGS, width=160)
+        self.fit_button = pn.widgets.Button(name='Fit models', button_type='primary', width=120)
+        self.fit_button.on_click(self.fit_models)
+        self.model_progress = pn.indicators.Progress(value=0, max=1, width=400, visible=False)
+        self.model_status = pn.pane.Markdown("", width=900)
+        self.model_table = pn.widgets.Tabulator(pd.DataFrame(), height=400, width=1200, show_index=False,
+                                                pagination='remote', page_size=TABLE_PAGE_SIZE,
+                                                header_filters=True, disabled=True)
+        self.prediction_table = pn.widgets.Tabulator(pd.DataFrame(), height=400, width=1200, show_index=False,
+                                                     pagination='remote', page_size=TABLE_PAGE_SIZE,
+                                                     header_filters=True, disabled=True)
+        self.model_exports = pn.pane.HTML("", width=310)
+        self.prediction_exports = pn.pane.HTML("", width=310)
+        return pn.Column(
+            pn.pane.Markdown(
+                "## Regression models of log response ratios\n"
+                "One weighted least-squares model of lnRR = log(x_t / x_c) per group, on the site coordinates "
+                "and the selected Site_metadata covariates. Rows are weighted by their inverse sampling variance "
+                "or equally; rows with a missing covariate are left out.", width=900),
+            pn.Row(self.grouping_select, self.covariate_select, self.weighting_select),
+            pn.Row(self.fit_button, self.model_progress),
+            self.model_status,
+            self.model_table,
+            self.model_exports,
+            pn.pane.Markdown("### Predictions", width=900),
+            self.prediction_table,
+            self.prediction_exports,
+        )
 
-model_dashboard = pn.Column(
-    pn.pane.Markdown("# Model Page (Coming Soon)", styles={'font-size': '20px', 'text-align': 'center'}),
-)
+    # Fit the models of the selected parameters (or `params`) in the background, streaming the job's
+    # progress until it is done
+    @metrics.timed('fit_models')
+    async def fit_models(self, event=None, params=None):
+        self._model_request += 1
+        request = self._model_request
+        self.model_params = params or {'grouping': self.grouping_select.value,
+                                       'covariates': self.covariate_select.value,
+                                       'weighting': self.weighting_select.value}
+        self.model_status.object = "Preparing the model data..."
+        self.model_progress.param.update(value=-1, visible=True)
+        job = await run_in_executor(submit_models, self.model_params)
+        done = asyncio.wrap_future(job.future)
+        while not done.done():
+            await asyncio.wait([done], timeout=0.25)
+            if request != self._model_request:
+                return  # Superseded by another fit; the job still finishes and caches its results
+            if job.groups and not done.done():
+                self.model_progress.max = job.groups  # Before the value, which it bounds
+                self.model_progress.value = job.fitted
+                self.model_status.object = f"Fitted {job.fitted} of {job.groups} models..."
+        self.model_progress.visible = False
+        try:
+            models, predictions = done.result()
+        except Exception:
+            self.model_status.object = "Model fitting failed."
+            raise
+        self.model_table.value = models
+        self.prediction_table.value = predictions
+        fitted = (models['status'] == 'ok').sum()
+        self.model_status.object = f"{fitted} of {len(models)} groups fitted on {len(predictions)} rows."
+        query = {'grouping': self.model_params['grouping'], 'covariate': self.model_params['covariates'],
+                 'weighting': self.model_params['weighting']}
+        self.model_exports.object = export_links('models', **query)
+        self.prediction_exports.object = export_links('predictions', **query)
+
+
+    # ## Live refresh: poll the process-wide data version and apply what changed since this session's
+    def watch_data(self):
+        if REFRESH_INTERVAL > 0:
+            pn.state.add_periodic_callback(self.apply_data_changes, period=int(REFRESH_INTERVAL * 1000))
+
+    @metrics.timed('apply_data_changes')
+    async def apply_data_changes(self):
+        if self.data_version == data_version:
+            return
+        changed_pairs = changes_since(self.data_version)
+        self.data_version = data_version
+
+        # Site list and slider bounds; sliders showing the full range keep showing it
+        self.site_set = site_set
+        self.site_select.options = unique_sites
+        for slider, value_range in ((self.lat_slider, lat_range), (self.lon_slider, lon_range)):
+            full = slider.value == (slider.start, slider.end)
+            slider.param.update(start=value_range[0], end=value_range[1], **({'value': value_range} if full else {}))
+
+        self.update_table()
+
+        # Main map: patch the trace arrays in place with the appended sites
+        self.spatial_index = spatial_index
+        if hasattr(self, 'main_map'):
+            points = self.spatial_index.points
+            if len(points) != len(self.site_points) or changed_pairs is None:
+                self.site_points = points
+                with self.main_map.batch_update():
+                    trace = self.main_map.data[0]
+                    trace.lon, trace.lat, trace.text = points['lon'], points['lat'], points['site']
+                    trace.marker.color = self._main_map_colors()
+                    self._show_main_map_range(trace)
+        else:
+            await self.refresh_main_map()
+
+        # Ratio section (once built): only when the shown treatment/response pair changed
+        if hasattr(self, 'treatment_select'):
+            pair = (self.treatment_select.value, self.response_select.value)
+            if changed_pairs is None or pair in changed_pairs:
+                self.update_ecosystem_options()
+                await self.refresh_ratio_map()
+
+        # Analytics (once opened): every group may have changed
+        if self.analytics_loaded:
+            await self.refresh_analytics()
+
+        # Models (once fitted): refitted on the new data with the parameters shown
+        if self.model_params is not None:
+            await self.fit_models(params=self.model_params)
+
+
+# Create a fresh dashboard for every browser session
+@metrics.timed('create_app')
+def create_app():
+    if not LAZY_STARTUP:
+        dashboard = MesiDashboard()
+        dashboard.watch_data()
+        return dashboard.layout
+
+    # Lazy startup: answer with a placeholder right away and swap the dashboard in once the page is
+    # served and the data is loaded. The main map comes first; the ratio section follows.
+    layout = pn.Column(pn.pane.Markdown("# MESI DASH\nLoading data..."),
+                       pn.indicators.LoadingSpinner(value=True, size=40))
+
+    async def show_dashboard():
+        while not data_loader.ready():
+            if data_loader.error is not None:
+                layout.objects = [pn.pane.Alert("The MESI data failed to load.", alert_type='danger')]
+                return
+            await asyncio.sleep(0.25)
+        # Widgets and figures are built off the event loop, so other sessions keep being served
+        dashboard = await run_in_executor(MesiDashboard, True)
+        layout.objects = dashboard.layout.objects
+        await dashboard.show_ratio_dashboard()
+        dashboard.watch_data()
+
+    pn.state.execute(show_dashboard)
+    return layout
 
-# Tabs interface with three pages
-tabs = pn.Tabs(
-    ("Main", pn.Column(header, main_dashboard, pn.Spacer(height =30), ratio_dashboard)),
-    ("Analytics", pn.Column(header, analytics_dashboard)),
-    ("Model", pn.Column(header, model_dashboard)),
-)
 
 # Display the app
-app = pn.Column(tabs, table_panel)
-pn.serve(app, port=8000, address="0.0.0.0", allow_websocket_origin=["mesi-dash-demo.onrender.com"])
+if __name__ == '__main__':
+    if NUM_PROCS == 1:
+        data_loader.start()  # Forked workers start on their first request (and load, in lazy mode)
+    pn.serve(create_app, port=PORT, address="0.0.0.0", allow_websocket_origin=["mesi-dash-demo.onrender.com"],
+             num_procs=NUM_PROCS,
+             extra_patterns=[(r'/export/(\w+)', export.ExportHandler, {'resolve': resolve_export}),
+                             (r'/metrics', metrics.MetricsHandler),  # Prometheus metrics of this process
+                             (r'/ready', ReadyHandler, {'loader': data_loader})])
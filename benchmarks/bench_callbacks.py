@@ -0,0 +1,171 @@
+# Time the dashboard callbacks directly against synthetic MESI databases of increasing size.
+# Each scale runs in its own process (the apps load their data at import), which reports
+# cold-start time, RSS, and p50/p95 latency and payload bytes per callback. The figure cache and the
+# warm-up are turned off, so the latencies are those of building every result.
+#
+#   python -m benchmarks.bench_callbacks --rows 10000 100000 1000000 [--repeat 30] [--json out.json]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic_db import RESPONSES, TREATMENTS, generate_db
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+
+def json_bytes(obj):
+    import plotly.io as pio
+    from plotly.utils import PlotlyJSONEncoder
+    if hasattr(obj, 'to_plotly_json') and not hasattr(obj, 'to_json'):
+        obj = obj.to_plotly_json()  # Dash components
+    if hasattr(obj, 'data') and hasattr(obj, 'layout'):
+        return len(pio.to_json(obj))
+    if hasattr(obj, 'to_json'):
+        return len(obj.to_json(orient='split'))
+    return len(json.dumps(obj, cls=PlotlyJSONEncoder))
+
+
+# Run `call` once per input and collect latency and payload size
+def measure(inputs, call, payload):
+    latencies, sizes = [], []
+    for args in inputs:
+        start = time.perf_counter()
+        result = call(*args)
+        latencies.append(1000 * (time.perf_counter() - start))
+        sizes.append(payload(result))
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'payload_bytes': int(np.median(sizes)),
+    }
+
+
+# Benchmark body, run inside a process whose MESI_DB points at the synthetic database
+def run_worker(repeat, seed=0):
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    start = time.perf_counter()
+    import Dash_Demo
+    results['import Dash_Demo'] = {'p50_ms': 1000 * (time.perf_counter() - start)}
+    start = time.perf_counter()
+    Dash_Demo.data_loader.wait()
+    results['Dash_Demo data load'] = {'p50_ms': 1000 * (time.perf_counter() - start)}
+    start = time.perf_counter()
+    import Dash_Panel
+    results['import Dash_Panel'] = {'p50_ms': 1000 * (time.perf_counter() - start)}
+    start = time.perf_counter()
+    Dash_Panel.data_loader.wait()
+    results['Dash_Panel data load'] = {'p50_ms': 1000 * (time.perf_counter() - start)}
+
+    sites = Dash_Panel.unique_sites
+    lat_lo, lat_hi = Dash_Panel.lat_range
+    lon_lo, lon_hi = Dash_Panel.lon_range
+
+    def some_sites():
+        return [sites[i] for i in rng.integers(0, len(sites), rng.integers(1, 6))]
+
+    def window(lo, hi):
+        a, b = sorted(rng.uniform(lo, hi, 2))
+        return (a, b)
+
+    pairs = [(t, r) for t in TREATMENTS for r in RESPONSES]
+
+    results['Dash_Demo.update_map'] = measure(
+        [(some_sites(), None, None) for _ in range(repeat)] + [(None, None, None)],
+        Dash_Demo.update_map, json_bytes)
+    results['Dash_Demo.display_site_data'] = measure(
+        [({'points': [{'text': some_sites()[0]}]},) for _ in range(repeat)],
+        Dash_Demo.display_site_data, json_bytes)
+
+    start = time.perf_counter()
+    dashboard = Dash_Panel.MesiDashboard()
+    results['Dash_Panel session'] = {'p50_ms': 1000 * (time.perf_counter() - start)}
+
+    def update_table(option, selected_sites):
+        dashboard.selected_option = option
+        dashboard.site_select.value = selected_sites
+        dashboard.update_table()
+        return dashboard.site_data_table.current_view.iloc[:Dash_Panel.TABLE_PAGE_SIZE]
+
+    options = list(Dash_Panel.SITE_VIEWS)
+    results['Dash_Panel.update_table'] = measure(
+        [(options[i % len(options)], some_sites() if i % 2 else []) for i in range(repeat)],
+        update_table, json_bytes)
+    results['Dash_Panel.plot_main_map'] = measure(
+        [(some_sites(), window(lat_lo, lat_hi), window(lon_lo, lon_hi)) for _ in range(repeat)],
+        Dash_Panel.plot_main_map, json_bytes)
+    results['Dash_Panel.calculate_ratio'] = measure(
+        [pairs[i % len(pairs)] for i in range(repeat)],
+        Dash_Panel.calculate_ratio, json_bytes)
+    results['Dash_Panel.update_ratio_map'] = measure(
+        [pairs[i % len(pairs)] + ('All',) for i in range(repeat)],
+        Dash_Panel.update_ratio_map, lambda result: json_bytes(result[1]))
+
+    results['rss_mb'] = rss_mb()
+    return results
+
+
+def run_scale(n_rows, repeat, data_dir):
+    db_path = os.path.join(data_dir, f'MESI_{n_rows}.db')
+    if not os.path.exists(db_path):
+        generate_db(db_path, n_rows)
+    env = dict(os.environ, MESI_DB=db_path, MESI_STORE_DIR=os.path.join(data_dir, f'store_{n_rows}'),
+               MESI_FIGURE_CACHE_MB='0', MESI_FIGURE_CACHE_DISK_MB='0', MESI_WARMUP_PROCS='0',
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_callbacks', '--worker', '--repeat', str(repeat)],
+                            cwd=REPO_ROOT, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_report(n_rows, results):
+    print(f"\n== {n_rows} rows, RSS {results.pop('rss_mb'):.0f} MB")
+    print(f"{'callback':<32} {'p50 ms':>9} {'p95 ms':>9} {'payload B':>11}")
+    for name, stats in results.items():
+        p95 = f"{stats['p95_ms']:>9.2f}" if 'p95_ms' in stats else f"{'':>9}"
+        payload = f"{stats['payload_bytes']:>11}" if 'payload_bytes' in stats else f"{'':>11}"
+        print(f"{name:<32} {stats['p50_ms']:>9.2f} {p95} {payload}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the dashboard callbacks against synthetic databases")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--data-dir', help="Where synthetic databases are kept (default: a temporary directory)")
+    parser.add_argument('--json', help="Also write the raw results to this file")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.repeat)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        all_results = {}
+        for n_rows in args.rows:
+            all_results[n_rows] = run_scale(n_rows, args.repeat, data_dir)
+            print_report(n_rows, dict(all_results[n_rows]))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(all_results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
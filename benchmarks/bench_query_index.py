@@ -0,0 +1,80 @@
+# Latency of the Dash_Demo query paths versus row count: the original boolean-mask filters
+# and site scans against the inverted indexes of mesi.query_index.
+#
+#   python -m benchmarks.bench_query_index [--rows 10000 100000 1000000] [--repeat 20]
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from mesi.query_index import SiteQueryIndex
+
+
+# Site_main-like frame with about ten observations per site
+def synthetic_site_main(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    n_sites = max(n_rows // 10, 1)
+    site_ids = rng.integers(0, n_sites, n_rows)
+    site_lat = np.round(rng.uniform(-60, 70, n_sites), 3)
+    site_lon = np.round(rng.uniform(-170, 170, n_sites), 3)
+    return pd.DataFrame({
+        'site': pd.Categorical([f'site_{i}' for i in site_ids]),
+        'lat': site_lat[site_ids],
+        'lon': site_lon[site_ids],
+        'treatment': pd.Categorical(rng.choice(list('fwicd'), n_rows)),
+        'response': pd.Categorical(rng.choice(['agb', 'soil_total_c', 'soc'], n_rows)),
+    })
+
+
+def mask_filter(df, sites, lats, lons):
+    if sites:
+        df = df[df['site'].isin(sites)]
+    if lats:
+        df = df[df['lat'].isin(lats)]
+    if lons:
+        df = df[df['lon'].isin(lons)]
+    return df
+
+
+def scan_lookup(df, site):
+    site_info = df[df['site'] == site]
+    return None if site_info.empty else site_info.iloc[0]
+
+
+def median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return 1000 * float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dash_Demo query latency versus row count")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'build ms':>9} {'filter mask':>12} {'filter index':>13} {'click scan':>11} {'click index':>12}")
+    for n_rows in args.rows:
+        df = synthetic_site_main(n_rows)
+        start = time.perf_counter()
+        index = SiteQueryIndex(df)
+        build_ms = 1000 * (time.perf_counter() - start)
+
+        # A typical dropdown state: a handful of sites plus one latitude of one of them
+        sites = df['site'].cat.categories[:5].tolist()
+        lats = [df.loc[df['site'] == sites[0], 'lat'].iloc[0]]
+        assert index.filter(sites, lats, None).equals(mask_filter(df, sites, lats, None))
+
+        print(f"{n_rows:>10} {build_ms:>9.1f}"
+              f" {median_ms(lambda: mask_filter(df, sites, lats, None), args.repeat):>12.3f}"
+              f" {median_ms(lambda: index.filter(sites, lats, None), args.repeat):>13.3f}"
+              f" {median_ms(lambda: scan_lookup(df, sites[0]), args.repeat):>11.3f}"
+              f" {median_ms(lambda: index.first_row(sites[0]), args.repeat):>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+# Concurrent-session load test against a locally served dashboard.
+#
+# Dash_Demo sessions load the page and then POST update_map / display_site_data callbacks to
+# /_dash-update-component. Dash_Panel sessions open a real Bokeh websocket session (page + document
+# pull) and change widgets, timing until the server pushes the resulting model updates back.
+# Reports p50/p95 latency, response bytes and server RSS.
+#
+#   python -m benchmarks.load_test --app panel --rows 100000 --sessions 16 --iterations 10
+#   python -m benchmarks.load_test --app dash --url http://localhost:8051
+import argparse
+import html
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.bench_callbacks import REPO_ROOT
+from benchmarks.synthetic_db import RESPONSES, TREATMENTS, generate_db
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_memory_mb(pid, field='Rss'):
+    # RSS (or PSS, which splits shared pages such as the memory-mapped store between the processes
+    # mapping them) of the server and its worker processes
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/smaps_rollup') as rollup:
+                total += next(int(line.split()[1]) for line in rollup if line.startswith(f'{field}:'))
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except (OSError, StopIteration):
+            continue
+    return total / 1024
+
+
+def process_rss_mb(pid):
+    return process_memory_mb(pid, 'Rss')
+
+
+def wait_until_up(url, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+# Start the app on a free port against a synthetic database
+def serve_app(app, db_path, data_dir, workers):
+    port = free_port()
+    env = dict(os.environ, MESI_DB=db_path, MESI_STORE_DIR=os.path.join(data_dir, 'store'), PORT=str(port),
+               MESI_NUM_PROCS=str(workers), PYTHONPATH=REPO_ROOT)
+    if app == 'panel':
+        command = [sys.executable, 'Dash_Panel.py']
+    elif workers > 1:
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', 'Dash_Demo:server']
+    else:
+        command = [sys.executable, '-c', f"import Dash_Demo; Dash_Demo.server.run(port={port}, threaded=True)"]
+    # In a session of its own, so the worker processes it forks can be stopped with it
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               start_new_session=True)
+    return process, f'http://localhost:{port}/'
+
+
+# Latency (ms), size and body of a request. Anything but 200 (a failing callback, or a callback
+# that sent no update) stops the test instead of being recorded as a sample.
+def http(url, payload=None):
+    data = None if payload is None else json.dumps(payload).encode()
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as exc:
+        status, body = exc.code, exc.read()
+    if status != 200:
+        raise RuntimeError(f"{url} returned HTTP {status}: {body[:500].decode(errors='replace')}")
+    return 1000 * (time.perf_counter() - start), len(body), body
+
+
+def dash_callback(output_id, output_prop, inputs, state=()):
+    return {
+        'output': f'{output_id}.{output_prop}',
+        'outputs': {'id': output_id, 'property': output_prop},
+        'inputs': [{'id': input_id, 'property': prop, 'value': value} for input_id, prop, value in inputs],
+        'state': [{'id': state_id, 'property': prop, 'value': value} for state_id, prop, value in state],
+        'changedPropIds': [f'{input_id}.{prop}' for input_id, prop, _ in inputs[:1]],
+    }
+
+
+def dash_session(url, iterations, rng, record):
+    latency, size, _ = http(url)
+    record('page', latency, size)
+    _, _, layout = http(url + '_dash-layout')
+    layout = json.loads(layout)
+
+    # Properties of a component, found in the serialized layout
+    def find(node, component_id):
+        if isinstance(node, dict):
+            if node.get('props', {}).get('id') == component_id:
+                return node['props']
+            return next((found for child in node.values() if (found := find(child, component_id))), None)
+        if isinstance(node, list):
+            return next((found for child in node if (found := find(child, component_id))), None)
+        return None
+    sites = [option['value'] for option in (find(layout, 'site-dropdown') or {}).get('options', [])]
+    version = (find(layout, 'data-version') or {}).get('data')
+
+    for _ in range(iterations):
+        selected = rng.sample(sites, min(len(sites), rng.randint(1, 5)))
+        latency, size, _ = http(url + '_dash-update-component', dash_callback(
+            'world-map', 'figure',
+            [('site-dropdown', 'value', selected), ('lat-dropdown', 'value', None), ('lon-dropdown', 'value', None),
+             ('data-version', 'data', version)]))
+        record('update_map', latency, size)
+        latency, size, _ = http(url + '_dash-update-component', dash_callback(
+            'site-data', 'children', [('world-map', 'clickData', {'points': [{'text': selected[0]}]})],
+            [('site-dropdown', 'value', selected), ('lat-dropdown', 'value', None), ('lon-dropdown', 'value', None)]))
+        record('display_site_data', latency, size)
+
+
+def panel_session(url, iterations, rng, record):
+    import panel.models.plotly  # noqa: F401  (registers Panel's Bokeh models for deserialization)
+    import panel.models.tabulator  # noqa: F401
+    from bokeh.client import pull_session
+    from bokeh.events import DocumentReady
+    from bokeh.models import MultiChoice, Select
+    from panel.models.markup import HTML
+
+    latency, size, _ = http(url)
+    record('page', latency, size)
+    start = time.perf_counter()
+    session = pull_session(url=url)
+    record('websocket session', 1000 * (time.perf_counter() - start), 0)
+
+    # Signal the page load like a browser does; with lazy startup the dashboard is only sent after it
+    start = time.perf_counter()
+    session.document.callbacks.send_event(DocumentReady())
+    session._connection._loop_until(
+        lambda: sum(isinstance(model, Select) for model in session.document.models) >= 3)
+    record('dashboard ready', 1000 * (time.perf_counter() - start), 0)
+    models = list(session.document.models)
+    selects = {model.title: model for model in models if isinstance(model, Select)}
+    site_select = next(model for model in models if isinstance(model, MultiChoice))
+    sites = list(site_select.options)
+    links = [model for model in models if isinstance(model, HTML)]
+
+    events = []
+    session.document.on_change(events.append)
+
+    # Change a widget and wait until the server pushes the matching state back. The download links
+    # are rewritten together with the map and table, and carry the state they were built for, so
+    # late updates from an earlier interaction are not mistaken for this one.
+    def interact(name, widget, value, expected):
+        events.clear()
+        start = time.perf_counter()
+        widget.value = value
+        # bokeh.client has no public "wait for server push"; drive its connection loop directly
+        session._connection._loop_until(
+            lambda: any(getattr(event, 'model', None) in links and expected in html.unescape(event.model.text)
+                        for event in events))
+        record(name, 1000 * (time.perf_counter() - start), 0)
+
+    def other_value(widget, values):
+        return rng.choice([value for value in values if value != widget.value])
+
+    treatment = selects['Select Treatment']
+    response = selects['Select Response']
+    for _ in range(iterations):
+        value = other_value(treatment, TREATMENTS)
+        interact('ratio treatment change', treatment, value, urlencode({'treatment': value, 'response': response.value}))
+        value = other_value(response, RESPONSES)
+        interact('ratio response change', response, value, urlencode({'treatment': treatment.value, 'response': value}))
+        if sites:
+            value = rng.sample(sites, min(len(sites), rng.randint(1, 5)))
+            interact('site selection', site_select, value, urlencode({'site': value}, doseq=True))
+    session.close()
+
+
+def run_load(app, url, sessions, iterations, seed=0):
+    samples = {}
+    lock = threading.Lock()
+
+    def record(name, latency_ms, size):
+        with lock:
+            samples.setdefault(name, []).append((latency_ms, size))
+
+    session_fn = panel_session if app == 'panel' else dash_session
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        futures = [pool.submit(session_fn, url, iterations, random.Random(seed + i), record) for i in range(sessions)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    report = {'sessions': sessions, 'elapsed_s': elapsed}
+    for name, values in samples.items():
+        latencies = np.array([latency for latency, _ in values])
+        report[name] = {
+            'count': len(values),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'bytes': int(np.median([size for _, size in values])),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the dashboards")
+    parser.add_argument('--app', choices=['dash', 'panel'], default='panel')
+    parser.add_argument('--url', help="Test an already running server instead of starting one")
+    parser.add_argument('--rows', type=int, default=100_000, help="Synthetic database size when starting a server")
+    parser.add_argument('--workers', type=int, default=1, help="Server processes when starting a server")
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--json', help="Also write the raw report to this file")
+    args = parser.parse_args()
+
+    process = None
+    with tempfile.TemporaryDirectory() as data_dir:
+        url = args.url
+        if url is None:
+            db_path = generate_db(os.path.join(data_dir, 'MESI.db'), args.rows)
+            process, url = serve_app(args.app, db_path, data_dir, args.workers)
+        url = url.rstrip('/') + '/'
+        try:
+            wait_until_up(url + 'ready')
+            memory_before = {field: process_memory_mb(process.pid, field) for field in ('Rss', 'Pss')} if process else None
+            report = run_load(args.app, url, args.sessions, args.iterations)
+            if process:
+                report['server_rss_mb'] = {'idle': memory_before['Rss'], 'after_load': process_rss_mb(process.pid)}
+                report['server_pss_mb'] = {'idle': memory_before['Pss'], 'after_load': process_memory_mb(process.pid, 'Pss')}
+        finally:
+            if process:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+
+    print(f"{args.app}: {report['sessions']} sessions in {report['elapsed_s']:.1f}s")
+    if 'server_rss_mb' in report:
+        print(f"server RSS: {report['server_rss_mb']['idle']:.0f} MB idle, "
+              f"{report['server_rss_mb']['after_load']:.0f} MB after load")
+        print(f"server PSS: {report['server_pss_mb']['idle']:.0f} MB idle, "
+              f"{report['server_pss_mb']['after_load']:.0f} MB after load")
+    print(f"{'request':<26} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'bytes':>9}")
+    for name, stats in report.items():
+        if isinstance(stats, dict) and 'p50_ms' in stats:
+            print(f"{name:<26} {stats['count']:>6} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['bytes']:>9}")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Synthetic MESI databases of configurable size, with the Site_main and Site_metadata schemas
+# the dashboards read. Values follow the shape of the real export: ~10 observations per site,
+# x_c/x_t stored as text with occasional "NA", a few hundred studies with long citations.
+#
+#   python -m benchmarks.synthetic_db MESI_100k.db --rows 100000
+import argparse
+import os
+import sqlite3
+
+import numpy as np
+
+TREATMENTS = ['f', 'w', 'i', 'c', 'd']
+RESPONSES = ['agb', 'soil_total_c', 'soc']
+ECOSYSTEM_TYPES = ['forest', 'grassland', 'cropland', 'shrubland', 'wetland', 'tundra']
+
+SITE_MAIN_COLUMNS = ['site', 'lat', 'lon', 'treatment', 'response', 'x_c', 'x_t', 'x_units',
+                     'sd_c', 'sd_t', 'rep_c', 'rep_t', 'ecosystem_type', 'citation', 'study']
+SITE_METADATA_COLUMNS = ['site', 'lat', 'lon', 'ecosystem_type', 'mat', 'map', 'elevation', 'soil_ph']
+
+
+def _text(values, missing):
+    text = np.char.mod('%.4g', values).astype(object)
+    text[missing] = 'NA'
+    return text
+
+
+def generate_db(path, n_rows, seed=0, batch_rows=100_000):
+    rng = np.random.default_rng(seed)
+    n_sites = max(n_rows // 10, 1)
+    n_studies = max(n_rows // 40, 1)
+
+    site_names = np.array([f'site_{i}' for i in range(n_sites)], dtype=object)
+    site_lat = np.round(rng.uniform(-60, 75, n_sites), 4)
+    site_lon = np.round(rng.uniform(-170, 175, n_sites), 4)
+    site_ecosystem = rng.choice(ECOSYSTEM_TYPES, n_sites)
+    citations = np.array([f'Author{i} et al. ({1990 + i % 34}) Effects of global change drivers on '
+                          f'ecosystem carbon and biomass, study {i}. Journal of Ecology {i % 97}: {i % 400}-{i % 400 + 12}.'
+                          for i in range(n_studies)], dtype=object)
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE Site_main ({', '.join(SITE_MAIN_COLUMNS)})")
+    conn.execute(f"CREATE TABLE Site_metadata ({', '.join(SITE_METADATA_COLUMNS)})")
+
+    for start in range(0, n_rows, batch_rows):
+        n = min(batch_rows, n_rows - start)
+        site_ids = rng.integers(0, n_sites, n)
+        study_ids = rng.integers(0, n_studies, n)
+        x_c = rng.lognormal(2, 1, n)
+        x_t = x_c * rng.lognormal(0.05, 0.3, n)
+        ecosystem = site_ecosystem[site_ids].astype(object)
+        ecosystem[rng.random(n) < 0.02] = None
+        rows = zip(
+            site_names[site_ids], site_lat[site_ids], site_lon[site_ids],
+            rng.choice(TREATMENTS, n), rng.choice(RESPONSES, n),
+            _text(x_c, rng.random(n) < 0.01), _text(x_t, rng.random(n) < 0.01), ['g m-2'] * n,
+            _text(x_c * rng.uniform(0.05, 0.4, n), rng.random(n) < 0.1),
+            _text(x_t * rng.uniform(0.05, 0.4, n), rng.random(n) < 0.1),
+            rng.integers(2, 10, n).astype(str), rng.integers(2, 10, n).astype(str),
+            ecosystem, citations[study_ids], [f'study_{i}' for i in study_ids],
+        )
+        conn.executemany(f"INSERT INTO Site_main VALUES ({', '.join('?' * len(SITE_MAIN_COLUMNS))})",
+                         (tuple(v.item() if isinstance(v, np.generic) else v for v in row) for row in rows))
+
+    conn.executemany(
+        f"INSERT INTO Site_metadata VALUES ({', '.join('?' * len(SITE_METADATA_COLUMNS))})",
+        zip(site_names, site_lat.tolist(), site_lon.tolist(), site_ecosystem.tolist(),
+            rng.uniform(-10, 28, n_sites).round(1).tolist(), rng.uniform(50, 3500, n_sites).round(0).tolist(),
+            rng.uniform(0, 4000, n_sites).round(0).tolist(), rng.uniform(3.5, 8.5, n_sites).round(2).tolist()))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic MESI.db")
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_db(args.path, args.rows, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+# Shared data and computation helpers for the MESI dashboards
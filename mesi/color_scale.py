@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+import numpy as np
+
+from mesi import metrics
+
+# Colour scale of the ratio map. All quantiles the scale needs are taken in one pass, and the
+# resulting summary is small enough to be cached with the ratio lookup it describes.
+
+# Quantiles used by the scale: the full range decides the sign case, 5%/92% bound the colours
+QUANTILES = (0.0, 0.05, 0.92, 1.0)
+
+RatioSummary = namedtuple('RatioSummary', ['count', 'min', 'lower', 'upper', 'max'])
+
+
+# Quantile summary of a ratio column (NaN quantiles for an empty column)
+@metrics.stage('ratio_summary')
+def summarize(ratios):
+    values = np.asarray(ratios, dtype=float)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return RatioSummary(0, np.nan, np.nan, np.nan, np.nan)
+    return RatioSummary(len(values), *np.quantile(values, QUANTILES))
+
+
+# Colorscale and (cmin, cmax) for a summary: red below zero, blue above, white at zero
+def ratio_color_scale(summary):
+    lower_bound, upper_bound = summary.lower, summary.upper
+
+    # Case where all values are the same or only one data point
+    if summary.min == summary.max:
+        lower_bound = summary.min - 1e-18
+        upper_bound = summary.max + 1e-18
+
+    # Case when all values are zero (or there are none)
+    if summary.count == 0 or (summary.min == 0 and summary.max == 0):
+        colorscale = [[0, "black"]]
+        lower_bound = -0.1
+        upper_bound = 0.1
+
+    # If data contains both negative and positive values
+    elif lower_bound < 0 < upper_bound:
+        zero_position = abs(lower_bound) / (abs(lower_bound) + upper_bound)
+        colorscale = [[0, "red"], [zero_position, "white"], [1, "blue"]]
+
+    # (Nearly) all values are positive; a few negative outliers below the 5% quantile are clipped
+    elif lower_bound >= 0:
+        lower_bound = 0
+        colorscale = [[0, "white"], [1, "blue"]]
+
+    # (Nearly) all values are negative
+    else:
+        upper_bound = 0
+        colorscale = [[0, "red"], [1, "white"]]
+
+    # Ensure color scale includes zero in all cases
+    return colorscale, min(lower_bound, 0), max(upper_bound, 0)
@@ -0,0 +1,70 @@
+import os
+
+# Location of the MESI SQLite database (relative to the working directory by default)
+DB_PATH = os.environ.get('MESI_DB', 'MESI.db')
+
+# Directory holding the memory-mapped columnar copy of the database tables
+STORE_DIR = os.environ.get('MESI_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'mesi_store'))
+
+# Store lat/lon as float32 in the columnar store (half the memory, ~1e-5 degree precision)
+FLOAT32_COORDS = os.environ.get('MESI_FLOAT32_COORDS', '0') == '1'
+
+# Number of (treatment, response, ecosystem_type) lookups kept by the ratio engine
+RATIO_CACHE_SIZE = int(os.environ.get('MESI_RATIO_CACHE_SIZE', '128'))
+
+# Maximum number of markers sent per map; above it sites are binned on a lat/lon grid
+MAP_POINT_BUDGET = int(os.environ.get('MESI_MAP_POINT_BUDGET', '5000'))
+
+# "incremental" patches the main map in place; "rebuild" recreates the figure on every change;
+# "client" sends the site coordinates once and filters/highlights them in the browser
+MAP_UPDATE_MODE = os.environ.get('MESI_MAP_UPDATE_MODE', 'incremental')
+
+# Rows serialized per chunk by the streaming exports
+EXPORT_CHUNK_ROWS = int(os.environ.get('MESI_EXPORT_CHUNK_ROWS', '50000'))
+
+# Rows per page of the remotely paginated tables
+TABLE_PAGE_SIZE = int(os.environ.get('MESI_TABLE_PAGE_SIZE', '25'))
+
+# Panel serving: port, worker processes, per-process event threads, and executor threads for pandas work
+PORT = int(os.environ.get('PORT', '8000'))
+NUM_PROCS = int(os.environ.get('MESI_NUM_PROCS', '1'))
+NUM_THREADS = int(os.environ['MESI_NUM_THREADS']) if os.environ.get('MESI_NUM_THREADS') else None
+COMPUTE_THREADS = int(os.environ.get('MESI_COMPUTE_THREADS', str(os.cpu_count() or 4)))
+
+# Bind the port first and load the data in the background ("0" loads everything at import)
+LAZY_STARTUP = os.environ.get('MESI_LAZY_STARTUP', '1') == '1'
+
+# Seconds between checks of MESI.db for new rows while the apps run (0 disables live refresh)
+REFRESH_INTERVAL = float(os.environ.get('MESI_REFRESH_INTERVAL', '5'))
+
+# Opt-in profiling: callbacks slower than this many milliseconds dump cProfile stats to PROFILE_DIR
+PROFILE_SLOW_MS = float(os.environ['MESI_PROFILE_SLOW_MS']) if os.environ.get('MESI_PROFILE_SLOW_MS') else None
+PROFILE_DIR = os.environ.get('MESI_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'mesi_profiles'))
+
+# "store" answers queries from the memory-mapped columnar store and in-memory indexes; "sqlite" pushes
+# the filters and the ratio aggregation down to MESI.db, so no table is kept resident in the workers
+QUERY_BACKEND = os.environ.get('MESI_QUERY_BACKEND', 'store')
+
+# Read-only SQLite connections per process (sqlite backend) and the memory-mapped I/O size of each
+SQLITE_POOL_SIZE = int(os.environ.get('MESI_SQLITE_POOL_SIZE', str(COMPUTE_THREADS)))
+SQLITE_MMAP_SIZE = int(os.environ.get('MESI_SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+# Rendered-figure cache shared by the sessions: serialized figures kept in memory per process, and in a
+# directory shared by the worker processes and kept across restarts (0 MB disables a tier)
+FIGURE_CACHE_MB = float(os.environ.get('MESI_FIGURE_CACHE_MB', '64'))
+FIGURE_CACHE_DISK_MB = float(os.environ.get('MESI_FIGURE_CACHE_DISK_MB', '512'))
+FIGURE_CACHE_DIR = os.environ.get('MESI_FIGURE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'mesi_figures'))
+
+# Analytics tab: processes running the bootstrap of the meta-analysis, and its number of replicates
+ANALYTICS_PROCS = int(os.environ.get('MESI_ANALYTICS_PROCS', '2'))
+BOOTSTRAP_REPLICATES = int(os.environ.get('MESI_BOOTSTRAP_REPLICATES', '1000'))
+
+# Warm-up of every treatment × response × ecosystem ratio view after startup and data changes: processes
+# rendering the ratio maps (0 disables the warm-up, 1 renders them in the warm-up thread)
+WARMUP_PROCS = int(os.environ.get('MESI_WARMUP_PROCS', '2'))
+
+# Model tab: processes fitting the per-group regression models (1 fits them in the job thread)
+MODEL_PROCS = int(os.environ.get('MESI_MODEL_PROCS', '2'))
+
+# Seconds an idle process pool (analytics, warm-up, models) keeps its workers before shutting down
+POOL_IDLE_TIMEOUT = float(os.environ.get('MESI_POOL_IDLE_TIMEOUT', '60'))
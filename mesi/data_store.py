@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from mesi import metrics
+from mesi.config import DB_PATH, FLOAT32_COORDS, STORE_DIR
+
+# Tables mirrored from MESI.db into the columnar store
+TABLES = ['Site_main', 'Site_metadata']
+
+# Repeated string columns that are dictionary-encoded in the store. Rows hold integer codes into
+# the column's dictionary, so e.g. each distinct citation text is kept once, in a side table.
+CATEGORICAL_COLUMNS = ['site', 'treatment', 'response', 'ecosystem_type', 'x_units', 'citation', 'study']
+
+# Measurement columns exported as text with "NA" for missing values. They are stored as float64,
+# missing values as nulls (a validity bitmap in Arrow, NaN in pandas), when all other values parse.
+NUMERIC_COLUMNS = ['x_c', 'x_t', 'sd_c', 'sd_t', 'rep_c', 'rep_t']
+MISSING_VALUES = ['NA', '']
+
+# Layout of the store files; stores written with another layout are converted again
+STORE_LAYOUT = {'version': 3, 'float32_coords': FLOAT32_COORDS}
+LAYOUT_KEY = b'mesi.layout'
+
+# Position of a table in the database: its highest rowid and its row count. Rows are only ever
+# appended, so everything above max_rowid is new; a count that does not add up means rows were
+# deleted and the table is reloaded in full.
+Watermark = namedtuple('Watermark', ['max_rowid', 'rows'])
+
+# A loaded table: store file mtime, the memory-mapped Arrow table, DataFrame (None until it is needed
+# again after an append), watermark, identity of the database file the rows were read from (see
+# db_identity), and the Arrow tables of the rows appended since the store file was written
+Snapshot = namedtuple('Snapshot', ['mtime', 'arrow', 'frame', 'watermark', 'identity', 'appended'])
+
+# Process-wide cache of loaded tables: table -> Snapshot
+_frames = {}
+_lock = threading.RLock()
+
+WATERMARK_KEY = b'mesi.watermark'
+IDENTITY_KEY = b'mesi.db_identity'
+
+
+def store_path(table, store_dir=STORE_DIR):
+    return os.path.join(store_dir, f'{table}.arrow')
+
+
+def read_watermark(conn, table):
+    return Watermark(*conn.execute(f"SELECT coalesce(max(rowid), 0), count(*) FROM {table}").fetchone())
+
+
+# Identity of the database file: inode, size and mtime, plus the mtime of its write-ahead log (commits
+# in WAL mode leave the main file alone). Watermarks only see appended and deleted rows; a file
+# replaced or edited in place keeping its watermarks is told apart by its identity.
+def db_identity(db_path=DB_PATH):
+    stat = os.stat(db_path)
+    try:
+        wal_mtime = os.stat(db_path + '-wal').st_mtime_ns
+    except OSError:
+        wal_mtime = None
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns, wal_mtime]
+
+
+# Text values as floats (missing markers become NaN), or None if some other value is not numeric
+def to_float(values):
+    missing = values.isna() | values.isin(MISSING_VALUES)
+    numbers = pd.to_numeric(values.where(~missing), errors='coerce')
+    if numbers[~missing].isna().any():
+        return None
+    return numbers.astype('float64')
+
+
+# Load-time schema normalizer: dictionary-encode repeated strings, parse the measurement columns,
+# and optionally downcast lat/lon to float32. Rows appended to a stored frame pass the frame's
+# dtypes as `like`, so they get the same layout (unparseable values in float columns become NaN).
+def normalize(df, like=None):
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    for col in NUMERIC_COLUMNS:
+        if col not in df.columns:
+            continue
+        if like is None:
+            numbers = to_float(df[col])
+            if numbers is not None:
+                df[col] = numbers
+        elif pd.api.types.is_float_dtype(like[col]):
+            df[col] = pd.to_numeric(df[col].where(~df[col].isin(MISSING_VALUES)), errors='coerce')
+    if FLOAT32_COORDS:
+        for col in ('lat', 'lon'):
+            if col in df.columns:
+                df[col] = df[col].astype('float32')
+    return df
+
+
+# Arrow table of a normalized frame. Under their nulls, the buffers keep what pandas stores there:
+# NaN in float columns and code -1 in categorical columns, so the loader can use them in place.
+def to_arrow(df):
+    arrays = []
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy()
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0),
+                                                         pa.array(values.cat.categories, pa.large_string())))
+        elif pd.api.types.is_float_dtype(values.dtype):
+            numbers = values.to_numpy()
+            arrays.append(pa.array(numbers, mask=np.isnan(numbers)))
+        else:
+            arrays.append(pa.array(values))
+    return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+
+# Read one table from SQLite and write it as an uncompressed Arrow IPC file.
+# Uncompressed files can be memory-mapped, so every worker shares the same pages.
+@metrics.stage('sqlite_load')
+def convert_table(table, db_path=DB_PATH, store_dir=STORE_DIR):
+    identity = db_identity(db_path)  # Before reading, so a commit made meanwhile shows as a change
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("BEGIN")  # One read snapshot for the rows and their watermark
+        df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
+        watermark = read_watermark(conn, table)
+    finally:
+        conn.close()
+
+    arrow = to_arrow(normalize(df))
+    arrow = arrow.replace_schema_metadata({WATERMARK_KEY: json.dumps(watermark).encode(),
+                                           IDENTITY_KEY: json.dumps(identity).encode(),
+                                           LAYOUT_KEY: json.dumps(STORE_LAYOUT).encode()})
+
+    # Write to a temporary file first so concurrent workers never read a partial file
+    os.makedirs(store_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        # One record batch, so every column is a single array the loader can view in place
+        feather.write_feather(arrow, tmp_path, compression='uncompressed', chunksize=max(arrow.num_rows, 1))
+        os.replace(tmp_path, store_path(table, store_dir))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# Watermark recorded in a store file, or None for files written before watermarks existed
+def store_watermark(arrow):
+    value = (arrow.schema.metadata or {}).get(WATERMARK_KEY)
+    return Watermark(*json.loads(value)) if value else None
+
+
+def store_layout(arrow):
+    value = (arrow.schema.metadata or {}).get(LAYOUT_KEY)
+    return json.loads(value) if value else None
+
+
+# Identity of the database file a store file was converted from
+def store_identity(arrow):
+    value = (arrow.schema.metadata or {}).get(IDENTITY_KEY)
+    return json.loads(value) if value else None
+
+
+# Convert every table whose store file is missing, has another layout, or was converted from
+# another state of the database file (replaced, edited or appended to since)
+def ensure_store(db_path=DB_PATH, store_dir=STORE_DIR, tables=TABLES):
+    identity = db_identity(db_path)
+    for table in tables:
+        path = store_path(table, store_dir)
+        if os.path.exists(path):
+            arrow = feather.read_table(path, memory_map=True)
+            if (store_watermark(arrow) is not None and store_layout(arrow) == STORE_LAYOUT
+                    and store_identity(arrow) == identity):
+                continue
+        convert_table(table, db_path, store_dir)
+
+
+# Memory-mapped Arrow table, shared read-only between processes through the page cache,
+# plus the rows this process appended since the store file was written
+def read_table(table, store_dir=STORE_DIR):
+    arrow = feather.read_table(store_path(table, store_dir), memory_map=True)
+    with _lock:
+        snapshot = _frames.get(table)
+        if snapshot is not None and snapshot.appended and snapshot.mtime == os.path.getmtime(store_path(table, store_dir)):
+            return pa.concat_tables([arrow] + snapshot.appended)
+    return arrow
+
+
+# Rows added to a table since `watermark` and the new watermark, or None if the table changed in
+# any other way than appending
+def read_new_rows(table, watermark, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("BEGIN")
+        current = read_watermark(conn, table)
+        if current == watermark:
+            return pd.DataFrame(), current
+        rows = pd.read_sql_query(f"SELECT * FROM {table} WHERE rowid > ? ORDER BY rowid", conn,
+                                 params=(watermark.max_rowid,))
+    finally:
+        conn.close()
+    if current.rows != watermark.rows + len(rows):
+        return None
+    return rows, current
+
+
+# Values of a single-chunk array as a NumPy view of its data buffer (nulls included, see to_arrow)
+def _buffer_view(array):
+    dtype = np.dtype(array.type.to_pandas_dtype())
+    return np.frombuffer(array.buffers()[1], dtype=dtype, count=len(array), offset=array.offset * dtype.itemsize)
+
+
+# DataFrame of an Arrow table. Float columns and the codes of categorical columns of a store file
+# are views of the memory map, shared by every process; appended chunks and other columns are
+# converted (copied) by Arrow.
+def to_frame(arrow):
+    columns = {}
+    for name, column in zip(arrow.column_names, arrow.columns):
+        if column.num_chunks == 1 and pa.types.is_dictionary(column.type):
+            chunk = column.chunks[0]
+            dtype = pd.CategoricalDtype(chunk.dictionary.to_pandas())
+            columns[name] = pd.Categorical.from_codes(_buffer_view(chunk.indices), dtype=dtype, validate=False)
+        elif column.num_chunks == 1 and pa.types.is_floating(column.type):
+            columns[name] = _buffer_view(column.chunks[0])
+        else:
+            columns[name] = column.to_pandas()
+    return pd.DataFrame(columns, copy=False)
+
+
+def _load(table, db_path, store_dir):
+    path = store_path(table, store_dir)
+    mtime = os.path.getmtime(path)
+    arrow = feather.read_table(path, memory_map=True)
+    _frames[table] = Snapshot(mtime, arrow, to_frame(arrow), store_watermark(arrow), store_identity(arrow), [])
+
+
+# Bring a loaded table up to date: append the rows added to the database, or reload it when the
+# store file was rewritten or the table changed in any other way.
+# Returns the appended rows (possibly empty), or None after a full reload.
+def _catch_up(table, db_path, store_dir):
+    snapshot = _frames[table]
+    if os.path.getmtime(store_path(table, store_dir)) != snapshot.mtime:
+        _load(table, db_path, store_dir)  # Rewritten by another process
+        return None
+    new_rows = read_new_rows(table, snapshot.watermark, db_path)
+    if new_rows is None:
+        convert_table(table, db_path, store_dir)
+        _load(table, db_path, store_dir)
+        return None
+    rows, watermark = new_rows
+    if len(rows):
+        # The rows are kept as another Arrow chunk; the frame is rebuilt when it is next asked for
+        rows = normalize(rows, like=snapshot.arrow.schema.empty_table().to_pandas().dtypes)
+        _frames[table] = snapshot._replace(
+            frame=None, watermark=watermark,
+            appended=snapshot.appended + [pa.Table.from_pandas(rows, schema=snapshot.arrow.schema, preserve_index=False)])
+    return rows
+
+
+# Pandas view of a table, loaded once per process (and caught up with the database on first load).
+# After appends the frame is rebuilt once, on the first call, from the store file and the new chunks.
+def get_frame(table, db_path=DB_PATH, store_dir=STORE_DIR):
+    with _lock:
+        if table not in _frames:
+            ensure_store(db_path, store_dir, [table])
+            _load(table, db_path, store_dir)
+            _catch_up(table, db_path, store_dir)
+        snapshot = _frames[table]
+        if snapshot.frame is None:
+            snapshot = _frames[table] = snapshot._replace(
+                frame=to_frame(pa.concat_tables([snapshot.arrow] + snapshot.appended)))
+        return snapshot.frame
+
+
+# Watermark of the rows of a table this process has loaded
+def watermark(table):
+    with _lock:
+        return _frames[table].watermark
+
+
+# Identity of the database file state a loaded table was last converted or caught up from
+def identity(table):
+    with _lock:
+        return _frames[table].identity
+
+
+# Catch up every loaded table with the database.
+# Returns {table: appended rows, or None if the table was reloaded} for the tables that changed.
+def refresh_frames(db_path=DB_PATH, store_dir=STORE_DIR):
+    changes = {}
+    with _lock:
+        identity = db_identity(db_path)  # Before the catch-up: a commit made meanwhile shows next time
+        for table in list(_frames):
+            rows = _catch_up(table, db_path, store_dir)
+            if rows is None or len(rows):
+                changes[table] = rows
+        # A file replaced (new inode), or changed without rows appended to any table, has rows updated
+        # in place that the watermarks cannot show: the tables read from the old file are converted again
+        edited = not changes
+        for table, snapshot in list(_frames.items()):
+            if snapshot.identity == identity:
+                continue
+            if edited or snapshot.identity is None or snapshot.identity[0] != identity[0]:
+                convert_table(table, db_path, store_dir)
+                _load(table, db_path, store_dir)
+                changes[table] = None
+            else:
+                _frames[table] = snapshot._replace(identity=identity)
+    return changes
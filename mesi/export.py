@@ -0,0 +1,132 @@
+import asyncio
+import zlib
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import tornado.web
+
+from mesi.config import EXPORT_CHUNK_ROWS
+
+# Export formats: format -> (content type, file extension)
+FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'csv.gz': ('application/gzip', '.csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', '.arrow'),
+}
+
+
+# File-like sink that collects what the Arrow writers produce until it is drained
+class _ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# Keep only the requested columns and sites of an Arrow table (no copy when nothing is filtered)
+def select_rows(table, columns=None, sites=None):
+    if columns:
+        table = table.select(columns)
+    if sites:
+        table = table.filter(pc.is_in(table['site'], value_set=pa.array(sites)))
+    return table
+
+
+# CSV has no dictionary type, so categorical columns are written as their values
+def _decode_dictionaries(batch):
+    arrays = [col.dictionary_decode() if pa.types.is_dictionary(col.type) else col for col in batch.columns]
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def _decoded_schema(schema):
+    return pa.schema([
+        pa.field(field.name, field.type.value_type if pa.types.is_dictionary(field.type) else field.type)
+        for field in schema
+    ])
+
+
+def _open_writer(fmt, sink, schema):
+    if fmt in ('csv', 'csv.gz'):
+        return pacsv.CSVWriter(sink, _decoded_schema(schema))
+    if fmt == 'parquet':
+        return pq.ParquetWriter(sink, schema)
+    return pa.ipc.new_stream(sink, schema)
+
+
+# Serialize an Arrow table (or the batches of a RecordBatchReader, read as they are written) chunk
+# by chunk, so memory stays bounded by the chunk size
+def iter_export(table, fmt='csv', chunk_rows=EXPORT_CHUNK_ROWS):
+    sink = _ChunkSink()
+    writer = _open_writer(fmt, pa.PythonFile(sink, mode='w'), table.schema)
+    compressor = zlib.compressobj(wbits=31) if fmt == 'csv.gz' else None  # wbits=31 writes a gzip stream
+
+    def emit(data):
+        return compressor.compress(data) if compressor else data
+
+    batches = table.to_batches(max_chunksize=chunk_rows) if isinstance(table, pa.Table) else table
+    for batch in batches:
+        writer.write_batch(_decode_dictionaries(batch) if fmt in ('csv', 'csv.gz') else batch)
+        chunk = emit(sink.drain())
+        if chunk:
+            yield chunk
+
+    writer.close()
+    chunk = emit(sink.drain()) + (compressor.flush() if compressor else b'')
+    if chunk:
+        yield chunk
+
+
+# Tornado handler streaming /export/<name>?format=... downloads.
+# `resolve(name, args)` returns the Arrow table (or RecordBatchReader) to export and its base file name,
+# and raises KeyError for unknown exports.
+class ExportHandler(tornado.web.RequestHandler):
+    def initialize(self, resolve):
+        self.resolve = resolve
+
+    async def get(self, name):
+        fmt = self.get_argument('format', 'csv')
+        if fmt not in FORMATS:
+            raise tornado.web.HTTPError(400, f"Unknown export format: {fmt}")
+
+        args = {key: self.get_arguments(key) for key in self.request.arguments}
+        loop = asyncio.get_running_loop()
+        try:
+            table, filename = await loop.run_in_executor(None, self.resolve, name, args)
+        except KeyError:
+            raise tornado.web.HTTPError(404)
+
+        content_type, extension = FORMATS[fmt]
+        self.set_header('Content-Type', content_type)
+        self.set_header('Content-Disposition', f'attachment; filename="{filename}{extension}"')
+
+        # Chunks are produced off the event loop and flushed one at a time
+        chunks = iter_export(table, fmt)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            self.write(chunk)
+            await self.flush()
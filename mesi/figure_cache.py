@@ -0,0 +1,208 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import plotly
+import plotly.graph_objs as go
+import pyarrow as pa
+
+from mesi import metrics
+from mesi.config import (FIGURE_CACHE_DIR, FIGURE_CACHE_DISK_MB, FIGURE_CACHE_MB, FLOAT32_COORDS,
+                         MAP_POINT_BUDGET)
+
+# Rendered figures shared by every session. A figure is stored as its Plotly JSON under a hash of
+# everything it is built from: the figure kind, its inputs (selected sites, slider ranges, treatment,
+# response, ecosystem) and the state of the data. Popular views are then answered without filtering
+# frames or building Plotly objects. The in-memory tier is per process; the directory tier is shared
+# by the worker processes and survives restarts. Tables (Arrow IPC) and small JSON values that go
+# with the figures can be cached the same way.
+
+
+# Hash of the code the cached values are built by: the mesi package and the app scripts next to it
+def source_hash():
+    package = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(package, '*.py')) + glob.glob(os.path.join(package, '..', '*.py'))):
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+# Settings that change how figures are drawn; part of every key, so a restart with other settings,
+# another Plotly version or changed code does not serve figures from the disk tier drawn the old way
+FIGURE_SETTINGS = {'format': 1, 'plotly': plotly.__version__, 'source': source_hash(),
+                   'point_budget': MAP_POINT_BUDGET, 'float32_coords': FLOAT32_COORDS}
+
+
+# State of the data the figures are drawn from: the Site_main watermark and the identity of the
+# database file state it was read at (data_store.db_identity). The watermark only follows appends;
+# the identity also moves when rows are updated or deleted in place, which reloads the tables.
+def data_key(watermark, identity):
+    return [identity, *(int(value) for value in watermark)]
+
+
+# JSON form of the key parts: numpy scalars as Python numbers, sets sorted
+def _canonical(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Cannot use {type(value).__name__} in a figure cache key")
+
+
+# Canonical hash of a figure's inputs. Multi-valued filters whose order does not matter are passed
+# as sets, so the same selection in another order hits the same entry.
+def figure_key(kind, data, **params):
+    text = json.dumps([FIGURE_SETTINGS, kind, data, params], sort_keys=True, default=_canonical)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class FigureCache:
+    """Size-bounded LRU of serialized figures, in memory and optionally in a shared directory."""
+
+    def __init__(self, max_bytes=FIGURE_CACHE_MB * 2**20, directory=FIGURE_CACHE_DIR,
+                 max_disk_bytes=FIGURE_CACHE_DISK_MB * 2**20):
+        self.max_bytes = max_bytes
+        self.directory = directory if directory and max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = None  # Estimated size of the directory, measured on the first write
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _remember(self, key, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = payload
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    # Serialized figure of a key, or None. Disk hits are kept in memory and their file is touched,
+    # so the directory is evicted in least-recently-used order as well.
+    def get(self, key):
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                return payload, 'memory'
+        if self.directory is None:
+            return None, 'miss'
+        try:
+            with open(self._path(key), 'rb') as file:
+                payload = file.read()
+            os.utime(self._path(key))
+        except OSError:
+            return None, 'miss'
+        self._remember(key, payload)
+        return payload, 'disk'
+
+    def put(self, key, payload):
+        self._remember(key, payload)
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written to a temporary file first, so other workers never read a partial figure
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(payload)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return  # The disk tier is best effort; the figure stays cached in memory
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(payload)
+            if self._disk_bytes is not None and self._disk_bytes <= self.max_disk_bytes:
+                return
+        self._evict_disk()
+
+    # Delete the least recently used files until the directory is back under 3/4 of its limit.
+    # Every worker writes to the same directory, so the size is measured rather than tracked.
+    def _evict_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        if total > self.max_disk_bytes:
+            for _, size, path in sorted(files):
+                if total <= self.max_disk_bytes * 3 / 4:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Removed by another worker
+                total -= size
+        with self._lock:
+            self._disk_bytes = total
+
+    # Whether a key is cached, without reading the figure or changing its place in either tier
+    def contains(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return self.directory is not None and os.path.exists(self._path(key))
+
+    # Value of a key: decoded from the cached bytes, or built by `build`, encoded and cached
+    def cached(self, kind, key, build, dump, load):
+        payload, tier = self.get(key)
+        metrics.FIGURE_CACHE.inc(kind=kind, result=tier)
+        if payload is not None:
+            value = load(payload)
+        else:
+            value = build()
+            payload = dump(value)
+            self.put(key, payload)
+        metrics.PAYLOAD_BYTES.observe(len(payload), kind='cache', name=kind)  # Serialized size, already at hand
+        return value
+
+    # Figure of a key, rebuilt from the cached JSON without validating it again (which is most of
+    # the cost of building a figure)
+    def figure(self, kind, key, build):
+        return self.cached(kind, key, build, dump_figure, load_figure)
+
+    def frame(self, kind, key, build):
+        return self.cached(kind, key, build, dump_frame, load_frame)
+
+    def value(self, kind, key, build):
+        return self.cached(kind, key, build, lambda value: json.dumps(value).encode(), json.loads)
+
+
+def dump_figure(fig):
+    return fig.to_json().encode()
+
+
+def load_figure(payload):
+    return go.Figure(json.loads(payload), _validate=False)
+
+
+def dump_frame(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def load_frame(payload):
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+cache = FigureCache()
@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from mesi.config import DB_PATH, REFRESH_INTERVAL
+
+# Change detection for MESI.db while the apps are running. A cheap check (file identity plus
+# SQLite's data_version) runs on every poll; only when it fires are the tables caught up
+# through data_store.refresh_frames.
+
+
+class DatabaseWatcher:
+    """Detects commits to the database file made by other connections."""
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._file = None
+        self._pid = None
+        self._data_version = None
+
+    # PRAGMA data_version changes whenever another connection commits to the file; a file replaced
+    # on disk (new inode) is caught by the stat check and reopened, as is the connection of a forked
+    # parent (the first check in a worker then reports a change)
+    def changed(self):
+        with self._lock:
+            try:
+                stat = os.stat(self.db_path)
+            except OSError:
+                return False
+            file = (stat.st_dev, stat.st_ino)
+            if self._conn is None or file != self._file or self._pid != os.getpid():
+                if self._conn is not None and self._pid == os.getpid():
+                    self._conn.close()
+                self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self._file = file
+                self._pid = os.getpid()
+                self._data_version = None
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            changed = data_version != self._data_version
+            self._data_version = data_version
+            return changed
+
+    # Forget the last seen version, so the next check reports a change (e.g. after a failed refresh)
+    def reset(self):
+        with self._lock:
+            self._data_version = None
+
+
+# Call `poll` every `interval` seconds in a daemon thread of this process (0 disables polling)
+def start_polling(poll, interval=REFRESH_INTERVAL):
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                poll()
+            except Exception:
+                traceback.print_exc()
+
+    thread = threading.Thread(target=run, name='mesi-refresh', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+from mesi import metrics
+from mesi.config import MAP_POINT_BUDGET
+
+# Level-of-detail helpers for the Scattergeo maps: rows are reduced to one point per site,
+# and above the point budget sites are binned on a lat/lon grid sized to the visible range.
+
+
+# One point per (site, lat, lon); flag_col (e.g. "selected") is true if any source row is flagged
+def dedupe_sites(df, flag_col=None):
+    cols = ['site', 'lat', 'lon'] + ([flag_col] if flag_col else [])
+    points = df[cols].dropna(subset=['lat', 'lon'])
+    if flag_col:
+        points = points.groupby(['site', 'lat', 'lon'], observed=True, sort=False)[flag_col].any().reset_index()
+    else:
+        points = points.drop_duplicates(['site', 'lat', 'lon'])
+    points = points.reset_index(drop=True)
+    points['site'] = points['site'].astype(object)
+    points['count'] = 1
+    return points
+
+
+# Add the sites of newly appended rows after the existing points, keeping existing positions
+def append_sites(points, rows):
+    merged = pd.concat([points, dedupe_sites(rows)], ignore_index=True)
+    return merged.drop_duplicates(['site', 'lat', 'lon']).reset_index(drop=True)
+
+
+# Grid of bin_points over a range: the cell size (degrees) and the number of columns
+def bin_grid(lat_range, lon_range, budget=MAP_POINT_BUDGET):
+    lat_span = max(lat_range[1] - lat_range[0], 1e-6)
+    lon_span = max(lon_range[1] - lon_range[0], 1e-6)
+    cell = np.sqrt(lat_span * lon_span / max(budget, 1))
+    return cell, int(np.ceil(lon_span / cell)) + 1
+
+
+# Grid row and column of coordinates inside the range
+def bin_cells(lat, lon, lat_range, lon_range, budget=MAP_POINT_BUDGET):
+    cell, _ = bin_grid(lat_range, lon_range, budget)
+    rows = np.floor((np.asarray(lat, dtype=float) - lat_range[0]) / cell).astype(np.int64)
+    cols = np.floor((np.asarray(lon, dtype=float) - lon_range[0]) / cell).astype(np.int64)
+    return rows, cols
+
+
+# Bin points on a grid with roughly `budget` cells over the given range.
+# Cells holding a single point keep their site; others report the point count and mean value.
+def bin_points(points, lat_range, lon_range, budget=MAP_POINT_BUDGET, value_col=None, flag_col=None):
+    _, n_cols = bin_grid(lat_range, lon_range, budget)
+    rows, cols = bin_cells(points['lat'], points['lon'], lat_range, lon_range, budget)
+    cell_id = rows * n_cols + cols
+
+    agg = {'lat': ('lat', 'mean'), 'lon': ('lon', 'mean'), 'site': ('site', 'first'), 'count': ('count', 'sum')}
+    if value_col:
+        agg[value_col] = (value_col, 'mean')
+    if flag_col:
+        agg[flag_col] = (flag_col, 'any')
+    cells = points.groupby(cell_id, sort=False).agg(**agg).reset_index(drop=True)
+    cells['site'] = cells['site'].where(cells['count'] == 1, None)
+    return cells
+
+
+# Lat/lon box around the bin_points cell holding (lat, lon), one cell wider on every side and clipped
+# to the range: it covers every cell whose marker can be drawn at (lat, lon)
+def cell_box(lat, lon, lat_range, lon_range, budget=MAP_POINT_BUDGET):
+    cell, _ = bin_grid(lat_range, lon_range, budget)
+    row, col = (int(value) for value in bin_cells(lat, lon, lat_range, lon_range, budget))
+    return ((max(lat_range[0] + (row - 1) * cell, lat_range[0]), min(lat_range[0] + (row + 2) * cell, lat_range[1])),
+            (max(lon_range[0] + (col - 1) * cell, lon_range[0]), min(lon_range[0] + (col + 2) * cell, lon_range[1])))
+
+
+# Mask of the points (inside the range) binned into the marker drawn at (lat, lon): the cell whose mean
+# position is nearest to it. The marker of a cell is the mean of its points, which rounding can put
+# on the edge of a neighbouring cell.
+def cell_members(points, lat, lon, lat_range, lon_range, budget=MAP_POINT_BUDGET):
+    if not len(points):
+        return np.zeros(0, dtype=bool)
+    _, n_cols = bin_grid(lat_range, lon_range, budget)
+    rows, cols = bin_cells(points['lat'], points['lon'], lat_range, lon_range, budget)
+    cell_id = rows * n_cols + cols
+    means = pd.DataFrame({'lat': points['lat'].to_numpy(dtype=float),
+                          'lon': points['lon'].to_numpy(dtype=float)}).groupby(cell_id).mean()
+    nearest = ((means['lat'] - lat) ** 2 + (means['lon'] - lon) ** 2).idxmin()
+    return cell_id == nearest
+
+
+# Hover text for reduced points: the site name, or the number of sites in a binned cell
+def point_text(points):
+    text = points['count'].astype(str) + ' sites'
+    return text.where(points['count'] > 1, points['site'])
+
+
+# Marker sizes that grow with the number of sites in a cell
+def marker_sizes(points, base_size):
+    return base_size + 2 * np.log2(points['count'].to_numpy())
+
+
+# Deduplicate rows per site and bin them when there are more sites than the point budget
+@metrics.stage('level_of_detail')
+def level_of_detail(df, lat_range=None, lon_range=None, budget=MAP_POINT_BUDGET, flag_col=None):
+    points = dedupe_sites(df, flag_col=flag_col)
+    if len(points) <= budget:
+        return points
+    if lat_range is None:
+        lat_range = (points['lat'].min(), points['lat'].max())
+    if lon_range is None:
+        lon_range = (points['lon'].min(), points['lon'].max())
+    return bin_points(points, lat_range, lon_range, budget=budget, flag_col=flag_col)
@@ -0,0 +1,131 @@
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from mesi import metrics, process_pool
+from mesi.config import ANALYTICS_PROCS, BOOTSTRAP_REPLICATES
+
+# Meta-analysis of the log response ratios, lnRR = log(x_t / x_c), of every treatment × response
+# × ecosystem_type group at once. Rows are mapped to integer group codes, and every per-group sum
+# is a np.bincount over those codes, so the whole table costs a handful of array passes.
+#
+# The sampling variance of a row is sd_t² / (rep_t x_t²) + sd_c² / (rep_c x_c²). Fixed-effect means
+# weight rows by 1 / v; random-effects means add the DerSimonian-Laird between-row variance tau².
+# Bootstrap intervals resample the rows of each group and run in a process pool.
+
+GROUP_COLUMNS = ['treatment', 'response', 'ecosystem_type']
+MEASUREMENT_COLUMNS = ['x_t', 'x_c', 'sd_t', 'sd_c', 'rep_t', 'rep_c']
+SUMMARY_COLUMNS = GROUP_COLUMNS + ['k', 'mean_fixed', 'se_fixed', 'mean_random', 'se_random', 'ci_lower',
+                                   'ci_upper', 'tau2', 'q', 'i2', 'boot_lower', 'boot_upper']
+
+Z_95 = 1.959963984540054  # Two-sided 95% normal quantile
+
+# Replicates per pool task. Fixed, so the intervals of a seed do not depend on the process count.
+BOOTSTRAP_CHUNK = 50
+
+
+# Effect size and sampling variance of every row: NaN unless x_t and x_c (for the variance also
+# rep_t and rep_c) are positive. Text columns ("NA" for missing values) and parsed float columns are
+# both accepted.
+def log_ratios(df):
+    values = {col: pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float) for col in MEASUREMENT_COLUMNS}
+    positive = (values['x_t'] > 0) & (values['x_c'] > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(positive, np.log(values['x_t'] / values['x_c']), np.nan)
+        v = np.where(positive & (values['rep_t'] > 0) & (values['rep_c'] > 0),
+                     values['sd_t'] ** 2 / (values['rep_t'] * values['x_t'] ** 2)
+                     + values['sd_c'] ** 2 / (values['rep_c'] * values['x_c'] ** 2), np.nan)
+    return y, v
+
+
+# Effect size and sampling variance of every usable row, with the group codes of the rows and the
+# group keys
+def effect_sizes(df):
+    y, v = log_ratios(df)
+    usable = np.isfinite(y) & np.isfinite(v) & (v > 0)
+
+    groups = df[GROUP_COLUMNS].groupby(GROUP_COLUMNS, observed=True, sort=True, dropna=True)
+    codes = groups.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    usable &= codes >= 0  # Rows with a missing key belong to no group
+    keys = groups.size().index.to_frame(index=False)
+    return keys, codes[usable], y[usable], v[usable]
+
+
+# Fixed- and random-effects estimates of every group (arrays indexed by group code)
+def pooled_effects(y, v, codes, n_groups):
+    k = np.bincount(codes, minlength=n_groups)
+    w = 1 / v
+    sw = np.bincount(codes, w, n_groups)
+    sww = np.bincount(codes, w * w, n_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_fixed = np.bincount(codes, w * y, n_groups) / sw
+        q = np.bincount(codes, w * (y - mean_fixed[codes]) ** 2, n_groups)
+        c = sw - sww / sw
+        tau2 = np.where(c > 0, np.maximum(0, (q - (k - 1)) / c), 0)
+        ws = 1 / (v + tau2[codes])
+        sws = np.bincount(codes, ws, n_groups)
+        return {
+            'k': k,
+            'mean_fixed': mean_fixed,
+            'se_fixed': np.sqrt(1 / sw),
+            'mean_random': np.bincount(codes, ws * y, n_groups) / sws,
+            'se_random': np.sqrt(1 / sws),
+            'tau2': tau2,
+            'q': q,
+            'i2': np.where(q > 0, np.maximum(0, (q - (k - 1)) / q), 0),
+        }
+
+
+# Random-effects means of `replicates` resamples (rows drawn with replacement within each group).
+# Rows must be sorted by group code. Resamples are drawn in batches sharing one set of bincounts.
+def _bootstrap_chunk(y, v, codes, replicates, seed):
+    n_groups = int(codes.max()) + 1
+    counts = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rng = np.random.default_rng(seed)
+    batch = max(1, min(replicates, 4_000_000 // len(y)))
+    means = []
+    for first in range(0, replicates, batch):
+        size = min(batch, replicates - first)
+        rows = starts[codes] + (rng.random((size, len(y))) * counts[codes]).astype(np.int64)
+        batch_codes = (codes + n_groups * np.arange(size)[:, None]).ravel()
+        effects = pooled_effects(y[rows].ravel(), v[rows].ravel(), batch_codes, size * n_groups)
+        means.append(effects['mean_random'].reshape(size, n_groups))
+    return np.concatenate(means)
+
+
+# Percentile intervals of the random-effects means: chunks of replicates run in the process pool
+@metrics.stage('meta_bootstrap')
+def bootstrap_intervals(y, v, codes, n_groups, replicates=BOOTSTRAP_REPLICATES, level=0.95, seed=0):
+    lower, upper = np.full(n_groups, np.nan), np.full(n_groups, np.nan)
+    if not len(y) or replicates <= 0:
+        return lower, upper
+    order = np.argsort(codes, kind='stable')
+    y, v, codes = y[order], v[order], codes[order]
+    sizes = [min(BOOTSTRAP_CHUNK, replicates - first) for first in range(0, replicates, BOOTSTRAP_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    chunks = process_pool.imap('bootstrap', ANALYTICS_PROCS, _bootstrap_chunk, repeat(y), repeat(v), repeat(codes),
+                               sizes, seeds)
+    means = np.concatenate(list(chunks))
+    present = np.unique(codes)
+    tail = (1 - level) / 2 * 100
+    lower[present], upper[present] = np.percentile(means[:, present], [tail, 100 - tail], axis=0)
+    return lower, upper
+
+
+# One row per treatment × response × ecosystem_type group with usable rows: row count, fixed- and
+# random-effects means with standard errors, the random-effects 95% interval, tau², Cochran's Q,
+# I², and (with replicates > 0) the bootstrap interval of the random-effects mean
+@metrics.stage('meta_summary')
+def summarize(df, replicates=0):
+    keys, codes, y, v = effect_sizes(df)
+    effects = pooled_effects(y, v, codes, len(keys))
+    summary = keys.assign(**effects)
+    summary['ci_lower'] = summary['mean_random'] - Z_95 * summary['se_random']
+    summary['ci_upper'] = summary['mean_random'] + Z_95 * summary['se_random']
+    summary['boot_lower'], summary['boot_upper'] = bootstrap_intervals(y, v, codes, len(keys), replicates)
+    for col in GROUP_COLUMNS:
+        if isinstance(summary[col].dtype, pd.CategoricalDtype):
+            summary[col] = summary[col].astype(object)
+    return summary.loc[summary['k'] > 0, SUMMARY_COLUMNS].reset_index(drop=True)
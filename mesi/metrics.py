@@ -0,0 +1,229 @@
+import cProfile
+import functools
+import inspect
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import tornado.web
+
+from mesi.config import PROFILE_DIR, PROFILE_SLOW_MS
+
+# In-process timing and payload metrics for the dashboard hot paths, exposed in the Prometheus
+# text format. Every worker process keeps its own registry (the scrape hits one process, so
+# multi-process deployments should scrape each worker or run one process per target).
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # sorted label items -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(key, list(series)) for key, series in self.series.items()]
+        for key, series in items:
+            for bound, count in zip(self.buckets + ('+Inf',), series[:len(self.buckets)] + [series[-2]]):
+                lines.append(f'{self.name}_bucket{_labels(key + (("le", bound),))} {count}')
+            lines.append(f'{self.name}_count{_labels(key)} {series[-2]}')
+            lines.append(f'{self.name}_sum{_labels(key)} {series[-1]}')
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = list(self.series.items())
+        lines.extend(f'{self.name}{_labels(key)} {value}' for key, value in items)
+        return lines
+
+
+def _labels(items):
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+CALL_SECONDS = Histogram('mesi_call_seconds', 'Wall time of instrumented callbacks and hot-path stages',
+                         LATENCY_BUCKETS)
+CALL_ERRORS = Counter('mesi_call_errors_total', 'Instrumented calls that raised')
+PAYLOAD_BYTES = Histogram('mesi_payload_bytes', 'Size of callback results and HTTP responses', BYTES_BUCKETS)
+HTTP_SECONDS = Histogram('mesi_http_request_seconds', 'Wall time of HTTP requests including serialization',
+                         LATENCY_BUCKETS)
+PROFILES = Counter('mesi_profiles_total', 'cProfile dumps written for slow calls')
+FIGURE_CACHE = Counter('mesi_figure_cache_total', 'Figure cache lookups by figure kind and the tier that answered')
+
+REGISTRY = [CALL_SECONDS, CALL_ERRORS, PAYLOAD_BYTES, HTTP_SECONDS, PROFILES, FIGURE_CACHE]
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Approximate serialized size of a callback result, without serializing it
+def payload_bytes(obj):
+    if obj is None:
+        return 0
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(index=False)))
+    if hasattr(obj, 'to_plotly_json'):  # Plotly figures and Dash components
+        return payload_bytes(obj.to_plotly_json())
+    if isinstance(obj, dict):
+        return sum(len(str(key)) + payload_bytes(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_bytes(value) for value in obj)
+    return 8
+
+
+# Only one cProfile profiler can be active at a time; concurrent slow calls are timed but not profiled
+_profile_lock = threading.Lock()
+_profiling = threading.local()
+
+
+def _profiled_call(name, fn, args, kwargs):
+    if PROFILE_SLOW_MS is None or getattr(_profiling, 'active', False) or not _profile_lock.acquire(blocking=False):
+        return fn(*args, **kwargs)
+    profiler = cProfile.Profile()
+    _profiling.active = True
+    start = time.perf_counter()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        elapsed_ms = 1000 * (time.perf_counter() - start)
+        _profiling.active = False
+        _profile_lock.release()
+        if elapsed_ms >= PROFILE_SLOW_MS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-'
+                                                          f'{int(elapsed_ms)}ms-{os.getpid()}.prof'))
+            PROFILES.inc(name=name)
+
+
+# Decorator recording wall time, errors and (optionally) the result size of a callback or stage.
+# With MESI_PROFILE_SLOW_MS set, callbacks run under cProfile and slow ones dump their stats.
+def timed(name, kind='callback', payload=None):
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            # Async callbacks are timed end to end; their executor work is profiled by its own stages
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception:
+                    CALL_ERRORS.inc(kind=kind, name=name)
+                    raise
+                finally:
+                    CALL_SECONDS.observe(time.perf_counter() - start, kind=kind, name=name)
+                if payload is not None:
+                    PAYLOAD_BYTES.observe(payload(result), kind=kind, name=name)
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if kind == 'callback':
+                    result = _profiled_call(name, fn, args, kwargs)
+                else:
+                    result = fn(*args, **kwargs)
+            except Exception:
+                CALL_ERRORS.inc(kind=kind, name=name)
+                raise
+            finally:
+                CALL_SECONDS.observe(time.perf_counter() - start, kind=kind, name=name)
+            if payload is not None:
+                PAYLOAD_BYTES.observe(payload(result), kind=kind, name=name)
+            return result
+        return wrapper
+    return decorate
+
+
+# Hot-path stage inside a callback (SQLite load, ratio lookup, figure build, ...)
+def stage(name, payload=None):
+    return timed(name, kind='stage', payload=payload)
+
+
+# Flask (Dash) server: time every request, record response sizes, and serve /metrics
+def instrument_flask(server):
+    import flask
+
+    @server.before_request
+    def start_timer():
+        flask.g.mesi_request_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = flask.g.pop('mesi_request_start', None)
+        if start is None or flask.request.path == '/metrics':
+            return response
+        # Route pattern rather than path, so asset URLs do not each become a series
+        rule = flask.request.url_rule
+        name = rule.rule if rule is not None else 'unmatched'
+        if name.endswith('_dash-update-component'):
+            body = flask.request.get_json(silent=True) or {}
+            name = body.get('output', name)  # The callback's output id, e.g. "world-map.figure"
+        HTTP_SECONDS.observe(time.perf_counter() - start, name=name)
+        if not response.direct_passthrough:
+            PAYLOAD_BYTES.observe(response.calculate_content_length() or 0, kind='http', name=name)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(render(), content_type=CONTENT_TYPE)
+
+    return server
+
+
+# Tornado (Panel) handler serving /metrics
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(render())
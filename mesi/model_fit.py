@@ -0,0 +1,204 @@
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+from mesi import figure_cache, meta_analysis, metrics, process_pool
+from mesi.config import MODEL_PROCS
+
+# Regression models of the log response ratio for the Model tab. Every group (response × treatment
+# and/or ecosystem type) gets a weighted least-squares fit of lnRR = log(x_t / x_c) on an intercept,
+# the site coordinates and numeric Site_metadata columns joined on the site.
+#
+# Fits run as background jobs: the groups are split into tasks of about equal row counts for a
+# process pool, and a job counts the fitted groups so the UI can show its progress. The fitted models
+# and predictions are kept in the figure cache under the state of the data and the model parameters,
+# so every session and worker process reuses them.
+
+KEY_COLUMNS = ['site', 'lat', 'lon', 'treatment', 'response', 'ecosystem_type']
+MAIN_COLUMNS = KEY_COLUMNS + meta_analysis.MEASUREMENT_COLUMNS
+
+# Grouping option -> group columns (one model per group)
+GROUPINGS = {
+    'treatment': ['response', 'treatment'],
+    'ecosystem_type': ['response', 'ecosystem_type'],
+    'treatment × ecosystem_type': ['response', 'treatment', 'ecosystem_type'],
+}
+BASE_COVARIATES = ['lat', 'lon']
+# Row weights: 1 / sampling variance (rows without sd/rep are left out) or equal weights
+WEIGHTINGS = ['inverse variance', 'none']
+
+# Pool tasks per process, so progress advances in steps while every task stays large
+TASKS_PER_PROC = 4
+
+
+# Numeric Site_metadata columns, one row per site (mean over repeated rows); the coordinates are
+# taken from Site_main. A column counts as numeric if most of its non-null values parse as numbers.
+def site_covariates(metadata):
+    numeric = {}
+    for col in metadata.columns:
+        if col in ('site', 'lat', 'lon'):
+            continue
+        values = pd.to_numeric(metadata[col], errors='coerce')
+        if values.notna().sum() > metadata[col].notna().sum() / 2:
+            numeric[col] = values.to_numpy(dtype=float)
+    frame = pd.DataFrame(numeric, index=np.asarray(metadata['site'], dtype=object))
+    return frame.groupby(level=0).mean()
+
+
+# Covariates a model can use
+def covariate_names(metadata):
+    return BASE_COVARIATES + list(site_covariates(metadata).columns)
+
+
+# Rows of the joined data with a finite log ratio, weight, covariates and group key
+def model_rows(main, metadata, group_columns, covariates, weighting):
+    y, v = meta_analysis.log_ratios(main)
+    df = pd.DataFrame({col: np.asarray(main[col]) for col in KEY_COLUMNS})
+    df['y'] = y
+    df['w'] = 1 / v if weighting == 'inverse variance' else np.ones(len(df))
+    extra = [col for col in covariates if col not in BASE_COVARIATES]
+    if extra:
+        df = df.join(site_covariates(metadata)[extra], on='site')
+    numeric = df[['y', 'w'] + covariates].to_numpy(dtype=float)
+    keep = np.isfinite(numeric).all(axis=1) & (df['w'].to_numpy() > 0) & df[group_columns].notna().all(axis=1)
+    return df[keep].reset_index(drop=True)
+
+
+# Weighted least squares of y on the columns of X: (coefficients, standard errors, weighted R²,
+# weighted RMSE, status). Groups with no more rows than terms, or collinear covariates, get no fit.
+def fit_wls(y, w, X):
+    n, p = X.shape
+    if n <= p:
+        return None, None, np.nan, np.nan, 'too few rows'
+    sw = np.sqrt(w)
+    Xw = X * sw[:, None]
+    beta, _, rank, _ = np.linalg.lstsq(Xw, y * sw, rcond=None)
+    if rank < p:
+        return None, None, np.nan, np.nan, 'collinear covariates'
+    rss = np.sum(w * (y - X @ beta) ** 2)
+    tss = np.sum(w * (y - np.sum(w * y) / np.sum(w)) ** 2)
+    se = np.sqrt(np.diag(np.linalg.inv(Xw.T @ Xw)) * rss / (n - p))
+    return beta, se, 1 - rss / tss if tss > 0 else np.nan, np.sqrt(rss / np.sum(w)), 'ok'
+
+
+# Fits of consecutive groups (pool task): rows sorted by group, `sizes` rows per group
+def _fit_task(y, w, X, sizes):
+    fits = []
+    for start, size in zip(np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes):
+        fits.append(fit_wls(y[start:start + size], w[start:start + size], X[start:start + size]))
+    return fits
+
+
+class ModelJob:
+    """A batch of fits: `groups` and `fitted` count its progress, `future` gives (models, predictions)."""
+
+    def __init__(self):
+        self.groups = 0  # Known once the data is prepared
+        self.fitted = 0
+        self.future = Future()
+
+
+# One model per group: a table of the fits (group keys, rows, R², RMSE, status, then the coefficient
+# b_<term> and standard error se_<term> of every term) and the prediction of every row used
+@metrics.stage('model_fit')
+def fit_models(main, metadata, grouping, covariates, weighting, job=None, procs=MODEL_PROCS):
+    job = job or ModelJob()
+    group_columns = GROUPINGS[grouping]
+    terms = ['intercept'] + covariates
+    df = model_rows(main, metadata, group_columns, covariates, weighting)
+
+    groups = df.groupby(group_columns, sort=True, observed=True)
+    codes = groups.ngroup().to_numpy()
+    keys = groups.size().index.to_frame(index=False)
+    order = np.argsort(codes, kind='stable')
+    df, codes = df.iloc[order].reset_index(drop=True), codes[order]
+    y, w = df['y'].to_numpy(dtype=float), df['w'].to_numpy(dtype=float)
+    X = np.column_stack([np.ones(len(df))] + [df[col].to_numpy(dtype=float) for col in covariates])
+    sizes = np.bincount(codes, minlength=len(keys))
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    job.groups = len(keys)
+
+    # Consecutive groups with about len(df) / n_tasks rows per task; a group is never split
+    n_tasks = max(1, min(len(keys), procs * TASKS_PER_PROC))
+    task_of_group = starts[:-1] * n_tasks // max(len(df), 1)
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(task_of_group)) + 1, [len(keys)]])
+    tasks = [(first, last, (y[starts[first]:starts[last]], w[starts[first]:starts[last]],
+                            X[starts[first]:starts[last]], sizes[first:last]))
+             for first, last in zip(bounds[:-1], bounds[1:])]
+
+    fits = [None] * len(keys)
+    results = process_pool.imap('models', procs if len(tasks) > 1 else 1, _fit_task,
+                                *zip(*(args for _, _, args in tasks)))
+    for (first, last, _), task_fits in zip(tasks, results):
+        fits[first:last] = task_fits
+        job.fitted += int(last - first)
+
+    coefficients = np.full((len(keys), len(terms)), np.nan)
+    errors = np.full((len(keys), len(terms)), np.nan)
+    for i, (beta, se, _, _, status) in enumerate(fits):
+        if status == 'ok':
+            coefficients[i], errors[i] = beta, se
+    models = keys.assign(n=sizes, r2=[fit[2] for fit in fits], rmse=[fit[3] for fit in fits],
+                         status=[fit[4] for fit in fits])
+    for j, term in enumerate(terms):
+        models[f'b_{term}'] = coefficients[:, j]
+        models[f'se_{term}'] = errors[:, j]
+
+    predicted = np.einsum('ij,ij->i', X, coefficients[codes]) if len(df) else np.empty(0)
+    predictions = df[KEY_COLUMNS].assign(observed=y, predicted=predicted, residual=y - predicted)
+    return models, predictions
+
+
+# Cache keys of the models and predictions of a parameter set on a data state
+def result_keys(data, params):
+    return (figure_cache.figure_key('model_fits', data, **params),
+            figure_cache.figure_key('model_predictions', data, **params))
+
+
+class ModelService:
+    """Fitting jobs of one process: a parameter set on a data state is fitted once, by a background
+    thread driving the process pool; sessions asking for it meanwhile share the running job."""
+
+    def __init__(self, load, procs=MODEL_PROCS):
+        self._load = load  # () -> (data state, Site_main rows with MAIN_COLUMNS, Site_metadata rows)
+        self.procs = procs
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    # Job fitting `params` on the data state `data`: already done if the results are cached
+    def submit(self, data, grouping, covariates, weighting):
+        if grouping not in GROUPINGS or weighting not in WEIGHTINGS:
+            raise KeyError((grouping, weighting))
+        params = {'grouping': grouping, 'covariates': sorted(set(covariates)), 'weighting': weighting}
+        models_key, predictions_key = result_keys(data, params)
+        with self._lock:
+            job = self._jobs.get(models_key)
+            if job is not None:
+                return job
+            job = ModelJob()
+            results = [figure_cache.cache.get(key) for key in (models_key, predictions_key)]
+            for kind, (_, tier) in zip(('model_fits', 'model_predictions'), results):
+                metrics.FIGURE_CACHE.inc(kind=kind, result=tier)
+            if all(payload is not None for payload, _ in results):
+                job.future.set_result(tuple(figure_cache.load_frame(payload) for payload, _ in results))
+                return job
+            self._jobs[models_key] = job
+        threading.Thread(target=self._run, args=(job, models_key, params), name='mesi-models', daemon=True).start()
+        return job
+
+    # Results are cached under the data state the rows were loaded from, which may be newer than the
+    # one the job was submitted for
+    def _run(self, job, job_key, params):
+        try:
+            data, main, metadata = self._load()
+            models, predictions = fit_models(main, metadata, job=job, procs=self.procs, **params)
+            for key, frame in zip(result_keys(data, params), (models, predictions)):
+                figure_cache.cache.put(key, figure_cache.dump_frame(frame))
+            job.future.set_result((models, predictions))
+        except Exception as exc:
+            job.future.set_exception(exc)
+        finally:
+            with self._lock:
+                self._jobs.pop(job_key, None)
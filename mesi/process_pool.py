@@ -0,0 +1,101 @@
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import context, forkserver, popen_forkserver, reduction, spawn, util
+
+from mesi.config import POOL_IDLE_TIMEOUT
+
+# Process pools for CPU-bound background work (bootstrap replicates, model fits, figure warm-up). The
+# workers are forked from a fork server, a single-threaded process started on first use, never from
+# the dashboard process: a worker forked from there could inherit a lock held by one of its threads
+# (metrics, caches, the data lock) and block on it. The fork server preloads the modules of the pool
+# tasks, so the workers start without importing them again. Tasks are plain functions of those
+# modules and get the data they work on as arguments. Neither the fork server nor the workers run
+# the script that started the app, so scripts and notebooks without a `__name__ == '__main__'` guard
+# can use the pools too. A pool is shut down once it has been idle for POOL_IDLE_TIMEOUT seconds and
+# started again on the next use.
+
+TASK_MODULES = ['mesi.meta_analysis', 'mesi.model_fit', 'mesi.ratio_map']
+
+
+class _TaskPopen(popen_forkserver.Popen):
+    # As popen_forkserver.Popen._launch, without the main module in the data the worker is prepared
+    # from (multiprocessing would run the launching script in the worker as __mp_main__)
+    def _launch(self, process_obj):
+        prep_data = spawn.get_preparation_data(process_obj._name)
+        prep_data.pop('init_main_from_path', None)
+        prep_data.pop('init_main_from_name', None)
+        buf = io.BytesIO()
+        context.set_spawning_popen(self)
+        try:
+            reduction.dump(prep_data, buf)
+            reduction.dump(process_obj, buf)
+        finally:
+            context.set_spawning_popen(None)
+
+        self.sentinel, w = forkserver.connect_to_new_process(self._fds)
+        _parent_w = os.dup(w)
+        self.finalizer = util.Finalize(self, util.close_fds, (_parent_w, self.sentinel))
+        with open(w, 'wb', closefd=True) as f:
+            f.write(buf.getbuffer())
+        self.pid = forkserver.read_signed(self.sentinel)
+
+
+class _TaskProcess(context.ForkServerProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        return _TaskPopen(process_obj)
+
+
+class _TaskContext(context.ForkServerContext):
+    Process = _TaskProcess
+
+
+_context = _TaskContext()
+_context.set_forkserver_preload(TASK_MODULES)
+
+_pools = {}
+_lock = threading.Lock()
+
+
+class _Pool:
+    def __init__(self, size):
+        self.executor = ProcessPoolExecutor(size, mp_context=_context)
+        self.pid = os.getpid()
+        self.users = 0
+        self.timer = None
+
+
+# Results of fn over the arguments, in order: computed by pool `name` of this process with `size`
+# workers, or in this thread if size <= 1. The pool counts as in use until the results are consumed.
+def imap(name, size, fn, *iterables):
+    if size <= 1:
+        yield from map(fn, *iterables)
+        return
+    with _lock:
+        pool = _pools.get(name)
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[name] = _Pool(size)
+        pool.users += 1
+        if pool.timer is not None:
+            pool.timer.cancel()
+            pool.timer = None
+    try:
+        yield from pool.executor.map(fn, *iterables)
+    finally:
+        with _lock:
+            pool.users -= 1
+            if not pool.users and _pools.get(name) is pool:
+                pool.timer = threading.Timer(POOL_IDLE_TIMEOUT, _shut_down, (name, pool))
+                pool.timer.daemon = True
+                pool.timer.start()
+
+
+# Shut down an idle pool, unless it was taken again since its timer started
+def _shut_down(name, pool):
+    with _lock:
+        if pool.users or _pools.get(name) is not pool:
+            return
+        del _pools[name]
+    pool.executor.shutdown(wait=False, cancel_futures=True)
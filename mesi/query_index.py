@@ -0,0 +1,69 @@
+import copy
+
+import numpy as np
+
+# Inverted indexes from site, lat and lon values to the row positions holding them.
+# Multi-criteria filters become unions/intersections of sorted position arrays instead of
+# boolean masks over the full frame, and a clicked site resolves to its row in O(1).
+
+
+# value -> sorted array of row positions
+def inverted_index(values):
+    return values.groupby(values, observed=True, sort=False).indices
+
+
+class SiteQueryIndex:
+
+    def __init__(self, df):
+        self.df = df
+        self.by_site = inverted_index(df['site'])
+        self.by_lat = inverted_index(df['lat'])
+        self.by_lon = inverted_index(df['lon'])
+        self.site_row = {site: positions[0] for site, positions in self.by_site.items()}
+
+    # Index over `df`, a frame extending the indexed one with appended rows. Only the new rows are
+    # indexed; the result is a new object, so readers of this one never see a half-updated index.
+    def extend(self, df):
+        start = len(self.df)
+        extended = copy.copy(self)
+        extended.df = df
+        for attr, col in (('by_site', 'site'), ('by_lat', 'lat'), ('by_lon', 'lon')):
+            index = dict(getattr(self, attr))
+            for value, positions in inverted_index(df[col].iloc[start:]).items():
+                positions = positions + start
+                index[value] = np.concatenate([index[value], positions]) if value in index else positions
+            setattr(extended, attr, index)
+        extended.site_row = {site: positions[0] for site, positions in extended.by_site.items()}
+        return extended
+
+    # Row positions holding any of the selected values
+    @staticmethod
+    def _union(index, selected):
+        hits = [index[value] for value in selected if value in index]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(hits))
+
+    # Row positions matching every given criterion (None means no filter at all)
+    def positions(self, sites=None, lats=None, lons=None):
+        result = None
+        for index, selected in ((self.by_site, sites), (self.by_lat, lats), (self.by_lon, lons)):
+            if not selected:
+                continue
+            hits = self._union(index, selected)
+            result = hits if result is None else np.intersect1d(result, hits, assume_unique=True)
+        return result
+
+    # Rows matching the criteria, in their original order
+    def filter(self, sites=None, lats=None, lons=None):
+        positions = self.positions(sites, lats, lons)
+        if positions is None:
+            return self.df
+        return self.df.iloc[positions]
+
+    # First row of a site, or None if the site is unknown
+    def first_row(self, site):
+        position = self.site_row.get(site)
+        if position is None:
+            return None
+        return self.df.iloc[position]
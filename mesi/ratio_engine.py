@@ -0,0 +1,133 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from mesi import color_scale, metrics
+from mesi.config import RATIO_CACHE_SIZE
+
+# Ratio = log (x_t / x_c) (x_t means data under certain treatment and x_c means data in control)
+# The cube holds one row per (treatment, response, site, lat, lon, ecosystem_type) with the
+# sum and count of log ratios, so the mean can be looked up instead of recomputed per widget event.
+CUBE_KEYS = ['treatment', 'response', 'site', 'lat', 'lon', 'ecosystem_type']
+RATIO_COLUMNS = ['site', 'lat', 'lon', 'ecosystem_type', 'ratio']
+
+
+# Compute the log ratio of every valid row (x_t and x_c numeric and positive)
+def log_ratios(df):
+    x_t = pd.to_numeric(df['x_t'], errors='coerce')
+    x_c = pd.to_numeric(df['x_c'], errors='coerce')
+    valid = (x_t > 0) & (x_c > 0)
+    df_valid = df.loc[valid, CUBE_KEYS].copy()
+    df_valid['ratio'] = np.log(x_t[valid] / x_c[valid])
+    return df_valid
+
+
+# Group the log ratios of a Site_main frame into the ratio cube
+@metrics.stage('build_ratio_cube')
+def build_ratio_cube(df):
+    df_valid = log_ratios(df)
+    cube = (df_valid.groupby(CUBE_KEYS, observed=True).ratio
+            .agg(ratio_sum='sum', ratio_count='count')
+            .reset_index())
+    cube['ratio'] = cube['ratio_sum'] / cube['ratio_count']
+    # Keys are stored as plain values so callers can concatenate and compare them freely
+    for col in ['treatment', 'response', 'site', 'ecosystem_type']:
+        if isinstance(cube[col].dtype, pd.CategoricalDtype):
+            cube[col] = cube[col].astype(object)
+    return cube
+
+
+class RatioEngine:
+    """Indexed, LRU-cached lookups of mean log ratios per (treatment, response)."""
+
+    def __init__(self, df, version=None, cache_size=RATIO_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self.rebuild(df, version)
+
+    # Rebuild the cube from a new Site_main frame and drop every cached lookup
+    def rebuild(self, df, version=None):
+        cube = build_ratio_cube(df)
+        pairs = {
+            key: cube.iloc[positions].reset_index(drop=True)
+            for key, positions in cube.groupby(['treatment', 'response'], sort=False).indices.items()
+        }
+        # Colour-scale summaries of every pair, precomputed; per-ecosystem ones are added on first use
+        summaries = {(*key, None): color_scale.summarize(pair['ratio']) for key, pair in pairs.items()}
+        with self._lock:
+            self.version = version
+            self.cube = cube
+            self._pairs = pairs
+            self._cache = OrderedDict()
+            self._summaries = summaries
+
+    # Fold newly appended Site_main rows into the cube. Only the (treatment, response) pairs they
+    # touch are regrouped and dropped from the cache; returns those pairs.
+    @metrics.stage('ratio_append')
+    def append(self, df_new, version=None):
+        delta = build_ratio_cube(df_new)
+        pairs = set(zip(delta['treatment'], delta['response']))
+        with self._lock:
+            updated = {}
+            for pair in pairs:
+                merged = pd.concat([self._pairs.get(pair), delta[(delta['treatment'] == pair[0])
+                                                                 & (delta['response'] == pair[1])]])
+                merged = (merged.groupby(CUBE_KEYS, sort=True)[['ratio_sum', 'ratio_count']].sum()
+                          .reset_index())
+                merged['ratio'] = merged['ratio_sum'] / merged['ratio_count']
+                updated[pair] = merged
+            self._pairs = {**self._pairs, **updated}
+            self.cube = pd.concat(self._pairs.values(), ignore_index=True)
+            self.version = version
+            self._cache = OrderedDict((key, value) for key, value in self._cache.items() if key[:2] not in pairs)
+            self._summaries = {key: value for key, value in self._summaries.items() if key[:2] not in pairs}
+            self._summaries.update({(*pair, None): color_scale.summarize(updated[pair]['ratio']) for pair in pairs})
+        return pairs
+
+    def is_stale(self, version):
+        return version != self.version
+
+    def _pair(self, treatment, response):
+        pair = self._pairs.get((treatment, response))
+        if pair is None:
+            return pd.DataFrame({col: pd.Series(dtype=self.cube[col].dtype) for col in self.cube.columns})
+        return pair
+
+    # Mean log ratio per site for a treatment/response, optionally restricted to one ecosystem_type.
+    # The returned frame is shared between callers and must not be modified in place.
+    @metrics.stage('ratio_lookup')
+    def lookup(self, treatment, response, ecosystem_type=None):
+        if ecosystem_type == "All":
+            ecosystem_type = None
+        key = (treatment, response, ecosystem_type)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            df_pair = self._pair(treatment, response)
+            if ecosystem_type:
+                df_pair = df_pair[df_pair['ecosystem_type'] == ecosystem_type]
+            result = df_pair[RATIO_COLUMNS].reset_index(drop=True)
+
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return result
+
+    # Colour-scale summary (color_scale.RatioSummary) of the ratios a lookup returns
+    def summary(self, treatment, response, ecosystem_type=None):
+        if ecosystem_type == "All":
+            ecosystem_type = None
+        key = (treatment, response, ecosystem_type)
+        with self._lock:
+            if key not in self._summaries:
+                self._summaries[key] = color_scale.summarize(self.lookup(*key)['ratio'])
+            return self._summaries[key]
+
+    # Ecosystem types available for a treatment/response pair
+    def ecosystems(self, treatment, response):
+        with self._lock:
+            return self._pair(treatment, response)['ecosystem_type'].dropna().unique().tolist()
@@ -0,0 +1,63 @@
+import plotly.graph_objs as go
+
+from mesi import figure_cache, map_lod
+from mesi.color_scale import ratio_color_scale
+from mesi.config import MAP_POINT_BUDGET
+
+# Ratio map of a treatment/response/ecosystem_type ratio table. Kept free of metrics and locks, so
+# the warm-up can render the maps in pool processes; the dashboard times its own calls.
+
+
+# Scattergeo figure of a ratio table, coloured by the colour-scale summary of its ratios
+def ratio_figure(df_grouped, summary):
+    colorscale, cmin, cmax = ratio_color_scale(summary)
+
+    # Bin the sites on a grid when there are more than the map point budget. Hover text is filled
+    # in by the browser from the marker color (the ratio) and customdata, not sent per point.
+    if len(df_grouped) > MAP_POINT_BUDGET:
+        points = df_grouped.assign(count=1)
+        points = map_lod.bin_points(points, (points['lat'].min(), points['lat'].max()),
+                                    (points['lon'].min(), points['lon'].max()), value_col='ratio')
+        sizes = map_lod.marker_sizes(points, 3)
+        text, customdata = map_lod.point_text(points), None
+        hovertemplate = '%{text} %{marker.color:.4g}<br>(%{lat}, %{lon})<extra></extra>'
+    else:
+        points, sizes = df_grouped, 3  # One site per marker: a single size instead of an array
+        text, customdata = df_grouped['site'], df_grouped['ecosystem_type']
+        hovertemplate = '%{text} %{customdata} %{marker.color:.4g}<br>(%{lat}, %{lon})<extra></extra>'
+
+    # Create Plotly scatter map
+    fig = go.Figure(go.Scattergeo(
+        lon=points['lon'],
+        lat=points['lat'],
+        text=text,
+        customdata=customdata,
+        hovertemplate=hovertemplate,
+        mode='markers',
+        marker=dict(
+            size=sizes,
+            color=points['ratio'],
+            colorscale=colorscale,
+            cmin=cmin,
+            cmax=cmax,
+            colorbar=dict(title="Ratio(log(x_t / x_c))")
+        )
+    ))
+
+    # Update map layout
+    fig.update_layout(
+        title='World Map with Ratio-colored Points',
+        geo=dict(
+            projection_type='natural earth',
+            showland=True,
+            landcolor="lightgray",
+            coastlinecolor="black"),
+        width=900 # Adjusted width and height for map size
+    )
+
+    return fig
+
+
+# Serialized ratio map (warm-up pool task)
+def render_ratio_map(df_grouped, summary):
+    return figure_cache.dump_figure(ratio_figure(df_grouped, summary))
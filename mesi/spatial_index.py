@@ -0,0 +1,105 @@
+import numpy as np
+
+# Grid index over site coordinates for the map interactions: box queries for the slider ranges,
+# sites within a radius of a click, and nearest sites. Points are sorted by the id of their
+# CELL_DEG × CELL_DEG cell, so the cells of one grid row covering a longitude interval are one
+# contiguous slice found by binary search; only points of the covered cells are checked exactly.
+
+CELL_DEG = 1.0
+EARTH_RADIUS_KM = 6371.0088
+HALF_CIRCUMFERENCE_KM = np.pi * EARTH_RADIUS_KM
+
+
+# Great-circle distance in km between a point and arrays of points (degrees)
+def haversine_km(lat, lon, lats, lons):
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    """Grid index of a points frame (lat/lon columns); queries return positions in the frame."""
+
+    def __init__(self, points, cell_deg=CELL_DEG):
+        self.points = points
+        self.cell_deg = cell_deg
+        self.n_rows = int(np.ceil(180 / cell_deg))
+        self.n_cols = int(np.ceil(360 / cell_deg))
+        lat = points['lat'].to_numpy(dtype=float)
+        lon = points['lon'].to_numpy(dtype=float)
+        valid = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+        cells = self._cell_ids(lat[valid], lon[valid])
+        order = np.argsort(cells, kind='stable')
+        self._positions = valid[order]
+        self._cells = cells[order]
+        self._lat = lat[self._positions]
+        self._lon = lon[self._positions]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _row(self, lat):
+        return np.clip(np.floor((np.asarray(lat) + 90) / self.cell_deg).astype(np.int64), 0, self.n_rows - 1)
+
+    def _col(self, lon):
+        return np.clip(np.floor((np.asarray(lon) + 180) / self.cell_deg).astype(np.int64), 0, self.n_cols - 1)
+
+    def _cell_ids(self, lat, lon):
+        return self._row(lat) * self.n_cols + self._col(lon)
+
+    # Sorted-array indices of the points in the cells covering a latitude range and longitude intervals
+    def _candidates(self, lat_lo, lat_hi, lon_intervals):
+        rows = np.arange(self._row(lat_lo), self._row(lat_hi) + 1)
+        col_lo = np.array([self._col(lo) for lo, _ in lon_intervals])
+        col_hi = np.array([self._col(hi) for _, hi in lon_intervals])
+        starts = np.searchsorted(self._cells, (rows[:, None] * self.n_cols + col_lo).ravel(), 'left')
+        ends = np.searchsorted(self._cells, (rows[:, None] * self.n_cols + col_hi).ravel(), 'right')
+        lengths = ends - starts
+        if not lengths.sum():
+            return np.empty(0, dtype=np.int64)
+        # Concatenated ranges starts[i]:ends[i] without a Python loop
+        offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return np.arange(lengths.sum()) + offsets
+
+    # Positions of the points inside a lat/lon box (inclusive, as Series.between), in frame order
+    def box(self, lat_range, lon_range):
+        (lat_lo, lat_hi), (lon_lo, lon_hi) = lat_range, lon_range
+        if lat_lo > lat_hi or lon_lo > lon_hi:
+            return np.empty(0, dtype=np.int64)
+        idx = self._candidates(lat_lo, lat_hi, [(lon_lo, lon_hi)])
+        lat, lon = self._lat[idx], self._lon[idx]
+        inside = (lat >= lat_lo) & (lat <= lat_hi) & (lon >= lon_lo) & (lon <= lon_hi)
+        return np.sort(self._positions[idx[inside]])
+
+    # Positions of the points within `radius_km` of (lat, lon) and their distances, nearest first
+    def within(self, lat, lon, radius_km):
+        angle = min(radius_km / EARTH_RADIUS_KM, np.pi)
+        dlat = np.degrees(angle)
+        lat_lo, lat_hi = lat - dlat, lat + dlat
+        # The circle's longitude extent, unless it reaches a pole; intervals wrap at ±180
+        if lat_lo <= -90 or lat_hi >= 90 or np.sin(angle) >= np.cos(np.radians(lat)):
+            lon_intervals = [(-180, 180)]
+        else:
+            dlon = np.degrees(np.arcsin(np.sin(angle) / np.cos(np.radians(lat))))
+            lo, hi = lon - dlon, lon + dlon
+            lon_intervals = [(max(lo, -180), min(hi, 180))]
+            if lo < -180:
+                lon_intervals.append((lo + 360, 180))
+            if hi > 180:
+                lon_intervals.append((-180, hi - 360))
+        idx = self._candidates(max(lat_lo, -90), min(lat_hi, 90), lon_intervals)
+        distances = haversine_km(lat, lon, self._lat[idx], self._lon[idx])
+        inside = distances <= radius_km
+        idx, distances = idx[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return self._positions[idx[order]], distances[order]
+
+    # Positions of the k nearest points and their distances: radius queries that widen until
+    # k points are found (every point closer than the k-th lies inside the last radius)
+    def nearest(self, lat, lon, k=1, max_km=HALF_CIRCUMFERENCE_KM):
+        radius = min(self.cell_deg * 111.2, max_km)
+        while True:
+            positions, distances = self.within(lat, lon, radius)
+            if len(positions) >= k or radius >= min(max_km, HALF_CIRCUMFERENCE_KM):
+                return positions[:k], distances[:k]
+            radius = min(radius * 4, max_km, HALF_CIRCUMFERENCE_KM)
@@ -0,0 +1,322 @@
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+import warnings
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+
+from mesi import metrics
+from mesi.config import DB_PATH, EXPORT_CHUNK_ROWS, SQLITE_MMAP_SIZE, SQLITE_POOL_SIZE
+from mesi.data_store import read_watermark
+from mesi.ratio_engine import RATIO_COLUMNS
+
+# Query layer that pushes the dashboard filters down to MESI.db (MESI_QUERY_BACKEND=sqlite).
+# Requests read only the rows they need through a per-process pool of read-only connections,
+# instead of keeping the tables resident. Multi-valued filters are passed as one JSON parameter
+# (json_each), so the SQL text stays the same and hits SQLite's statement cache.
+
+# Covering indexes for the pushed-down queries: (treatment, response) for the ratio aggregation,
+# (site) for site filters and clicked-site lookups, (lat, lon) for the map filters
+INDEXES = {
+    'Site_main_treatment_response': ('Site_main', ['treatment', 'response', 'ecosystem_type', 'site', 'lat', 'lon',
+                                                   'x_t', 'x_c']),
+    'Site_main_site': ('Site_main', ['site', 'lat', 'lon']),
+    'Site_main_lat_lon': ('Site_main', ['lat', 'lon', 'site']),
+    'Site_metadata_site': ('Site_metadata', ['site']),
+}
+
+
+# Switch the database to WAL (readers never block the writer that appends rows) and create the
+# indexes. Needs write access once; a read-only database is still queried, only more slowly.
+@metrics.stage('sqlite_prepare')
+def prepare_database(db_path=DB_PATH):
+    try:
+        conn = sqlite3.connect(db_path, timeout=600)  # Other workers may be building the same indexes
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for name, (table, columns) in INDEXES.items():
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.OperationalError as exc:
+        warnings.warn(f"Could not index {db_path} ({exc}); queries will scan the tables")
+
+
+# log(x_t / x_c) of one row, or NULL unless both values are numeric and positive (as in
+# ratio_engine.log_ratios, where x_t and x_c are text columns with "NA" for missing values)
+def log_ratio(x_t, x_c):
+    try:
+        x_t, x_c = float(x_t), float(x_c)
+    except (TypeError, ValueError):
+        return None
+    if x_t > 0 and x_c > 0:
+        return math.log(x_t / x_c)
+    return None
+
+
+class ConnectionPool:
+    """Read-only SQLite connections shared by the threads of one process."""
+
+    def __init__(self, db_path=DB_PATH, size=SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+
+    def _connect(self):
+        uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA query_only=1")
+        conn.create_function('log_ratio', 2, log_ratio, deterministic=True)
+        return conn
+
+    # Connections are not shared across fork, and a database file replaced on disk (new inode)
+    # is reopened; both start a fresh set of connections
+    def _check(self):
+        stat = os.stat(self.db_path)
+        file = (stat.st_dev, stat.st_ino)
+        with self._lock:
+            if self._pid == os.getpid() and self._file == file:
+                return
+            if self._pid == os.getpid():
+                while not self._idle.empty():
+                    self._idle.get_nowait().close()
+            self._pid, self._file = os.getpid(), file
+            self._idle = queue.LifoQueue()
+            self._opened = 0
+
+    # Borrow a connection; waits for one to be returned once `size` connections are open
+    @contextmanager
+    def connection(self):
+        self._check()
+        idle = self._idle
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                opened = self._opened < self.size
+                if opened:
+                    self._opened += 1
+            conn = self._connect() if opened else idle.get()
+        try:
+            yield conn
+        finally:
+            if idle is self._idle:
+                idle.put(conn)
+            else:
+                conn.close()  # The pool was reset while the connection was out
+
+    def read_frame(self, sql, params=()):
+        with self.connection() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+
+pool = ConnectionPool()
+
+
+# JSON parameter of a multi-valued filter, matched with `IN (SELECT value FROM json_each(?))`
+def json_values(values):
+    return json.dumps([value.item() if hasattr(value, 'item') else value for value in values])
+
+
+# WHERE clause and parameters of the optional site/lat/lon filters (None or empty means no filter)
+def _site_filters(sites=None, lats=None, lons=None, lat_range=None, lon_range=None):
+    clauses, params = [], []
+    for col, values in (('site', sites), ('lat', lats), ('lon', lons)):
+        if values:
+            clauses.append(f"{col} IN (SELECT value FROM json_each(?))")
+            params.append(json_values(values))
+    for col, value_range in (('lat', lat_range), ('lon', lon_range)):
+        if value_range is not None:
+            clauses.append(f"{col} BETWEEN ? AND ?")
+            params.extend(float(bound) for bound in value_range)
+    return (' AND '.join(clauses) or '1'), params
+
+
+# One row per (site, lat, lon) matching the filters, in the shape of map_lod.dedupe_sites
+@metrics.stage('sqlite_site_points')
+def site_points(sites=None, lats=None, lons=None, lat_range=None, lon_range=None):
+    where, params = _site_filters(sites, lats, lons, lat_range, lon_range)
+    points = pool.read_frame(f"SELECT DISTINCT site, lat, lon FROM Site_main "
+                             f"WHERE lat IS NOT NULL AND lon IS NOT NULL AND {where}", params)
+    points['count'] = 1
+    return points
+
+
+# Rows of a table for the selected sites (all rows without a selection), in database order
+@metrics.stage('sqlite_site_rows')
+def site_rows(table, columns=None, sites=None):
+    select = ', '.join(f'"{col}"' for col in columns) if columns else '*'
+    where, params = _site_filters(sites)
+    return pool.read_frame(f"SELECT {select} FROM {table} WHERE {where} ORDER BY rowid", params)
+
+
+# Arrow types of SQLite's storage classes, and the SQL a value is read with when a column holds
+# several of them (the first class present decides, as pandas would keep text rather than numbers)
+STORAGE_TYPES = [('blob', pa.binary(), 'CAST({} AS BLOB)'), ('text', pa.string(), 'CAST({} AS TEXT)'),
+                 ('real', pa.float64(), 'CAST({} AS REAL)'), ('integer', pa.int64(), '{}')]
+
+
+# The rows of site_rows as Arrow record batches of up to `page_rows` rows, read one page at a time
+# (after the last rowid of the previous page) as the batches are consumed. A connection is only
+# borrowed while a page is read, so a slow download does not hold one. The column types come from
+# the values of the selected rows, read in one pass before the first page.
+def site_batches(table, columns=None, sites=None, page_rows=EXPORT_CHUNK_ROWS):
+    where, params = _site_filters(sites)
+    with pool.connection() as conn:
+        columns = columns or [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        present = conn.execute("SELECT " + ', '.join(f"max(typeof(\"{col}\") = '{name}')" for col in columns
+                                                     for name, _, _ in STORAGE_TYPES)
+                               + f" FROM {table} WHERE {where}", params).fetchone()
+    fields, select = [], []
+    for i, col in enumerate(columns):
+        classes = present[i * len(STORAGE_TYPES):(i + 1) * len(STORAGE_TYPES)]
+        arrow_type, sql = next(((arrow_type, sql) for found, (_, arrow_type, sql) in zip(classes, STORAGE_TYPES)
+                                if found), (pa.null(), '{}'))
+        fields.append((col, arrow_type))
+        select.append(sql.format(f'"{col}"'))
+    schema = pa.schema(fields)
+
+    def pages():
+        last = 0
+        while True:
+            with pool.connection() as conn:
+                rows = conn.execute(f"SELECT rowid, {', '.join(select)} FROM {table} WHERE rowid > ? AND {where} "
+                                    f"ORDER BY rowid LIMIT ?", [last] + params + [int(page_rows)]).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            values = list(zip(*rows))[1:]
+            yield pa.RecordBatch.from_arrays([pa.array(col, type=field.type) for col, field in zip(values, schema)],
+                                             schema=schema)
+
+    return pa.RecordBatchReader.from_batches(schema, pages())
+
+
+# Comparison operators of the table header filters (Tabulator filter types) that map onto SQL as is
+FILTER_OPERATORS = {'=', '!=', '<', '>', '>=', '<='}
+
+
+# LIKE pattern matching `text` literally, case-insensitively (as the Tabulator text filters)
+def _like(text, prefix='%', suffix='%'):
+    escaped = str(text).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{prefix}{escaped}{suffix}"
+
+
+# WHERE clause and parameters of the header filters of a data table (dicts with field, type and
+# value, as in Tabulator.filters). Fields that are not columns of the table are ignored.
+def _header_filters(filters, columns):
+    clauses, params = [], []
+    for filt in filters:
+        col, op, value = filt['field'], filt['type'], filt['value']
+        if col not in columns:
+            continue
+        if isinstance(value, list):
+            if not value:
+                continue
+            if len(value) == 1:
+                value = value[0]
+        if op in FILTER_OPERATORS:
+            clauses.append(f'"{col}" {op} ?')
+            params.append(value)
+        elif op == 'in':
+            clauses.append(f'"{col}" IN (SELECT value FROM json_each(?))')
+            params.append(json_values(value if isinstance(value, list) else [value]))
+        elif op in ('like', 'starts', 'ends'):
+            clauses.append(f'"{col}" LIKE ? ESCAPE \'\\\'')
+            params.append(_like(value, '' if op == 'starts' else '%', '' if op == 'ends' else '%'))
+        elif op == 'keywords':
+            words = str(value).split()
+            if words:
+                clauses.append('(' + ' OR '.join(f'"{col}" LIKE ? ESCAPE \'\\\'' for _ in words) + ')')
+                params.extend(_like(word) for word in words)
+        else:
+            raise ValueError(f"Filter type {op!r} not supported")
+    return (' AND '.join(clauses) or '1'), params
+
+
+# One page of a data table and the number of rows matching: the selected sites' rows (all rows
+# without a selection) that pass the header filters, ordered by the sorters (dicts with field and
+# dir) and then in database order. Count and page are read in one transaction, so they agree.
+@metrics.stage('sqlite_site_page')
+def site_page(table, columns=None, sites=None, filters=(), sorters=(), offset=0, limit=25):
+    with pool.connection() as conn:
+        shown = set(columns or (row[1] for row in conn.execute(f"PRAGMA table_info({table})")))
+        select = ', '.join(f'"{col}"' for col in columns) if columns else '*'
+        where, params = _site_filters(sites)
+        header_where, header_params = _header_filters(filters, shown)
+        where, params = f"{where} AND {header_where}", params + header_params
+        order = [f'"{s["field"]}" {"DESC" if s.get("dir") == "desc" else "ASC"}'
+                 for s in sorters if s['field'] in shown]
+        conn.execute("BEGIN")
+        try:
+            total = conn.execute(f"SELECT count(*) FROM {table} WHERE {where}", params).fetchone()[0]
+            page = pd.read_sql_query(f"SELECT {select} FROM {table} WHERE {where} "
+                                     f"ORDER BY {', '.join(order + ['rowid'])} LIMIT ? OFFSET ?", conn,
+                                     params=params + [int(limit), int(offset)])
+        finally:
+            conn.rollback()
+    return page, total
+
+
+# First row of a site (the clicked-site details), or None if the site is unknown
+@metrics.stage('sqlite_first_row')
+def first_site_row(site):
+    rows = pool.read_frame("SELECT * FROM Site_main WHERE site = ? ORDER BY rowid LIMIT 1", (site,))
+    return rows.iloc[0] if len(rows) else None
+
+
+# Distinct non-null values of a Site_main column, sorted
+def distinct_values(col):
+    return pool.read_frame(f"SELECT DISTINCT {col} FROM Site_main WHERE {col} IS NOT NULL ORDER BY {col}")[col].tolist()
+
+
+# (min, max) of a Site_main column
+def value_range(col):
+    return tuple(pool.read_frame(f"SELECT min({col}) AS lo, max({col}) AS hi FROM Site_main").iloc[0])
+
+
+# Current (max_rowid, rows) of a table, as in data_store.read_watermark
+def watermark(table):
+    with pool.connection() as conn:
+        return read_watermark(conn, table)
+
+
+# Mean log ratio per site for a treatment/response, optionally restricted to one ecosystem_type.
+# Matches RatioEngine.lookup: rows with a missing key or no valid ratio are left out.
+@metrics.stage('sqlite_ratio')
+def ratio_by_site(treatment, response, ecosystem_type=None):
+    params = [treatment, response]
+    ecosystem_filter = ''
+    if ecosystem_type and ecosystem_type != "All":
+        ecosystem_filter = 'AND ecosystem_type = ?'
+        params.append(ecosystem_type)
+    df = pool.read_frame(f"""
+        SELECT site, lat, lon, ecosystem_type, avg(ratio) AS ratio
+        FROM (SELECT site, lat, lon, ecosystem_type, log_ratio(x_t, x_c) AS ratio
+              FROM Site_main
+              WHERE treatment = ? AND response = ? {ecosystem_filter}
+                AND site IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL AND ecosystem_type IS NOT NULL)
+        WHERE ratio IS NOT NULL
+        GROUP BY site, lat, lon, ecosystem_type
+        ORDER BY site, lat, lon, ecosystem_type""", params)
+    return df[RATIO_COLUMNS]
+
+
+# Ecosystem types available for a treatment/response pair
+def ecosystems(treatment, response):
+    return pool.read_frame("SELECT DISTINCT ecosystem_type FROM Site_main "
+                           "WHERE treatment = ? AND response = ? AND ecosystem_type IS NOT NULL ORDER BY ecosystem_type",
+                           (treatment, response))['ecosystem_type'].tolist()
@@ -0,0 +1,110 @@
+import os
+import threading
+
+import tornado.web
+
+# Background data loading, so the servers bind their port right away and report readiness
+# while the database is converted and the derived state is built.
+
+
+class BackgroundLoader:
+    """Loads the data once in a background thread, and starts the threads of every process serving it."""
+
+    def __init__(self, load, start_threads=None):
+        self._load = load
+        self._start_threads = start_threads  # Per-process threads using the loaded data (live refresh etc.)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loaded = False  # Inherited by forked workers, which share the loaded data copy-on-write
+        self._done = threading.Event()
+        self.error = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    # Locks and events held by other threads at fork time would stay held in the child
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        if self._loaded:
+            self._done.set()
+
+    # Start this process: load the data in a background thread, or, in a worker forked after the
+    # load, only start its threads (threads do not survive fork). A no-op once started.
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if self._loaded:
+                self._begin_serving()
+                return
+            self._done = threading.Event()
+            self.error = None
+            threading.Thread(target=self._run, name='mesi-data-loader', daemon=True).start()
+
+    # Load in the calling thread without starting any threads (eager startup, before the server
+    # forks its workers); each process starts its threads when it first serves the data
+    def load(self):
+        with self._lock:
+            self._load()
+            self._loaded = True
+            self._done.set()
+
+    def _begin_serving(self):
+        if self._start_threads is not None:
+            self._start_threads()
+
+    def _run(self):
+        try:
+            self._load()
+            self._loaded = True
+            self._begin_serving()
+        except Exception as exc:
+            self.error = exc
+            raise
+        finally:
+            self._done.set()
+
+    def ready(self):
+        self.start()
+        return self._done.is_set() and self.error is None
+
+    # Block until the data is loaded; re-raises the load error
+    def wait(self, timeout=None):
+        self.start()
+        if not self._done.wait(timeout):
+            raise TimeoutError("Data is still loading")
+        if self.error is not None:
+            raise RuntimeError("Data failed to load") from self.error
+
+    def status(self):
+        self.start()
+        if not self._done.is_set():
+            return 503, 'loading'
+        if self.error is not None:
+            return 500, f'failed: {self.error!r}'
+        return 200, 'ready'
+
+
+# Flask (Dash) server: GET /ready answers 200 once the data is loaded, 503 while loading
+def add_ready_route(server, loader):
+    import flask
+
+    @server.route('/ready')
+    def ready():
+        code, text = loader.status()
+        return flask.Response(text + '\n', status=code, content_type='text/plain')
+
+    return server
+
+
+# Tornado (Panel) handler for GET /ready
+class ReadyHandler(tornado.web.RequestHandler):
+
+    def initialize(self, loader):
+        self.loader = loader
+
+    def get(self):
+        code, text = self.loader.status()
+        self.set_status(code)
+        self.set_header('Content-Type', 'text/plain')
+        self.write(text + '\n')
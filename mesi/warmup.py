@@ -0,0 +1,56 @@
+import fcntl
+import os
+import threading
+import traceback
+from contextlib import contextmanager
+
+# Background warm-up of the views every session is likely to open. Runs after startup and after
+# every data change, in one thread per process; requests made while a run is in progress are merged
+# into a single next run.
+
+
+class WarmupScheduler:
+    """Runs a warm-up function in a background thread whenever it is requested."""
+
+    def __init__(self, warm_up):
+        self._warm_up = warm_up
+        self._lock = threading.Lock()
+        self._pid = None
+        self._requested = threading.Event()
+
+    # Ask for a warm-up run. Forked workers start their own thread, since threads do not survive fork.
+    def request(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._requested = threading.Event()
+                threading.Thread(target=self._run, args=(self._requested,), name='mesi-warmup', daemon=True).start()
+            self._requested.set()
+
+    def _run(self, requested):
+        while True:
+            requested.wait()
+            requested.clear()
+            try:
+                self._warm_up()
+            except Exception:
+                traceback.print_exc()
+
+
+# One warm-up at a time across the worker processes sharing `directory` (None: no sharing). The lock
+# is held for the whole run and released by the OS if the process dies. A POSIX record lock rather
+# than flock: it is not inherited by the render pool forked while it is held. Yields False if another
+# process is warming up; its results reach this process through the shared directory.
+@contextmanager
+def exclusive(directory):
+    if directory is None:
+        yield True
+        return
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'warmup.lock'), 'w') as lock_file:
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
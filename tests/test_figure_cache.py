@@ -0,0 +1,76 @@
+import sqlite3
+
+import numpy as np
+import plotly.graph_objs as go
+import pytest
+
+from benchmarks.synthetic_db import generate_db
+from mesi import data_store, figure_cache
+from mesi.figure_cache import FigureCache, data_key, figure_key
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'MESI.db')
+    generate_db(path, 2000, seed=4)
+    monkeypatch.setattr(data_store, '_frames', {})
+    return path, str(tmp_path / 'store')
+
+
+def loaded_key(db):
+    path, store_dir = db
+    data_store.get_frame('Site_main', path, store_dir)
+    return data_key(data_store.watermark('Site_main'), data_store.identity('Site_main'))
+
+
+def test_keys_ignore_the_order_of_set_filters():
+    data = data_key((np.int64(10), 10), [1, 2, 3, None])
+    assert (figure_key('main_map', data, sites={'b', 'a'}, lat_range=(np.float64(-1), np.float64(1)))
+            == figure_key('main_map', data, sites={'a', 'b'}, lat_range=(-1.0, 1.0)))
+    assert figure_key('main_map', data, sites={'a'}) != figure_key('main_map', data, sites={'a', 'b'})
+    assert figure_key('main_map', data) != figure_key('ratio_map', data)
+
+
+def test_keys_follow_the_settings(monkeypatch):
+    before = figure_key('main_map', [None, 1, 1])
+    monkeypatch.setitem(figure_cache.FIGURE_SETTINGS, 'point_budget', -1)
+    assert figure_key('main_map', [None, 1, 1]) != before
+
+
+def test_keys_reject_unknown_values():
+    with pytest.raises(TypeError):
+        figure_key('main_map', [None, 1, 1], sites=object())
+
+
+def test_data_key_is_stable_across_reloads(db, monkeypatch):
+    key = loaded_key(db)
+    monkeypatch.setattr(data_store, '_frames', {})  # Another process loading the same store
+    assert loaded_key(db) == key
+
+
+@pytest.mark.parametrize('statement', [
+    "UPDATE Site_main SET x_t = '999' WHERE rowid = 5",
+    "DELETE FROM Site_main WHERE rowid = (SELECT max(rowid) FROM Site_main)",
+])
+def test_edit_in_place_misses_the_cache(db, tmp_path, statement):
+    path, store_dir = db
+    cache = FigureCache(directory=str(tmp_path / 'figures'))
+    before = figure_key('ratio_map', loaded_key(db), treatment='f', response='agb')
+    cache.put(before, figure_cache.dump_figure(go.Figure()))
+
+    with sqlite3.connect(path) as conn:
+        conn.execute(statement)
+    assert data_store.refresh_frames(path, store_dir)['Site_main'] is None  # Reloaded, not appended
+    after = figure_key('ratio_map', loaded_key(db), treatment='f', response='agb')
+    assert after != before
+    assert cache.get(after) == (None, 'miss')
+    assert FigureCache(directory=str(tmp_path / 'figures')).get(before)[1] == 'disk'  # Only the key moved
+
+
+def test_contains_does_not_load_disk_entries(tmp_path):
+    writer = FigureCache(directory=str(tmp_path / 'figures'))
+    writer.put('a', b'{}')
+    reader = FigureCache(directory=str(tmp_path / 'figures'))
+    assert reader.contains('a') and not reader.contains('b')
+    assert not reader._entries  # Not promoted to memory
+    assert FigureCache(directory=None).contains('a') is False
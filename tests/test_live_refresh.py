@@ -0,0 +1,96 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from benchmarks.synthetic_db import generate_db
+from mesi import data_store
+from mesi.live_refresh import DatabaseWatcher
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'MESI.db')
+    generate_db(path, 2000, seed=6)
+    monkeypatch.setattr(data_store, '_frames', {})
+    return path, str(tmp_path / 'store')
+
+
+def execute(path, statement, params=()):
+    with sqlite3.connect(path) as conn:
+        conn.execute(statement, params)
+
+
+def test_watcher_reports_commits_once(db):
+    path, _ = db
+    watcher = DatabaseWatcher(path)
+    assert watcher.changed()  # First check: nothing seen yet
+    assert not watcher.changed()
+    execute(path, "UPDATE Site_main SET x_t = '1' WHERE rowid = 1")
+    assert watcher.changed()
+    assert not watcher.changed()
+    watcher.reset()
+    assert watcher.changed()
+
+
+def test_watcher_reports_a_replaced_file(db, tmp_path):
+    path, _ = db
+    watcher = DatabaseWatcher(path)
+    watcher.changed()
+    shutil.copy(path, str(tmp_path / 'copy.db'))
+    os.replace(str(tmp_path / 'copy.db'), path)
+    assert watcher.changed()
+
+
+def test_appended_rows_are_caught_up(db):
+    path, store_dir = db
+    before = data_store.get_frame('Site_main', path, store_dir)
+    execute(path, "INSERT INTO Site_main SELECT * FROM Site_main WHERE rowid <= 10")
+    execute(path, "INSERT INTO Site_main (site, lat, lon, treatment, response, x_c, x_t) "
+                  "VALUES ('new_site', 1.5, 2.5, 'f', 'agb', 'NA', '4')")
+
+    changes = data_store.refresh_frames(path, store_dir)
+    assert list(changes) == ['Site_main'] and len(changes['Site_main']) == 11
+    after = data_store.get_frame('Site_main', path, store_dir)
+    assert len(after) == len(before) + 11
+    assert after['site'].iloc[-1] == 'new_site' and after['x_c'].isna().iloc[-1]
+    assert after.iloc[:len(before)].astype(object).equals(before.astype(object))  # Categories may grow
+    assert data_store.watermark('Site_main') == data_store.Watermark(len(after), len(after))
+    assert data_store.refresh_frames(path, store_dir) == {}  # Nothing new
+
+
+def test_edited_rows_reload_the_table(db):
+    path, store_dir = db
+    data_store.get_frame('Site_main', path, store_dir)
+    execute(path, "UPDATE Site_main SET x_t = '999', site = 'renamed' WHERE rowid = 3")
+
+    assert data_store.refresh_frames(path, store_dir) == {'Site_main': None}
+    after = data_store.get_frame('Site_main', path, store_dir)
+    assert after['x_t'].iloc[2] == 999 and after['site'].iloc[2] == 'renamed'
+
+
+def test_deleted_rows_reload_the_table(db):
+    path, store_dir = db
+    before = data_store.get_frame('Site_main', path, store_dir)
+    execute(path, "DELETE FROM Site_main WHERE rowid = 3")
+
+    assert data_store.refresh_frames(path, store_dir) == {'Site_main': None}
+    after = data_store.get_frame('Site_main', path, store_dir)
+    assert len(after) == len(before) - 1
+    assert after['site'].astype(object).tolist() == before['site'].astype(object).drop(index=2).tolist()
+
+
+def test_delete_and_insert_keeping_the_row_count_reloads_the_table(db):
+    path, store_dir = db
+    data_store.get_frame('Site_main', path, store_dir)
+    rows = data_store.watermark('Site_main')
+    with sqlite3.connect(path) as conn:
+        conn.execute("DELETE FROM Site_main WHERE rowid = 5")
+        conn.execute("INSERT INTO Site_main (site, lat, lon, treatment, response, x_c, x_t) "
+                     "VALUES ('replacement', 0, 0, 'f', 'agb', '1', '2')")
+
+    changes = data_store.refresh_frames(path, store_dir)
+    assert changes == {'Site_main': None}
+    after = data_store.get_frame('Site_main', path, store_dir)
+    assert len(after) == rows.rows and 'replacement' in set(after['site'])
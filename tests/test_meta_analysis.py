@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mesi import meta_analysis
+
+
+# Site_main-like rows: text measurements with "NA" for missing values, a few one-row groups and
+# rows with a missing group key
+@pytest.fixture
+def site_main():
+    rng = np.random.default_rng(1)
+    n = 3000
+    x_c = rng.lognormal(2, 1, n)
+    x_t = x_c * rng.lognormal(rng.choice([-0.2, 0.1, 0.3], n), 0.3)
+    df = pd.DataFrame({
+        'treatment': rng.choice(['f', 'w', 'i'], n).astype(object),
+        'response': rng.choice(['agb', 'soc'], n).astype(object),
+        'ecosystem_type': rng.choice(['forest', 'grassland', 'tundra', 'wetland'], n).astype(object),
+        'x_c': np.char.mod('%.4g', x_c).astype(object),
+        'x_t': np.char.mod('%.4g', x_t).astype(object),
+        'sd_c': np.char.mod('%.4g', x_c * rng.uniform(0.05, 0.4, n)).astype(object),
+        'sd_t': np.char.mod('%.4g', x_t * rng.uniform(0.05, 0.4, n)).astype(object),
+        'rep_c': rng.integers(2, 10, n).astype(str).astype(object),
+        'rep_t': rng.integers(2, 10, n).astype(str).astype(object),
+    })
+    df.loc[rng.random(n) < 0.05, 'sd_t'] = 'NA'
+    df.loc[rng.random(n) < 0.02, 'x_c'] = 'NA'
+    df.loc[rng.random(n) < 0.02, 'ecosystem_type'] = None
+    singles = pd.DataFrame({'treatment': ['c', 'd'], 'response': ['agb', 'agb'], 'ecosystem_type': ['forest', 'forest'],
+                            'x_c': ['10', '4'], 'x_t': ['12', '5'], 'sd_c': ['1', '0.5'], 'sd_t': ['2', '0.5'],
+                            'rep_c': ['3', '4'], 'rep_t': ['3', '4']})
+    return pd.concat([df, singles], ignore_index=True)
+
+
+# DerSimonian-Laird estimates of one group, straight from the formulas
+def dersimonian_laird(y, v):
+    w = 1 / v
+    mean_fixed = np.sum(w * y) / np.sum(w)
+    q = np.sum(w * (y - mean_fixed) ** 2)
+    c = np.sum(w) - np.sum(w ** 2) / np.sum(w)
+    tau2 = max(0.0, (q - (len(y) - 1)) / c) if c > 0 else 0.0
+    ws = 1 / (v + tau2)
+    return {
+        'k': len(y),
+        'mean_fixed': mean_fixed,
+        'se_fixed': np.sqrt(1 / np.sum(w)),
+        'mean_random': np.sum(ws * y) / np.sum(ws),
+        'se_random': np.sqrt(1 / np.sum(ws)),
+        'tau2': tau2,
+        'q': q,
+        'i2': max(0.0, (q - (len(y) - 1)) / q) if q > 0 else 0.0,
+    }
+
+
+def test_summary_matches_per_group_loop(site_main):
+    summary = meta_analysis.summarize(site_main)
+
+    expected = []
+    for key, group in site_main.dropna(subset=meta_analysis.GROUP_COLUMNS).groupby(meta_analysis.GROUP_COLUMNS):
+        y, v = meta_analysis.log_ratios(group)
+        usable = np.isfinite(y) & np.isfinite(v) & (v > 0)
+        if usable.any():
+            expected.append({**dict(zip(meta_analysis.GROUP_COLUMNS, key)), **dersimonian_laird(y[usable], v[usable])})
+    expected = pd.DataFrame(expected)
+
+    assert len(summary) == len(expected)
+    assert (summary['k'] == 1).any()
+    for col in meta_analysis.GROUP_COLUMNS + ['k']:
+        assert summary[col].tolist() == expected[col].tolist()
+    for col in ['mean_fixed', 'se_fixed', 'mean_random', 'se_random', 'tau2', 'q', 'i2']:
+        np.testing.assert_allclose(summary[col], expected[col], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(summary['ci_upper'] - summary['ci_lower'],
+                               2 * meta_analysis.Z_95 * summary['se_random'], rtol=1e-9)
+    assert summary['boot_lower'].isna().all()  # No replicates asked for
+
+
+def test_log_ratios_need_positive_values():
+    df = pd.DataFrame({'x_t': ['2', '0', 'NA', '3'], 'x_c': ['1', '1', '1', '-1'], 'sd_t': ['1'] * 4,
+                       'sd_c': ['1'] * 4, 'rep_t': ['2', '2', '2', '2'], 'rep_c': ['0', '2', '2', '2']})
+    y, v = meta_analysis.log_ratios(df)
+    assert y[0] == pytest.approx(np.log(2)) and np.isnan(v[0])  # rep_c of 0: no variance
+    assert np.isnan(y[1:]).all() and np.isnan(v[1:]).all()
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic_db import generate_db
+from mesi import data_store
+from mesi.ratio_engine import CUBE_KEYS, RATIO_COLUMNS, RatioEngine
+
+
+@pytest.fixture
+def site_main(tmp_path, monkeypatch):
+    path = str(tmp_path / 'MESI.db')
+    generate_db(path, 3000, seed=5)
+    monkeypatch.setattr(data_store, '_frames', {})
+    return data_store.get_frame('Site_main', path, str(tmp_path / 'store'))
+
+
+# Mean log ratio per site of one treatment/response, straight from the rows
+def expected_ratios(df, treatment, response, ecosystem_type=None):
+    x_t = pd.to_numeric(df['x_t'], errors='coerce').to_numpy(dtype=float)
+    x_c = pd.to_numeric(df['x_c'], errors='coerce').to_numpy(dtype=float)
+    rows = pd.DataFrame({col: df[col].astype(object) for col in CUBE_KEYS})
+    keep = ((rows['treatment'] == treatment) & (rows['response'] == response) & (x_t > 0) & (x_c > 0)
+            & rows[CUBE_KEYS].notna().all(axis=1))
+    if ecosystem_type:
+        keep &= rows['ecosystem_type'] == ecosystem_type
+    rows = rows[keep].assign(ratio=np.log(x_t[keep] / x_c[keep]))
+    return rows.groupby(RATIO_COLUMNS[:-1])['ratio'].mean().reset_index()
+
+
+def assert_same_ratios(result, expected):
+    assert list(result.columns) == RATIO_COLUMNS
+    result = result.sort_values(RATIO_COLUMNS[:-1], ignore_index=True)
+    for col in RATIO_COLUMNS[:-1]:
+        assert result[col].astype(object).tolist() == expected[col].tolist()
+    np.testing.assert_allclose(result['ratio'], expected['ratio'], rtol=1e-12)
+
+
+def test_lookup_matches_the_rows(site_main):
+    engine = RatioEngine(site_main)
+    for ecosystem_type in [None, 'All', 'forest', 'tundra']:
+        assert_same_ratios(engine.lookup('f', 'agb', ecosystem_type),
+                           expected_ratios(site_main, 'f', 'agb', None if ecosystem_type == 'All' else ecosystem_type))
+    assert engine.lookup('f', 'agb') is engine.lookup('f', 'agb')  # Cached
+    assert engine.lookup('f', 'no such response').empty
+    assert sorted(engine.ecosystems('f', 'agb')) == sorted(expected_ratios(site_main, 'f', 'agb')['ecosystem_type'].unique())
+
+
+def test_append_matches_a_rebuild(site_main):
+    old, new = site_main.iloc[:2000], site_main.iloc[2000:]
+    engine = RatioEngine(old, version=1)
+    before = engine.lookup('w', 'soc')
+    assert engine.summary('w', 'soc').count == len(before)
+    changed = engine.append(new, version=2)
+
+    assert changed == set(zip(new['treatment'].astype(object), new['response'].astype(object)))
+    assert not engine.is_stale(2)
+    for treatment, response in [('w', 'soc'), ('f', 'agb'), ('d', 'soil_total_c')]:
+        assert_same_ratios(engine.lookup(treatment, response), expected_ratios(site_main, treatment, response))
+    assert engine.lookup('w', 'soc') is not before  # Dropped from the cache
+    assert engine.summary('w', 'soc').count == len(engine.lookup('w', 'soc')) > len(before)
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from mesi import map_lod
+from mesi.spatial_index import HALF_CIRCUMFERENCE_KM, SpatialIndex, haversine_km
+
+
+# Points spread over the globe, plus clusters on both sides of the ±180° seam, at and around the
+# poles, on the cell edges and a few without coordinates
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(2)
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, 4000)))
+    lon = rng.uniform(-180, 180, 4000)
+    seam_lat = rng.uniform(-70, 70, 300)
+    seam_lon = np.concatenate([rng.uniform(179, 180, 150), rng.uniform(-180, -179, 150)])
+    pole_lat = np.concatenate([rng.uniform(88, 90, 150), rng.uniform(-90, -88, 150)])
+    pole_lon = rng.uniform(-180, 180, 300)
+    edges_lat = [90, -90, 0, 45, 89, -89.0, np.nan, 10]
+    edges_lon = [0, 135, 180, -180, -180, 180, 20, np.nan]
+    return pd.DataFrame({'site': np.arange(4608),
+                         'lat': np.concatenate([lat, seam_lat, pole_lat, edges_lat]),
+                         'lon': np.concatenate([lon, seam_lon, pole_lon, edges_lon])})
+
+
+@pytest.fixture(scope='module')
+def index(points):
+    return SpatialIndex(points)
+
+
+# Centres near the seam, near and at both poles, and elsewhere
+CENTRES = [(0, 179.9), (0, -179.9), (45, 180), (-30, -180), (89.9, 10), (90, 0), (-90, 0), (-88.5, 170),
+           (51.5, -0.1), (-33.9, 151.2), (0, 0)]
+RADII_KM = [1, 50, 300, 2000, 12000, HALF_CIRCUMFERENCE_KM]
+
+
+def brute_distances(points, lat, lon):
+    return haversine_km(lat, lon, points['lat'].to_numpy(dtype=float), points['lon'].to_numpy(dtype=float))
+
+
+@pytest.mark.parametrize('lat_range, lon_range', [
+    ((-90, 90), (-180, 180)), ((10, 40), (-20, 60)), ((-10, 10), (170, 180)), ((-10, 10), (-180, -175)),
+    ((85, 90), (-180, 180)), ((-90, -89), (0, 180)), ((0.5, 0.5), (0, 1)), ((45, 45), (180, 180)),
+    ((40, 10), (0, 10)), ((0, 10), (10, 0)),
+])
+def test_box_matches_brute_force(points, index, lat_range, lon_range):
+    expected = np.flatnonzero(points['lat'].between(*lat_range) & points['lon'].between(*lon_range))
+    np.testing.assert_array_equal(index.box(lat_range, lon_range), expected)
+
+
+@pytest.mark.parametrize('lat, lon', CENTRES)
+@pytest.mark.parametrize('radius_km', RADII_KM)
+def test_within_matches_brute_force(points, index, lat, lon, radius_km):
+    distances = brute_distances(points, lat, lon)
+    positions, found = index.within(lat, lon, radius_km)
+    assert sorted(positions) == sorted(np.flatnonzero(distances <= radius_km))
+    np.testing.assert_array_equal(found, distances[positions])
+    assert np.all(np.diff(found) >= 0)
+
+
+def test_within_crosses_the_seam():
+    index = SpatialIndex(pd.DataFrame({'lat': [0.0, 0.05, 0.0, 0.0], 'lon': [179.95, -179.95, -179.5, 0.0]}))
+    positions, distances = index.within(0, 179.99, 20)
+    assert positions.tolist() == [0, 1]
+    assert distances[1] < 20
+
+
+def test_within_covers_every_longitude_at_a_pole(points, index):
+    positions, _ = index.within(90, 0, 250)
+    expected = np.flatnonzero(points['lat'] >= 88)
+    assert set(expected) <= set(positions)
+
+
+@pytest.mark.parametrize('lat, lon', CENTRES)
+@pytest.mark.parametrize('k', [1, 5, 40])
+def test_nearest_matches_brute_force(points, index, lat, lon, k):
+    distances = brute_distances(points, lat, lon)
+    positions, found = index.nearest(lat, lon, k=k)
+    assert len(positions) == k
+    np.testing.assert_array_equal(found, np.sort(distances[np.isfinite(distances)])[:k])
+    np.testing.assert_array_equal(found, distances[positions])
+
+
+def test_nearest_stops_at_max_km(index):
+    positions, found = index.nearest(0, 0, k=10, max_km=1e-3)
+    assert len(positions) == len(found) < 10
+
+
+# Clicking a binned marker finds exactly the points bin_points put in its cell, from the box of the
+# cells around it, for ranges that bin the points into cells of a few points each
+@pytest.mark.parametrize('lat_range, lon_range, budget', [
+    ((-90, 90), (-180, 180), 300), ((-20, 50), (100, 180), 40), ((-90, -60), (-180, 180), 25),
+])
+def test_binned_markers_resolve_to_their_cell(points, index, lat_range, lon_range, budget):
+    inside = index.box(lat_range, lon_range)
+    cells = map_lod.bin_points(index.points.iloc[inside].assign(count=1), lat_range, lon_range, budget=budget)
+    rows, cols = map_lod.bin_cells(points['lat'].to_numpy()[inside], points['lon'].to_numpy()[inside],
+                                   lat_range, lon_range, budget)
+    assert (cells['count'] > 1).any()
+    for marker in cells.itertuples():
+        positions = index.box(*map_lod.cell_box(marker.lat, marker.lon, lat_range, lon_range, budget))
+        positions = positions[map_lod.cell_members(index.points.iloc[positions], marker.lat, marker.lon,
+                                                   lat_range, lon_range, budget)]
+        row, col = map_lod.bin_cells(marker.lat, marker.lon, lat_range, lon_range, budget)
+        expected = inside[(rows == row) & (cols == col)]
+        assert len(positions) == marker.count
+        assert sorted(positions) == sorted(expected)
@@ -0,0 +1,128 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from benchmarks.synthetic_db import generate_db
+from mesi import data_store, export, sqlite_query
+from mesi.ratio_engine import RATIO_COLUMNS, RatioEngine
+
+RATIO_KEYS = ['site', 'lat', 'lon', 'ecosystem_type']
+
+
+# A synthetic MESI.db queried by both backends: the sqlite query layer, and the store (Arrow copy
+# of the tables) feeding the ratio engine
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'MESI.db')
+    generate_db(path, 3000, seed=3)
+    sqlite_query.prepare_database(path)
+    monkeypatch.setattr(sqlite_query, 'pool', sqlite_query.ConnectionPool(path, size=2))
+    monkeypatch.setattr(data_store, '_frames', {})
+    return path, str(tmp_path / 'store')
+
+
+def pairs(df):
+    return sorted(set(zip(df['treatment'].astype(object), df['response'].astype(object))))
+
+
+def assert_same_ratios(engine, treatment, response, ecosystem_type):
+    from_sqlite = sqlite_query.ratio_by_site(treatment, response, ecosystem_type)
+    from_store = engine.lookup(treatment, response, ecosystem_type)
+    assert list(from_sqlite.columns) == list(from_store.columns) == RATIO_COLUMNS
+    from_sqlite = from_sqlite.sort_values(RATIO_KEYS, ignore_index=True)
+    from_store = from_store.sort_values(RATIO_KEYS, ignore_index=True)
+    for col in RATIO_KEYS:
+        assert from_sqlite[col].astype(object).tolist() == from_store[col].astype(object).tolist()
+    np.testing.assert_allclose(from_sqlite['ratio'].astype(float), from_store['ratio'].astype(float), rtol=1e-12)
+
+
+def assert_same_backends(engine, df):
+    for treatment, response in pairs(df) + [('f', 'no such response')]:
+        ecosystems = sqlite_query.ecosystems(treatment, response)
+        assert ecosystems == sorted(engine.ecosystems(treatment, response))
+        for ecosystem_type in [None, 'All'] + ecosystems:
+            assert_same_ratios(engine, treatment, response, ecosystem_type)
+
+
+def test_ratio_by_site_matches_ratio_engine(db):
+    path, store_dir = db
+    df = data_store.get_frame('Site_main', path, store_dir)
+    assert_same_backends(RatioEngine(df), df)
+
+
+def test_backends_agree_after_appends(db):
+    path, store_dir = db
+    engine = RatioEngine(data_store.get_frame('Site_main', path, store_dir))
+    with sqlite3.connect(path) as conn:
+        # New observations of known sites and a new site, including values the ratio skips
+        conn.execute("INSERT INTO Site_main SELECT * FROM Site_main WHERE rowid % 7 = 0")
+        conn.execute("INSERT INTO Site_main (site, lat, lon, treatment, response, x_c, x_t, ecosystem_type) VALUES "
+                     "('new_site', 1.5, 2.5, 'f', 'agb', '3', '4', 'forest'), "
+                     "('new_site', 1.5, 2.5, 'f', 'agb', 'NA', '4', 'forest')")
+    changes = data_store.refresh_frames(path, store_dir)
+    engine.append(changes['Site_main'])
+    df = data_store.get_frame('Site_main', path, store_dir)
+    assert len(df) == sqlite_query.watermark('Site_main').rows
+    assert_same_backends(engine, df)
+    assert 'new_site' in set(sqlite_query.ratio_by_site('f', 'agb')['site'])
+
+
+# Site table pages read in SQL against the same rows filtered and sorted in pandas
+@pytest.mark.parametrize('filters, sorters', [
+    ([], []),
+    ([{'field': 'treatment', 'type': '=', 'value': 'f'}], [{'field': 'lat', 'dir': 'desc'}]),
+    ([{'field': 'response', 'type': 'in', 'value': ['agb', 'soc']}, {'field': 'citation', 'type': 'like', 'value': 'author1'}],
+     [{'field': 'site', 'dir': 'asc'}]),
+    ([{'field': 'no_such_column', 'type': '=', 'value': 1}], [{'field': 'no_such_column', 'dir': 'asc'}]),
+])
+def test_site_page_matches_pandas(db, filters, sorters):
+    columns = ['site', 'lat', 'lon', 'treatment', 'response', 'citation']
+    rows = sqlite_query.site_rows('Site_main', columns)
+    expected = rows
+    for filt in filters:
+        if filt['field'] not in columns:
+            continue
+        values = expected[filt['field']]
+        if filt['type'] == '=':
+            expected = expected[values == filt['value']]
+        elif filt['type'] == 'in':
+            expected = expected[values.isin(filt['value'])]
+        else:
+            expected = expected[values.str.lower().str.contains(filt['value'].lower(), regex=False)]
+    for sorter in reversed(sorters):
+        if sorter['field'] in columns:
+            expected = expected.sort_values(sorter['field'], ascending=sorter['dir'] == 'asc', kind='stable')
+
+    for offset in (0, 25, len(expected) - 5):
+        page, total = sqlite_query.site_page('Site_main', columns, filters=filters, sorters=sorters,
+                                             offset=offset, limit=25)
+        assert total == len(expected)
+        pd.testing.assert_frame_equal(page, expected.iloc[offset:offset + 25].reset_index(drop=True))
+
+
+def test_site_page_rejects_unknown_filter_types(db):
+    with pytest.raises(ValueError):
+        sqlite_query.site_page('Site_main', filters=[{'field': 'site', 'type': 'regex', 'value': 'a'}])
+
+
+# Site exports read page by page give the rows of site_rows, and the same file as the whole table
+@pytest.mark.parametrize('table, columns, sites', [
+    ('Site_main', None, None),
+    ('Site_main', ['site', 'lat', 'lon', 'citation'], ['site_1', 'site_7']),
+    ('Site_metadata', None, None),
+])
+def test_site_batches_match_site_rows(db, table, columns, sites):
+    expected = sqlite_query.site_rows(table, columns, sites)
+    batches = list(sqlite_query.site_batches(table, columns, sites, page_rows=97))
+    assert all(batch.num_rows <= 97 for batch in batches)
+    streamed = pa.Table.from_batches(batches).to_pandas()
+    assert list(streamed.columns) == list(expected.columns)
+    for col in expected.columns:
+        assert streamed[col].astype(object).tolist() == expected[col].astype(object).tolist()
+
+    whole = pa.Table.from_pandas(expected, preserve_index=False)
+    reader = sqlite_query.site_batches(table, columns, sites, page_rows=97)
+    assert b''.join(export.iter_export(reader)) == b''.join(export.iter_export(whole))